@@ -18,47 +18,128 @@ truncate, pad and process it into batches ready for training"""
 from __future__ import absolute_import
 from __future__ import division
 
+import os
 import random
 import time
 import re
+from itertools import izip
 
 import numpy as np
 from six.moves import xrange
 from vocab import PAD_ID, UNK_ID, CHAR_PAD_ID, CHAR_UNK_ID, ALPHABET
 
+# Maps a character code (< 256) to its char id: its first position in ALPHABET, or CHAR_UNK_ID.
+# Characters with higher codes are all CHAR_UNK_ID. All the char ids fit in a uint8.
+CHAR_ID_TABLE = np.array([ALPHABET.find(chr(code)) if chr(code) in ALPHABET else CHAR_UNK_ID for code in xrange(256)], dtype=np.uint8)
+
+# Memo of word_char_ids, cleared when it reaches CHAR_ID_CACHE_SIZE words
+CHAR_ID_CACHE_SIZE = 200000
+char_id_cache = {}
+
+# The line offsets of a data file (see get_line_offsets) are saved next to it, with this suffix
+LINE_OFFSETS_SUFFIX = ".offsets.npy"
+
 
 class Batch(object):
     """A class to hold the information needed for a training batch"""
 
-    def __init__(self, context_ids, context_char_ids, context_mask, context_tokens, qn_ids, qn_char_ids, qn_mask, qn_tokens, ans_span, ans_tokens, uuids=None):
+    # No per-object __dict__: a batch only has these attributes
+    __slots__ = ["context_ids", "context_char_ids", "context_lens", "context_tokens", "qn_ids", "qn_char_ids", "qn_lens", "qn_tokens", "ans_span",
+                 "uuids", "context_offsets", "num_windows", "context_words", "context_word_idx", "qn_words", "qn_word_idx", "batch_size"]
+
+    def __init__(self, context_ids, context_char_ids, context_lens, context_tokens, qn_ids, qn_char_ids, qn_lens, qn_tokens, ans_span, uuids=None, context_words=None, context_word_idx=None, qn_words=None, qn_word_idx=None, context_offsets=None, num_windows=None):
         """
         Inputs:
-          {context/qn}_ids: Numpy arrays.
+          {context/qn}_ids: Numpy int32 arrays.
             Shape (batch_size, {context_len/question_len}). Contains padding.
-          {context/qn}_mask: Numpy arrays, same shape as _ids.
-            Contains 1s where there is real data, 0s where there is padding.
-          {context/qn/ans}_tokens: Lists length batch_size, containing lists (unpadded) of tokens (strings)
-          ans_span: numpy array, shape (batch_size, 2)
+          {context/qn}_char_ids: Numpy uint8 arrays shape (batch_size, {context_len/question_len} * word_len).
+            May be None if the batch only has the _words and _word_idx inputs (see data_shards.make_batch).
+          {context/qn}_lens: Numpy int32 arrays shape (batch_size).
+            The number of real (non-padding) tokens in each row of _ids. The graph makes the masks from these.
+          {context/qn}_words: Numpy uint8 arrays shape (num_unique_words, word_len).
+            The char ids of the unique words in the batch (see unique_word_char_ids).
+          {context/qn}_word_idx: Numpy int32 arrays, same shape as _ids.
+            The index of each token in {context/qn}_words.
+          {context/qn}_tokens: Sequences (e.g. lists) length batch_size, containing sequences (tuples or lists, unpadded) of tokens (strings).
+            Examples about the same context may share the same sequence.
+          ans_span: numpy int32 array, shape (batch_size, 2), or None if there are no answers.
+            The answer tokens (ans_tokens) are sliced from context_tokens when needed.
           uuid: a list (length batch_size) of strings.
             Not needed for training. Used by official_eval mode.
+          context_offsets: a list (length batch_size) of ints.
+            The position of context_tokens in the full context, when long contexts
+            are split into windows. Used by official_eval mode.
+          num_windows: a list (length batch_size) of ints.
+            The number of windows the full context was split into. Used by official_eval mode.
+
+        Note: the arrays may be views of a BatchBuffers, which are reused for later batches.
         """
         self.context_ids = context_ids
         self.context_char_ids = context_char_ids
-        self.context_mask = context_mask
+        self.context_lens = context_lens
         self.context_tokens = context_tokens
 
         self.qn_ids = qn_ids
         self.qn_char_ids = qn_char_ids
-        self.qn_mask = qn_mask
+        self.qn_lens = qn_lens
         self.qn_tokens = qn_tokens
 
         self.ans_span = ans_span
-        self.ans_tokens = ans_tokens
 
         self.uuids = uuids
+        self.context_offsets = context_offsets
+        self.num_windows = num_windows
+
+        self.context_words = context_words
+        self.context_word_idx = context_word_idx
+        self.qn_words = qn_words
+        self.qn_word_idx = qn_word_idx
 
         self.batch_size = len(self.context_tokens)
 
+    @property
+    def ans_tokens(self):
+        """List length batch_size of lists of tokens (strings): the true answers. None if there are no answers."""
+        if self.ans_span is None:
+            return None
+        return [list(context_tokens[start : end+1]) for context_tokens, (start, end) in zip(self.context_tokens, self.ans_span.tolist())]
+
+
+class BatchBuffers(object):
+    """
+    Preallocated arrays that batches are assembled into, so that (once they have grown
+    to the largest batch shape) making a batch doesn't allocate any arrays.
+
+    There are num_slots sets of arrays, used in turn, one set per batch. So the arrays of
+    a batch are only overwritten num_slots batches later: at most num_slots - 1 batches
+    may still be in use when the next one is made. When batches are prefetched
+    (see prefetch.py) with a queue of depth batches, num_slots must be at least depth + 2.
+    """
+
+    def __init__(self, num_slots=2):
+        self.slots = [{} for _ in xrange(num_slots)]
+        self.slot = None
+        self.num_batches = 0
+
+    def next_batch(self):
+        """Switches to the next set of arrays. Call this before making each batch."""
+        self.slot = self.slots[self.num_batches % len(self.slots)]
+        self.num_batches += 1
+
+    def array(self, name, shape, dtype, fill_value=None):
+        """
+        Returns the (C-contiguous) array called name in the current set, reshaped to shape,
+        and filled with fill_value (if given). Its buffer is grown if it's too small.
+        """
+        size = int(np.prod(shape))
+        buf = self.slot.get(name)
+        if buf is None or buf.size < size:
+            buf = self.slot[name] = np.empty(max(size, 2 * buf.size if buf is not None else 0), dtype=dtype)
+        array = buf[:size].reshape(shape)
+        if fill_value is not None:
+            array.fill(fill_value)
+        return array
+
 
 def split_by_whitespace(sentence):
     words = []
@@ -77,92 +158,377 @@ def sentence_to_token_ids(sentence, word2id):
     e.g. "i do n't know" -> [9, 32, 16, 96]
     Note any token that isn't in the word2id mapping gets mapped to the id for UNK
     """
-    char_ids = []
     tokens = split_by_whitespace(sentence) # list of strings
-    for word in tokens :
-        char_ids.append([ALPHABET.find(char) if char in ALPHABET else CHAR_UNK_ID for char in word])
+    char_ids = [word_char_ids(w) for w in tokens]
     ids = [word2id.get(w, UNK_ID) for w in tokens]
     return tokens, ids, char_ids
 
 
-def padded(token_batch, char_batch, word_len, batch_pad=0):
+def words_to_ids(tokens, word2id):
+    """Returns the word ids of a sequence of tokens (strings) as a numpy int32 array. Tokens not in word2id get UNK_ID."""
+    return np.fromiter((word2id.get(w, UNK_ID) for w in tokens), dtype=np.int32, count=len(tokens))
+
+
+def word_char_ids(word):
+    """
+    Turns a word (str or unicode) into a numpy uint8 array of char ids, one per character (of len(word)).
+    The arrays are memoized (see CHAR_ID_CACHE_SIZE), and must not be modified.
+    """
+    char_ids = char_id_cache.get(word)
+    if char_ids is None:
+        if isinstance(word, str):
+            codes = np.frombuffer(word, dtype=np.uint8)
+        else:
+            codes = np.fromiter((ord(char) for char in word), dtype=np.int64, count=len(word))
+        char_ids = np.where(codes < 256, CHAR_ID_TABLE[np.minimum(codes, 255)], CHAR_UNK_ID).astype(np.uint8)
+        if len(char_id_cache) >= CHAR_ID_CACHE_SIZE:
+            char_id_cache.clear()
+        char_id_cache[word] = char_ids
+    return char_ids
+
+
+def unique_word_char_ids(buffers, name, tokens_batch, lens, word_len):
+    """
+    Finds the unique words in a batch, so that the char-CNN only needs to run once per unique word.
+
+    Inputs:
+      buffers: BatchBuffers to write the arrays into
+      name: string. Prefix for the arrays' names in buffers ("context" or "qn").
+      tokens_batch: List (length batch size) of sequences of tokens (strings).
+      lens: numpy int32 array shape (batch size). Only the first lens[i] tokens of example i are used.
+      word_len: int. Max size of a word.
+
+    Returns:
+      words: numpy uint8 array shape (num_unique_words, word_len) containing char ids.
+        Row 0 is the padding word (all CHAR_PAD_ID).
+      word_idx: numpy int32 array shape (batch_size, max(lens)).
+        word_idx[i, j] is the row of words for the j-th token of example i (0 for padding).
+    """
+    word2idx = {}
+    unique_words = [None] # the padding word
+    word_idx = buffers.array(name + "_word_idx", (len(tokens_batch), lens.max()), np.int32, 0)
+    for i, (tokens, length) in enumerate(zip(tokens_batch, lens.tolist())):
+        row_idx = []
+        for word in tokens[:length]:
+            idx = word2idx.get(word)
+            if idx is None:
+                idx = word2idx[word] = len(unique_words)
+                unique_words.append(word)
+            row_idx.append(idx)
+        word_idx[i, :length] = row_idx
+
+    words = buffers.array(name + "_words", (len(unique_words), word_len), np.uint8, CHAR_PAD_ID)
+    for idx in xrange(1, len(unique_words)):
+        char_ids = word_char_ids(unique_words[idx])[:word_len]
+        words[idx, :len(char_ids)] = char_ids
+    return words, word_idx
+
+
+def pad_ids(buffers, name, ids_batch, lens):
+    """
+    Pads the word ids of a batch to its longest sequence.
+
+    Inputs:
+      buffers: BatchBuffers to write the arrays into
+      name: string. Prefix for the arrays' names in buffers ("context" or "qn").
+      ids_batch: List (length batch size) of int32 arrays of word ids.
+      lens: List (length batch size) of ints. Only the first lens[i] ids of example i are used.
+
+    Returns:
+      ids: numpy int32 array shape (batch_size, max(lens)), padded with PAD_ID
+      lens: numpy int32 array shape (batch_size)
+    """
+    lens_array = buffers.array(name + "_lens", (len(ids_batch),), np.int32)
+    lens_array[:] = lens
+    ids = buffers.array(name + "_ids", (len(ids_batch), lens_array.max()), np.int32, PAD_ID)
+    for i, (row_ids, length) in enumerate(zip(ids_batch, lens)):
+        ids[i, :length] = row_ids[:length]
+    return ids, lens_array
+
+
+def batch_inputs(buffers, name, ids_batch, tokens_batch, lens, word_len):
+    """
+    Assembles the padded model inputs for the contexts (or questions) of a batch.
+
+    Inputs:
+      buffers, name, ids_batch, lens: see pad_ids
+      tokens_batch: List (length batch size) of sequences of tokens (strings), aligned with ids_batch.
+      word_len: int. Each word is truncated or padded (with CHAR_PAD_ID) to this length.
+
+    Returns:
+      ids, char_ids, lens, words, word_idx (see Batch)
+    """
+    ids, lens = pad_ids(buffers, name, ids_batch, lens)
+    words, word_idx = unique_word_char_ids(buffers, name, tokens_batch, lens, word_len)
+
+    # Each token's char ids are its word's row of words (padding tokens get row 0)
+    char_ids = buffers.array(name + "_char_ids", word_idx.shape + (word_len,), np.uint8)
+    np.take(words, word_idx, axis=0, out=char_ids, mode='clip')
+    char_ids = char_ids.reshape(word_idx.shape[0], word_idx.shape[1] * word_len)
+
+    return ids, char_ids, lens, words, word_idx
+
+
+def batch_boundaries(seq_lens, batch_size, max_batch_tokens=0):
     """
+    Splits a list of examples into consecutive batches.
+
     Inputs:
-      token_batch: List (length batch size) of lists of ints.
-      batch_pad: Int. Length to pad to. If 0, pad to maximum length sequence in token_batch.
+      seq_lens: list of ints. The (context) length of each example, in order.
+      batch_size: int. Number of examples per batch, if max_batch_tokens is 0.
+      max_batch_tokens: int. If > 0, each batch instead gets as many examples as fit in
+        max_batch_tokens padded tokens, i.e. num_rows * (longest seq_len in the batch).
+        A single example longer than max_batch_tokens gets a batch to itself.
+
     Returns:
-      List (length batch_size) of padded of lists of ints.
-        All are same length - batch_pad if batch_pad!=0, otherwise the maximum length in token_batch
+      List of (start, end) pairs, one per batch: the batch is examples[start:end]
+    """
+    if max_batch_tokens <= 0:
+        return [(start, min(start + batch_size, len(seq_lens))) for start in xrange(0, len(seq_lens), batch_size)]
+
+    boundaries = []
+    start, longest = 0, 0
+    for end, seq_len in enumerate(seq_lens):
+        longest = max(longest, seq_len)
+        if end > start and (end - start + 1) * longest > max_batch_tokens:
+            boundaries.append((start, end))
+            start, longest = end, seq_len
+    if start < len(seq_lens):
+        boundaries.append((start, len(seq_lens)))
+    return boundaries
+
+
+def build_line_offsets(path, chunk_size=2**24):
+    """
+    Returns a numpy int64 array with the byte offset of the start of each line of the file,
+    followed by the size of the file. Line i is [offsets[i], offsets[i+1]).
+    The file is read chunk_size bytes at a time.
+    """
+    offsets = [np.zeros(1, dtype=np.int64)]
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            # Each newline ends a line, so the next one starts after it
+            offsets.append(np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n")).astype(np.int64) + size + 1)
+            size += len(chunk)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != size: # the last line has no newline
+        offsets = np.append(offsets, size)
+    return offsets
+
+
+def get_line_offsets(path):
+    """
+    Returns the line offsets of a file (see build_line_offsets), from the index saved next to it
+    (path + LINE_OFFSETS_SUFFIX). The index is built the first time, and rebuilt if the file is newer
+    or its size changed.
+    """
+    index_path = path + LINE_OFFSETS_SUFFIX
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+        offsets = np.load(index_path)
+        if offsets[-1] == os.path.getsize(path):
+            return offsets
+
+    print "Indexing the lines of %s..." % path
+    offsets = build_line_offsets(path)
+    try:
+        tmp_path = index_path + ".tmp.npy"
+        np.save(tmp_path, offsets)
+        os.rename(tmp_path, index_path)
+    except (IOError, OSError) as e:
+        print "Could not save the line index: %s" % e
+    return offsets
+
+
+def read_lines(paths, line_idx=None):
+    """
+    Reads parallel files (e.g. the .context, .question and .span files of a dataset) line by line.
+
+    Inputs:
+      paths: list of file paths. The files must have the same number of lines.
+      line_idx: optional iterable of line numbers (ints). If given, only these lines are read,
+        in this order, by seeking to them (see get_line_offsets), so a shuffled or sampled
+        dataset doesn't need to be loaded into memory.
+
+    Yields:
+      Tuples of lines, one from each file.
+    """
+    files = [open(path, 'rb') for path in paths]
+    try:
+        if line_idx is None:
+            for lines in izip(*files):
+                yield lines
+            return
+
+        offsets = [get_line_offsets(path) for path in paths]
+        for i in line_idx:
+            lines = []
+            for f, file_offsets in zip(files, offsets):
+                f.seek(file_offsets[i])
+                lines.append(f.read(file_offsets[i+1] - file_offsets[i]))
+            yield tuple(lines)
+    finally:
+        for f in files:
+            f.close()
+
+
+def count_lines(paths):
+    """Returns the number of lines of parallel files, using their line indexes (see get_line_offsets)"""
+    num_lines = [len(get_line_offsets(path)) - 1 for path in paths]
+    if len(set(num_lines)) != 1:
+        raise Exception("The files %s should have the same number of lines, but they have %s" % (", ".join(paths), ", ".join(map(str, num_lines))))
+    return num_lines[0]
+
+
+def sample_order(num_examples, rng, num_samples=0):
+    """
+    Returns a list of the indices of the examples to read, in random order:
+    a random sample of num_samples examples if num_samples > 0, otherwise a permutation of all of them.
+    """
+    return rng.sample(xrange(num_examples), min(num_samples, num_examples) if num_samples > 0 else num_examples)
+
+
+BUCKET_BY = ["question", "context"]
+
+
+def schedule_batches(context_lens, qn_lens, batch_size, max_batch_tokens=0, bucket_by=None, spread=1, rng=random):
     """
-    maxlen = max(map(lambda x: len(x), token_batch)) if batch_pad == 0 else batch_pad
-    maxcharlen = max(map(lambda x: len(x), char_batch)) if batch_pad == 0 else (batch_pad * word_len)
-    word_pad = map(lambda token_list: token_list + [PAD_ID] * (maxlen - len(token_list)), token_batch)
-    char_pad = map(lambda char_token_list: char_token_list + [CHAR_PAD_ID] * (maxcharlen - len(char_token_list)), char_batch)
-    return (word_pad,char_pad)
+    Groups a pool of examples into batches of examples of similar length, in random order.
 
+    Inputs:
+      context_lens, qn_lens: lists of ints. The (truncated) context and question length of each example.
+      batch_size, max_batch_tokens: see batch_boundaries
+      bucket_by: "question" to sort the examples by question length, or "context" to sort them
+        by (context length, question length). The contexts are the most expensive part of the model
+        to pad, but the questions about a context have the same context length, so they end up together.
+        If None, "context" if max_batch_tokens > 0 (the token budget counts context tokens, so sorting
+        by question length would let a single long context shrink a batch), otherwise "question".
+      spread: int. If > 1, the sorted examples are dealt out round-robin over each group of spread
+        consecutive batches, so up to spread neighbouring examples (e.g. questions about the same context)
+        go into different batches. Each batch then spans spread times more lengths, so it needs more padding.
+      rng: random.Random instance used to shuffle the batches.
+
+    Returns:
+      List of batches, each a list of example indices.
+    """
+    if bucket_by is None:
+        bucket_by = "context" if max_batch_tokens > 0 else "question"
+
+    if bucket_by == "question":
+        # Note: if you sort by context length, then you'll have batches which contain the same context many times (because each context appears several times, with different questions)
+        order = sorted(xrange(len(qn_lens)), key=lambda i: qn_lens[i])
+    elif bucket_by == "context":
+        order = sorted(xrange(len(qn_lens)), key=lambda i: (context_lens[i], qn_lens[i]))
+    else:
+        raise Exception("Unknown bucket_by: %s. Expected one of %s" % (bucket_by, ", ".join(BUCKET_BY)))
+
+    if spread > 1:
+        # Deal out the examples of each group of spread consecutive batches
+        boundaries = batch_boundaries([context_lens[i] for i in order], batch_size, max_batch_tokens)
+        dealt = []
+        for group_start in xrange(0, len(boundaries), spread):
+            window = order[boundaries[group_start][0] : boundaries[min(group_start + spread, len(boundaries)) - 1][1]]
+            dealt.extend(idx for offset in xrange(spread) for idx in window[offset::spread])
+        order = dealt
+
+    boundaries = batch_boundaries([context_lens[i] for i in order], batch_size, max_batch_tokens)
+    rng.shuffle(boundaries)
+    return [order[start:end] for start, end in boundaries]
+
+
+class PaddingStats(object):
+    """
+    Counts the real and padded tokens of the batches (e.g. of an epoch), to measure how well they are bucketed.
+    Also counts the examples whose context is repeated in the same batch (which makes the batch less random).
+    """
 
-def refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size, context_len, question_len, word_len, discard_long):
+    def __init__(self):
+        self.num_batches = 0
+        self.num_examples = 0
+        self.num_repeated_contexts = 0
+        self.context_tokens = 0 # real tokens
+        self.context_padded = 0 # real + padding tokens
+        self.qn_tokens = 0
+        self.qn_padded = 0
+
+    def add(self, batch):
+        self.num_batches += 1
+        self.num_examples += batch.batch_size
+        self.num_repeated_contexts += batch.batch_size - len(set(row[:length].tostring() for row, length in zip(batch.context_ids, batch.context_lens.tolist())))
+        self.context_tokens += int(batch.context_lens.sum())
+        self.context_padded += batch.context_ids.size
+        self.qn_tokens += int(batch.qn_lens.sum())
+        self.qn_padded += batch.qn_ids.size
+
+    def context_efficiency(self):
+        """Real context tokens / padded context tokens"""
+        return self.context_tokens / max(self.context_padded, 1)
+
+    def qn_efficiency(self):
+        return self.qn_tokens / max(self.qn_padded, 1)
+
+    def repeated_context_rate(self):
+        """Fraction of the examples whose context is also in another example of the same batch, not counting the first one"""
+        return self.num_repeated_contexts / max(self.num_examples, 1)
+
+    def __str__(self):
+        return "%i batches, padding efficiency (real tokens / padded tokens): context %.3f, question %.3f, repeated contexts in a batch: %.3f" % (
+            self.num_batches, self.context_efficiency(), self.qn_efficiency(), self.repeated_context_rate())
+
+
+def refill_batches(batches, word2id, lines, batch_size, context_len, question_len, discard_long, max_batch_tokens=0, rng=random, pool_size=160, bucket_by=None, spread=1):
     """
     Adds more batches into the "batches" list.
 
     Inputs:
       batches: list to add batches to
       word2id: dictionary mapping word (string) to word id (int)
-      context_file, qn_file, ans_file: paths to {train/dev}.{context/question/answer} data files
+      lines: iterator of (context, question, answer span) lines, from the {train/dev}.{context/question/answer} data files (see read_lines)
       batch_size: int. how big to make the batches
       context_len, question_len: max length of context and question respectively
       discard_long: If True, discard any examples that are longer than context_len or question_len.
         If False, truncate those exmaples instead.
+      max_batch_tokens: int. If > 0, pack batches up to this many padded context tokens
+        instead of batch_size examples (see batch_boundaries).
+      rng: random.Random instance used to shuffle the batches.
+      pool_size: int. Number of batches to read at a time.
+      bucket_by, spread: how to group the examples into batches (see schedule_batches).
+
+    The batches hold the unpadded examples; they are padded (and the char ids looked up)
+    by get_batch_generator, one batch at a time.
     """
     print "Refilling batches..."
     tic = time.time()
-    examples = [] # list of (qn_ids, context_ids, ans_span, ans_tokens) triples
-    context_line, qn_line, ans_line = context_file.readline(), qn_file.readline(), ans_file.readline() # read the next line from each
+    examples = [] # list of (context_ids, context_tokens, qn_ids, qn_tokens, ans_span) tuples
+    prev_context_line, prev_context = None, None
 
-    while context_line and qn_line and ans_line: # while you haven't reached the end
+    while True:
 
-        # Convert tokens to word ids
-        context_tokens, context_ids, context_char_ids = sentence_to_token_ids(context_line, word2id)
-        qn_tokens, qn_ids, qn_char_ids = sentence_to_token_ids(qn_line, word2id)
+        # read the next line from each file, until you reach the end
+        # (reading only when another example is needed, so no line is lost when we stop refilling)
+        example_lines = next(lines, None)
+        if example_lines is None:
+            break
+        context_line, qn_line, ans_line = example_lines
+
+        # Convert tokens to word ids.
+        # The questions about a context are consecutive (unless the lines are shuffled), so they share its tokens and ids
+        if context_line != prev_context_line:
+            context_tokens = tuple(split_by_whitespace(context_line))
+            prev_context_line, prev_context = context_line, (context_tokens, words_to_ids(context_tokens, word2id))
+        context_tokens, context_ids = prev_context
+        qn_tokens = tuple(split_by_whitespace(qn_line))
+        qn_ids = words_to_ids(qn_tokens, word2id)
         ans_span = intstr_to_intlist(ans_line)
 
-        # read the next line from each file
-        context_line, qn_line, ans_line = context_file.readline(), qn_file.readline(), ans_file.readline()
-
-        # get ans_tokens from ans_span
+        # check the answer span
         assert len(ans_span) == 2
         if ans_span[1] < ans_span[0]:
             print "Found an ill-formed gold span: start=%i end=%i" % (ans_span[0], ans_span[1])
             continue
-        ans_tokens = context_tokens[ans_span[0] : ans_span[1]+1] # list of strings
-
-        # always truncate too long words
-        for context_char_id in context_char_ids :
-            if len(context_char_id) > word_len:
-                context_char_id=context_char_id[:word_len]
-            if len(context_char_id) < word_len :
-                context_char_id.extend([CHAR_PAD_ID] * (word_len - len(context_char_id)))
-        context_char_ids_flat = [item for sublist in context_char_ids for item in sublist]
-        context_char_len = context_len * word_len
-        if len(context_char_ids_flat) > context_char_len:
-            if discard_long:
-                continue
-            else:
-                context_char_ids_flat = context_char_ids_flat[:context_char_len]
-
-        # always truncate too long words
-        for qn_char_id in qn_char_ids :
-            if len(qn_char_id) > word_len:
-                context_char_id=context_char_id[:word_len]
-            if len(qn_char_id) < word_len :
-                qn_char_id.extend([CHAR_PAD_ID] * (word_len - len(qn_char_id)))
-        question_char_len = question_len * word_len
-        qn_char_ids_flat = [item for sublist in qn_char_ids for item in sublist]
-        if len(qn_char_ids_flat) > question_char_len:
-            if discard_long:
-                continue
-            else:
-                qn_char_ids_flat = qn_char_ids_flat[:question_char_len]
 
         # discard or truncate too-long questions
         if len(qn_ids) > question_len:
@@ -179,35 +545,23 @@ def refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size
                 context_ids = context_ids[:context_len]
 
         # add to examples
-        examples.append((context_ids, context_tokens, qn_ids, qn_tokens, context_char_ids_flat, qn_char_ids_flat, ans_span, ans_tokens))
+        examples.append((context_ids, context_tokens, qn_ids, qn_tokens, ans_span))
 
-        # stop refilling if you have 160 batches
-        if len(examples) == batch_size * 160:
+        # stop refilling if you have pool_size batches
+        if len(examples) == batch_size * pool_size:
             break
 
-    # Once you've either got 160 batches or you've reached end of file:
-
-    # Sort by question length
-    # Note: if you sort by context length, then you'll have batches which contain the same context many times (because each context appears several times, with different questions)
-    examples = sorted(examples, key=lambda e: len(e[2]))
-
-    # Make into batches and append to the list batches
-    for batch_start in xrange(0, len(examples), batch_size):
-
-        # Note: each of these is a list length batch_size of lists of ints (except on last iter when it might be less than batch_size)
-        context_ids_batch, context_tokens_batch, qn_ids_batch, qn_tokens_batch, context_char_ids_batch, qn_char_ids_batch, ans_span_batch, ans_tokens_batch = zip(*examples[batch_start:batch_start+batch_size])
-
-        batches.append((context_ids_batch, context_tokens_batch, qn_ids_batch, qn_tokens_batch, context_char_ids_batch, qn_char_ids_batch, ans_span_batch, ans_tokens_batch))
-
-    # shuffle the batches
-    random.shuffle(batches)
+    # Once you've either got pool_size batches or you've reached end of file:
+    # bucket the examples by length, make them into batches, shuffle the batches and append them to the list batches
+    for batch_idx in schedule_batches([len(e[0]) for e in examples], [len(e[2]) for e in examples], batch_size, max_batch_tokens, bucket_by, spread, rng):
+        batches.append([examples[idx] for idx in batch_idx])
 
     toc = time.time()
     print "Refilling batches took %.2f seconds" % (toc-tic)
     return
 
 
-def get_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, word_len, discard_long):
+def get_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, word_len, discard_long, max_batch_tokens=0, seed=None, num_buffers=2, pool_size=160, bucket_by=None, spread=1, shuffle=False, num_samples=0):
     """
     This function returns a generator object that yields batches.
     The last batch in the dataset will be a partial batch.
@@ -220,38 +574,46 @@ def get_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, co
       context_len, question_len: max length of context and question respectively
       discard_long: If True, discard any examples that are longer than context_len or question_len.
         If False, truncate those exmaples instead.
+      max_batch_tokens: int. If > 0, pack batches up to this many padded context tokens
+        (number of examples * longest context in the batch) instead of batch_size examples.
+      seed: optional int. If given, the order of the batches is reproducible.
+      num_buffers: int. The batches' arrays are reused after this many batches (see BatchBuffers).
+      pool_size, bucket_by, spread: see refill_batches
+      shuffle: bool. If True, the examples are read in a random order (a permutation of the whole dataset),
+        instead of in file order. Otherwise only the batches of each pool are shuffled.
+      num_samples: int. If > 0, only a random sample of this many examples is read.
+        Shuffled and sampled examples are read by seeking to their lines (see get_line_offsets).
     """
-    context_file, qn_file, ans_file = open(context_path), open(qn_path), open(ans_path)
+    rng = random.Random(seed)
+    paths = [context_path, qn_path, ans_path]
+    line_idx = sample_order(count_lines(paths), rng, num_samples) if (shuffle or num_samples > 0) else None
+    lines = read_lines(paths, line_idx)
     batches = []
+    buffers = BatchBuffers(num_buffers)
 
     while True:
         if len(batches) == 0: # add more batches
-            refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size, context_len, question_len, word_len, discard_long)
+            refill_batches(batches, word2id, lines, batch_size, context_len, question_len, discard_long, max_batch_tokens, rng, pool_size, bucket_by, spread)
         if len(batches) == 0:
             break
 
         # Get next batch. These are all lists length batch_size
-        (context_ids, context_tokens, qn_ids, qn_tokens, context_char_ids, qn_char_ids, ans_span, ans_tokens) = batches.pop(0)
-
-        # Pad context_ids and qn_ids
-        qn_ids, qn_char_ids = padded(qn_ids, qn_char_ids, word_len, question_len) # pad questions to length question_len
-        context_ids, context_char_ids = padded(context_ids, context_char_ids, word_len, context_len) # pad contexts to length context_len
-
-        # Make qn_ids into a np array and create qn_mask
-        qn_ids = np.array(qn_ids) # shape (question_len, batch_size)
-        qn_char_ids = np.array(qn_char_ids) # shape (question_len * word_len, batch_size)
-        qn_mask = (qn_ids != PAD_ID).astype(np.int32) # shape (question_len, batch_size)
+        context_ids, context_tokens, qn_ids, qn_tokens, ans_span = zip(*batches.pop(0))
+        buffers.next_batch()
 
-        # Make context_ids into a np array and create context_mask
-        context_ids = np.array(context_ids) # shape (context_len, batch_size)
-        context_char_ids = np.array(context_char_ids)
-        context_mask = (context_ids != PAD_ID).astype(np.int32) # shape (context_len, batch_size)
+        # Pad context_ids and qn_ids to the length of the longest context and question in this batch
+        # (the graph accepts any sequence length up to context_len and question_len),
+        # and get the char ids and the unique words of the batch, for the (deduplicated) char-CNN
+        qn_ids, qn_char_ids, qn_lens, qn_words, qn_word_idx = batch_inputs(buffers, "qn", qn_ids, qn_tokens, map(len, qn_ids), word_len)
+        context_ids, context_char_ids, context_lens, context_words, context_word_idx = batch_inputs(buffers, "context", context_ids, context_tokens, map(len, context_ids), word_len)
 
         # Make ans_span into a np array
-        ans_span = np.array(ans_span) # shape (batch_size, 2)
+        ans_span_array = buffers.array("ans_span", (len(ans_span), 2), np.int32) # shape (batch_size, 2)
+        ans_span_array[:] = ans_span
 
         # Make into a Batch object
-        batch = Batch(context_ids, context_char_ids, context_mask, context_tokens, qn_ids, qn_char_ids, qn_mask, qn_tokens, ans_span, ans_tokens)
+        batch = Batch(context_ids, context_char_ids, context_lens, list(context_tokens), qn_ids, qn_char_ids, qn_lens, list(qn_tokens), ans_span_array,
+                      context_words=context_words, context_word_idx=context_word_idx, qn_words=qn_words, qn_word_idx=qn_word_idx)
 
         yield batch
 
@@ -0,0 +1,338 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains code to compile the tokenized {train,dev}.{context,question,span}
+files into binary shards (see compile_shards), and to make batches straight from them.
+
+A compiled dataset is a directory with a meta.json file and one subdirectory per shard.
+Each shard holds NumPy arrays, which are memory-mapped when read:
+  {context/qn}_ids: int32, the word ids of all the examples, concatenated
+  {context/qn}_offsets: int64 shape (num_examples + 1). Example i is ids[offsets[i]:offsets[i+1]]
+  {context/qn}_word_idx: int32 shape (num_tokens). The row of words.npy (see below) for each token
+  {context/qn}_text: uint8, the tokens (strings) concatenated
+  {context/qn}_text_offsets: int64 shape (num_tokens + 1). Token j is text[text_offsets[j]:text_offsets[j+1]]
+  ans_span: int32 shape (num_examples, 2)
+The dataset directory also has words.npy, uint8 shape (num_unique_words + 1, word_len): the char ids
+of each distinct token of the dataset, padded with CHAR_PAD_ID. Row 0 is the padding word.
+So the char ids are stored once per distinct word, and a batch's unique words (for --dedup_char_words)
+are found from the indices, without decoding the tokens.
+The word ids depend on the vocabulary, so meta.json records a signature of it."""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import json
+import time
+import random
+import hashlib
+from itertools import izip
+
+import numpy as np
+from six.moves import xrange
+
+from vocab import CHAR_PAD_ID
+from data_batcher import Batch, BatchBuffers, split_by_whitespace, words_to_ids, word_char_ids, intstr_to_intlist, sample_order, schedule_batches, pad_ids
+
+SHARD_ARRAYS = ["context_ids", "context_offsets", "context_word_idx", "context_text", "context_text_offsets",
+                "qn_ids", "qn_offsets", "qn_word_idx", "qn_text", "qn_text_offsets", "ans_span"]
+
+# Bumped when the arrays change, so that older compiled data is rejected
+SHARD_FORMAT = 2
+
+
+def vocab_signature(id2word):
+    """Returns a hash (string) of the vocabulary, i.e. of the words in id order"""
+    sha = hashlib.sha1()
+    for word in id2word:
+        sha.update(word.encode('utf-8') if isinstance(word, unicode) else word)
+        sha.update(b"\n")
+    return sha.hexdigest()
+
+
+class ShardWriter(object):
+    """Accumulates tokenized examples, and writes them as a shard"""
+
+    def __init__(self):
+        self.num_examples = 0
+        self.ans_span = []
+        self.parts = {"context": self.new_part(), "qn": self.new_part()}
+
+    @staticmethod
+    def new_part():
+        return {"ids": [], "lens": [], "word_idx": [], "text": []}
+
+    def add(self, context_tokens, context_ids, context_word_idx, qn_tokens, qn_ids, qn_word_idx, ans_span):
+        for name, tokens, ids, word_idx in [("context", context_tokens, context_ids, context_word_idx), ("qn", qn_tokens, qn_ids, qn_word_idx)]:
+            part = self.parts[name]
+            part["ids"].extend(ids)
+            part["lens"].append(len(ids))
+            part["word_idx"].extend(word_idx)
+            part["text"].extend(tokens)
+        self.ans_span.append(ans_span)
+        self.num_examples += 1
+
+    def write(self, shard_dir):
+        """Writes the arrays (see SHARD_ARRAYS) to shard_dir"""
+        os.makedirs(shard_dir)
+        arrays = {"ans_span": np.array(self.ans_span, dtype=np.int32).reshape(-1, 2)}
+        for name, part in self.parts.items():
+            arrays[name + "_ids"] = np.array(part["ids"], dtype=np.int32)
+            arrays[name + "_offsets"] = np.concatenate([[0], np.cumsum(part["lens"], dtype=np.int64)])
+            arrays[name + "_word_idx"] = np.array(part["word_idx"], dtype=np.int32)
+            arrays[name + "_text"] = np.frombuffer(b"".join(part["text"]), dtype=np.uint8)
+            arrays[name + "_text_offsets"] = np.concatenate([[0], np.cumsum([len(token) for token in part["text"]], dtype=np.int64)])
+        for name in SHARD_ARRAYS:
+            np.save(os.path.join(shard_dir, name + ".npy"), arrays[name])
+
+
+def compile_shards(context_path, qn_path, ans_path, out_dir, word2id, vocab_sig, word_len, shard_size=50000):
+    """
+    Compiles the {train/dev}.{context/question/span} files into shards in out_dir.
+    Only shard_size examples (and the distinct words) are held in memory at a time.
+
+    Inputs:
+      context_path, qn_path, ans_path: paths to the data files
+      out_dir: directory to write to. Must not exist yet.
+      word2id: dictionary mapping word (string) to word id (int)
+      vocab_sig: string. The vocab_signature of the vocabulary word2id comes from.
+      word_len: int. The words' char ids are truncated to this length.
+        Batches can then be made with any word_len up to this one.
+      shard_size: int. Number of examples per shard.
+
+    Returns:
+      num_examples: int
+    """
+    if os.path.exists(out_dir):
+        raise Exception("%s already exists" % out_dir)
+    tmp_dir = out_dir + ".tmp"
+    os.makedirs(tmp_dir)
+
+    print "Compiling %s, %s and %s to %s..." % (context_path, qn_path, ans_path, out_dir)
+    tic = time.time()
+    num_examples, num_shards = 0, 0
+    writer = ShardWriter()
+    word2idx = {} # maps each distinct token to its row of words.npy
+    unique_words = [None] # the padding word
+
+    def tokens_to_word_idx(tokens):
+        word_idx = []
+        for word in tokens:
+            idx = word2idx.get(word)
+            if idx is None:
+                idx = word2idx[word] = len(unique_words)
+                unique_words.append(word)
+            word_idx.append(idx)
+        return word_idx
+
+    with open(context_path) as context_file, open(qn_path) as qn_file, open(ans_path) as ans_file:
+        for context_line, qn_line, ans_line in izip(context_file, qn_file, ans_file):
+            context_tokens = split_by_whitespace(context_line)
+            qn_tokens = split_by_whitespace(qn_line)
+            ans_span = intstr_to_intlist(ans_line)
+
+            # Ill-formed gold spans are skipped, as in data_batcher.refill_batches
+            assert len(ans_span) == 2
+            if ans_span[1] < ans_span[0]:
+                print "Found an ill-formed gold span: start=%i end=%i" % (ans_span[0], ans_span[1])
+                continue
+
+            writer.add(context_tokens, words_to_ids(context_tokens, word2id), tokens_to_word_idx(context_tokens),
+                       qn_tokens, words_to_ids(qn_tokens, word2id), tokens_to_word_idx(qn_tokens), ans_span)
+            num_examples += 1
+            if writer.num_examples == shard_size:
+                writer.write(os.path.join(tmp_dir, "%05i" % num_shards))
+                num_shards += 1
+                writer = ShardWriter()
+
+    if writer.num_examples > 0:
+        writer.write(os.path.join(tmp_dir, "%05i" % num_shards))
+        num_shards += 1
+
+    words = np.full((len(unique_words), word_len), CHAR_PAD_ID, dtype=np.uint8)
+    for idx in xrange(1, len(unique_words)):
+        char_ids = word_char_ids(unique_words[idx])[:word_len]
+        words[idx, :len(char_ids)] = char_ids
+    np.save(os.path.join(tmp_dir, "words.npy"), words)
+
+    with open(os.path.join(tmp_dir, "meta.json"), 'w') as f:
+        json.dump({"num_examples": num_examples, "num_shards": num_shards, "word_len": word_len, "num_words": len(unique_words) - 1,
+                   "vocab_size": len(word2id), "vocab_signature": vocab_sig, "format": SHARD_FORMAT}, f)
+    os.rename(tmp_dir, out_dir)
+
+    print "Compiled %i examples into %i shards in %.2f seconds" % (num_examples, num_shards, time.time() - tic)
+    return num_examples
+
+
+class Shard(object):
+    """The memory-mapped arrays of a shard (see SHARD_ARRAYS)"""
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        for name in SHARD_ARRAYS:
+            setattr(self, name, np.load(os.path.join(shard_dir, name + ".npy"), mmap_mode='r'))
+        self.num_examples = len(self.ans_span)
+
+    def __reduce__(self):
+        # Batches hold shards (see ShardTokens). When they are pickled (e.g. by a prefetch
+        # process), only the path is sent, and the shard is memory-mapped again on the other side.
+        return open_shard, (self.shard_dir,)
+
+    def get_tokens(self, part, i):
+        """Returns the tokens (tuple of strings) of the context (part="context") or question (part="qn") of example i"""
+        offsets = getattr(self, part + "_offsets")
+        text_offsets = getattr(self, part + "_text_offsets")[offsets[i]:offsets[i+1] + 1].tolist()
+        # Slice the example's text out of the memory map once, then split it into tokens
+        text = getattr(self, part + "_text")[text_offsets[0]:text_offsets[-1]].tostring()
+        start = text_offsets[0]
+        return tuple(text[text_offsets[j] - start:text_offsets[j+1] - start] for j in xrange(len(text_offsets) - 1))
+
+
+opened_shards = {} # shard_dir -> Shard, for the shards unpickled in this process
+
+def open_shard(shard_dir):
+    shard = opened_shards.get(shard_dir)
+    if shard is None:
+        shard = opened_shards[shard_dir] = Shard(shard_dir)
+    return shard
+
+
+class ShardTokens(object):
+    """
+    The tokens of the contexts (or questions) of a batch, as a sequence of tuples of strings.
+    Each example's tokens are only decoded from its shard when they are accessed
+    (e.g. by check_f1_em), so training doesn't spend any time on them.
+    """
+
+    def __init__(self, part, examples):
+        self.part = part
+        self.examples = [(example[0], example[1]) for example in examples]
+
+    def __len__(self):
+        return len(self.examples)
+
+    def __getitem__(self, row):
+        shard, i = self.examples[row]
+        return shard.get_tokens(self.part, i)
+
+    def __iter__(self):
+        for row in xrange(len(self.examples)):
+            yield self[row]
+
+
+def load_shards(shards_dir, vocab_sig, word_len):
+    """
+    Opens the shards compiled in shards_dir, checking that they were made with the same
+    vocabulary and a large enough word_len.
+
+    Returns:
+      shards: list of Shard objects
+      words: memory-mapped words.npy (see the top of this file)
+    """
+    with open(os.path.join(shards_dir, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("format") != SHARD_FORMAT:
+        raise Exception("The data in %s was compiled with an older version of this code. Run compile_data mode again" % shards_dir)
+    if meta["vocab_signature"] != vocab_sig:
+        raise Exception("The data in %s was compiled with a different vocabulary. Run compile_data mode again" % shards_dir)
+    if meta["word_len"] < word_len:
+        raise Exception("The data in %s was compiled with --word_len=%i, but --word_len=%i" % (shards_dir, meta["word_len"], word_len))
+    words = np.load(os.path.join(shards_dir, "words.npy"), mmap_mode='r')
+    return [Shard(os.path.join(shards_dir, "%05i" % idx)) for idx in xrange(meta["num_shards"])], words
+
+
+def make_batch(buffers, examples, words_table, word_len, dedup_char_words):
+    """
+    Makes a Batch from a list of examples, each a (shard, example index, context length, question length) tuple,
+    with the (possibly truncated) lengths. The arrays are filled in directly from the shards, into buffers (a BatchBuffers).
+    Only the char inputs the model feeds are made: {context/qn}_words and _word_idx if dedup_char_words,
+    otherwise {context/qn}_char_ids (the others are None). The tokens are decoded lazily (see ShardTokens).
+    """
+    buffers.next_batch()
+    batch_size = len(examples)
+    inputs = {}
+    for part, len_idx in [("context", 2), ("qn", 3)]:
+        # The shard, start and (truncated) length of each example's tokens
+        spans = [(example[0], getattr(example[0], part + "_offsets")[example[1]], example[len_idx]) for example in examples]
+        ids, lens = pad_ids(buffers, part, [getattr(shard, part + "_ids")[start:start + length] for shard, start, length in spans], [length for _, _, length in spans])
+        seq_len = ids.shape[1]
+
+        # The row of words_table for each token (0 for padding)
+        token_words = buffers.array(part + "_token_words", (batch_size, seq_len), np.int32, 0)
+        for row, (shard, start, length) in enumerate(spans):
+            token_words[row, :length] = getattr(shard, part + "_word_idx")[start:start + length]
+
+        char_ids, words, word_idx = None, None, None
+        if dedup_char_words:
+            # The unique words of the batch, for the deduplicated char-CNN. Row 0 must be the padding word.
+            unique, inverse = np.unique(token_words, return_inverse=True)
+            if unique[0] != 0:
+                unique, inverse = np.concatenate([[0], unique]), inverse + 1
+            words = buffers.array(part + "_words", (len(unique), word_len), np.uint8)
+            words[:] = words_table[unique, :word_len]
+            word_idx = buffers.array(part + "_word_idx", (batch_size, seq_len), np.int32)
+            word_idx[:] = inverse.reshape(batch_size, seq_len)
+        else:
+            char_ids = buffers.array(part + "_char_ids", (batch_size, seq_len, word_len), np.uint8)
+            char_ids[:] = words_table[token_words, :word_len]
+            char_ids = char_ids.reshape(batch_size, seq_len * word_len)
+        inputs[part] = (ids, char_ids, lens, ShardTokens(part, examples), words, word_idx)
+
+    ans_span = buffers.array("ans_span", (batch_size, 2), np.int32)
+    for row, (shard, i, _, _) in enumerate(examples):
+        ans_span[row] = shard.ans_span[i]
+
+    context_ids, context_char_ids, context_lens, context_tokens, context_words, context_word_idx = inputs["context"]
+    qn_ids, qn_char_ids, qn_lens, qn_tokens, qn_words, qn_word_idx = inputs["qn"]
+    return Batch(context_ids, context_char_ids, context_lens, context_tokens, qn_ids, qn_char_ids, qn_lens, qn_tokens, ans_span,
+                 context_words=context_words, context_word_idx=context_word_idx, qn_words=qn_words, qn_word_idx=qn_word_idx)
+
+
+def get_batch_generator(shards_dir, vocab_sig, batch_size, context_len, question_len, word_len, discard_long, max_batch_tokens=0, seed=None, num_buffers=2, pool_size=160, bucket_by=None, spread=1, shuffle=False, num_samples=0, dedup_char_words=False):
+    """
+    Like data_batcher.get_batch_generator, but reads the examples from compiled shards.
+    The batches are the same: examples are read in order (or in the same shuffled or sampled order), batch_size * pool_size at a time,
+    bucketed by length, split into batches and shuffled (see data_batcher.schedule_batches).
+
+    Inputs:
+      shards_dir: directory written by compile_shards
+      vocab_sig: string. The vocab_signature of the model's vocabulary.
+      dedup_char_words: bool. Whether to make the char inputs for --dedup_char_words (see make_batch).
+      the other inputs: see data_batcher.get_batch_generator
+    """
+    shards, words_table = load_shards(shards_dir, vocab_sig, word_len)
+    rng = random.Random(seed)
+    buffers = BatchBuffers(num_buffers)
+
+    def iter_examples():
+        """Yields (shard, example index, context length, question length), after discarding or truncating long examples"""
+        lens = [(np.diff(shard.context_offsets).tolist(), np.diff(shard.qn_offsets).tolist()) for shard in shards]
+        locations = [(shard_idx, i) for shard_idx, shard in enumerate(shards) for i in xrange(shard.num_examples)]
+        if shuffle or num_samples > 0:
+            # The shards are memory-mapped, so reading the examples in any order is cheap
+            locations = [locations[idx] for idx in sample_order(len(locations), rng, num_samples)]
+        for shard_idx, i in locations:
+            context_length, qn_length = lens[shard_idx][0][i], lens[shard_idx][1][i]
+            if discard_long and (context_length > context_len or qn_length > question_len):
+                continue
+            yield shards[shard_idx], i, min(context_length, context_len), min(qn_length, question_len)
+
+    examples = iter_examples()
+    while True:
+        pool = [example for _, example in zip(xrange(batch_size * pool_size), examples)]
+        if not pool:
+            break
+
+        for batch_idx in schedule_batches([e[2] for e in pool], [e[3] for e in pool], batch_size, max_batch_tokens, bucket_by, spread, rng):
+            yield make_batch(buffers, [pool[idx] for idx in batch_idx], words_table, word_len, dedup_char_words)
@@ -21,13 +21,23 @@ import os
 import io
 import json
 import sys
+import time
+import hashlib
 import logging
+import multiprocessing
 
 import tensorflow as tf
 
-from qa_model import QAModel
-from vocab import get_glove
-from official_eval_helper import get_json_data, generate_answers
+from qa_model import QAModel, FrozenQAModel
+from data_shards import compile_shards, vocab_signature
+from vocab import get_glove, load_glove, get_vocab_mappings, get_pruned_vocab, prune_vocab, save_pruned_vocab
+from evaluate import evaluate
+from preprocessing.squad_preprocess import data_from_json
+from quantization import dequantize_int8
+from server import serve
+from prediction_cache import PredictionCache
+from data_batcher import split_by_whitespace, BUCKET_BY
+from official_eval_helper import get_json_data, get_json_paragraphs, pool_paragraphs, tokenize_paragraphs, tokenize_context, tokens_to_ids, predict_answers, collect_answers, generate_answers, predict_answers_with_cache, stream_answers
 
 
 logging.basicConfig(level=logging.INFO)
@@ -39,7 +49,7 @@ EXPERIMENTS_DIR = os.path.join(MAIN_DIR, "experiments") # relative path of exper
 
 # High-level options
 tf.app.flags.DEFINE_integer("gpu", 0, "Which GPU to use, if you have multiple.")
-tf.app.flags.DEFINE_string("mode", "train", "Available modes: train / show_examples / official_eval")
+tf.app.flags.DEFINE_string("mode", "train", "Available modes: train / show_examples / official_eval / stream_eval / serve / export_graph / export_slim_checkpoint / quantization_report / prune_vocab / compile_data")
 tf.app.flags.DEFINE_string("experiment_name", "", "Unique name for your experiment. This will create a directory by this name in the experiments/ directory, which will hold all data related to this experiment")
 tf.app.flags.DEFINE_integer("num_epochs", 0, "Number of epochs to train. 0 means train indefinitely")
 
@@ -48,12 +58,25 @@ tf.app.flags.DEFINE_float("learning_rate", 0.001, "Learning rate.")
 tf.app.flags.DEFINE_float("max_gradient_norm", 5.0, "Clip gradients to this norm.")
 tf.app.flags.DEFINE_float("dropout", 0.15, "Fraction of units randomly dropped on non-recurrent connections.")
 tf.app.flags.DEFINE_integer("batch_size", 100, "Batch size to use")
+tf.app.flags.DEFINE_integer("max_batch_tokens", 0, "If > 0, make batches with as many examples as fit in this many padded context tokens (number of examples * longest context in the batch), instead of batch_size examples")
+tf.app.flags.DEFINE_integer("batch_pool_size", 160, "Number of batches' worth of examples that are read, bucketed by length and shuffled at a time. Larger pools need less padding, but the order is less random. The inference modes read whole paragraphs until they have this many batches' worth of questions, and sort them by length")
+tf.app.flags.DEFINE_string("bucket_by", "", "How to bucket the examples of a pool into batches: question (by question length) / context (by context length, then question length; less padding, but questions about the same context end up together, see --bucket_spread). If empty, context with --max_batch_tokens (whose budget counts context tokens), otherwise question")
+tf.app.flags.DEFINE_integer("bucket_spread", 1, "If > 1, deal the bucketed examples out over this many consecutive batches, so that up to this many questions about the same context go into different batches, at the cost of more padding. The padding efficiency is logged at the end of each epoch")
+tf.app.flags.DEFINE_bool("shuffle_examples", False, "Shuffle the training examples over the whole dataset each epoch (reading them by seeking to their lines, with an index saved next to the data files), instead of only shuffling the batches of each pool")
+tf.app.flags.DEFINE_integer("prefetch_batches", 0, "If > 0, make up to this many batches ahead in a background worker, overlapping with the training / evaluation steps. 0 means make each batch when it's needed")
+tf.app.flags.DEFINE_bool("prefetch_process", False, "With --prefetch_batches > 0, make the batches in a worker process instead of a thread, so they don't compete with the main loop for the GIL")
+tf.app.flags.DEFINE_integer("seed", None, "Random seed for the order of the batches. If not set, the order is not reproducible")
 tf.app.flags.DEFINE_integer("hidden_size", 200, "Size of the hidden states")
 tf.app.flags.DEFINE_integer("context_len", 600, "The maximum context length of your model")
 tf.app.flags.DEFINE_integer("question_len", 30, "The maximum question length of your model")
 tf.app.flags.DEFINE_integer("embedding_size", 100, "Size of the pretrained word vectors. This needs to be one of the available GloVe dimensions: 50/100/200/300")
 tf.app.flags.DEFINE_integer("word_len", 16, "Maximum word size in vocab")
 tf.app.flags.DEFINE_integer("char_embedding_size", 20, "Embedding size of char matrix")
+tf.app.flags.DEFINE_bool("dedup_char_words", False, "Run the char-CNN once per unique word in the batch (and gather the results back) instead of once per token slot, including padding")
+tf.app.flags.DEFINE_bool("cache_context_encodings", False, "At inference time (show_examples / official_eval), run the context encoder once per unique context and reuse it for all of that context's questions")
+tf.app.flags.DEFINE_integer("window_len", 0, "For official_eval mode. If > 0, contexts longer than window_len are split into overlapping windows of window_len tokens (instead of being truncated to context_len), and the best span over all windows is returned. Must be at most context_len")
+tf.app.flags.DEFINE_integer("window_stride", 128, "For official_eval mode with --window_len > 0. Number of tokens between the starts of consecutive windows. Must be at most window_len")
+tf.app.flags.DEFINE_integer("max_answer_len", 0, "Maximum length (in tokens) of a predicted answer span. 0 means no limit")
 
 # How often to print, save, eval
 tf.app.flags.DEFINE_integer("print_every", 1, "How many iterations to do per print.")
@@ -66,14 +89,59 @@ tf.app.flags.DEFINE_string("train_dir", "", "Training directory to save the mode
 tf.app.flags.DEFINE_string("glove_path", "", "Path to glove .txt file. Defaults to data/glove.6B.{embedding_size}d.txt")
 tf.app.flags.DEFINE_string("data_dir", DEFAULT_DATA_DIR, "Where to find preprocessed SQuAD data for training. Defaults to data/")
 tf.app.flags.DEFINE_string("ckpt_load_dir", "", "For official_eval mode, which directory to load the checkpoint fron. You need to specify this for official_eval mode.")
-tf.app.flags.DEFINE_string("json_in_path", "", "For official_eval mode, path to JSON input file. You need to specify this for official_eval_mode.")
-tf.app.flags.DEFINE_string("json_out_path", "predictions.json", "Output path for official_eval mode. Defaults to predictions.json")
+tf.app.flags.DEFINE_string("frozen_graph_path", "", "For export_graph mode, where to write the frozen inference graph (made from --ckpt_load_dir). For official_eval / stream_eval / serve modes, if set, load the model from this frozen graph instead of --ckpt_load_dir")
+tf.app.flags.DEFINE_string("slim_ckpt_dir", "", "For export_slim_checkpoint mode, the directory to write the weights-only checkpoint (made from --ckpt_load_dir) to")
+tf.app.flags.DEFINE_bool("slim_float16", False, "For export_slim_checkpoint mode, store the weights as float16")
+tf.app.flags.DEFINE_bool("slim_int8", False, "For export_slim_checkpoint mode, store the kernels as int8 with per-unit scales (the other weights are stored as float32, or float16 with --slim_float16). They are dequantized when restored")
+tf.app.flags.DEFINE_string("shards_dir", "", "Directory for the train and dev data compiled to binary shards by compile_data mode. If set, train and show_examples modes read their batches from it instead of the text files in data_dir")
+tf.app.flags.DEFINE_string("prune_vocab_corpora", "", "For prune_vocab mode, comma-separated paths of extra tokenized text files (one sequence per line) whose words to keep, besides the train/dev contexts and questions in data_dir")
+tf.app.flags.DEFINE_bool("use_pruned_vocab", False, "For the inference modes (official_eval / stream_eval / serve / export_graph / quantization_report), use the vocabulary written by prune_vocab mode instead of the full GloVe vocabulary. Words of the input that are in GloVe but not in the pruned vocabulary then map to UNK, which changes predictions on new data (see --input_vocab for a small per-run vocabulary instead). train, show_examples and compile_data modes always use it if it exists")
+tf.app.flags.DEFINE_bool("save_embeddings", False, "Include the (non-trainable) embedding matrix in the checkpoints, and restore it from them. By default it's set from --glove_path in every run")
+tf.app.flags.DEFINE_bool("export_embeddings", True, "For export_graph mode, include the embedding matrix in the frozen graph. If False, it's set from --glove_path when the graph is loaded, which must give the same vocabulary")
+tf.app.flags.DEFINE_bool("quantize_embeddings", False, "Not for train mode. Store the GloVe embedding matrix in the graph as int8 with one scale per row (4x less memory)")
+tf.app.flags.DEFINE_string("json_in_path", "", "For official_eval mode, path to JSON input file. You need to specify this for official_eval_mode. For stream_eval mode, path to a JSONL file (or a SQuAD JSON file)")
+tf.app.flags.DEFINE_string("json_out_path", "predictions.json", "Output path for official_eval mode. Defaults to predictions.json. For stream_eval mode, answers are written to this path one JSON object per line")
+tf.app.flags.DEFINE_bool("input_vocab", False, "For official_eval mode, read the input first and build the embedding matrix from only the words in it, so memory scales with the input instead of the GloVe vocabulary. Not for use with --frozen_graph_path or --prediction_cache_path")
+tf.app.flags.DEFINE_integer("num_workers", 1, "For official_eval mode. If > 1, split the questions across this many worker processes, each with its own copy of the model. The input is split into the same pools of --batch_pool_size batches' worth of questions as one process reads it in, and each worker tokenizes, batches and predicts whole pools. So the batches, and the answers (and n-best lists), are identical to one process. An input smaller than two pools only uses one worker: lower --batch_pool_size to split it further")
+tf.app.flags.DEFINE_integer("n_best_size", 0, "If > 0, official_eval mode also writes the n_best_size most likely answers per question (with probabilities) to --nbest_json_out_path, and show_examples mode prints them")
+tf.app.flags.DEFINE_string("host", "localhost", "For serve mode, the address to listen on")
+tf.app.flags.DEFINE_integer("port", 8000, "For serve mode, the port to listen on")
+tf.app.flags.DEFINE_float("max_wait_ms", 10.0, "For serve mode, the maximum time (milliseconds) a request waits for other requests to join its micro-batch. Micro-batches have at most batch_size requests")
+tf.app.flags.DEFINE_integer("prediction_cache_size", 0, "For official_eval / stream_eval / serve modes. If > 0, cache up to this many tokenized contexts and this many answers (keyed on context and question), so repeated contexts and questions aren't recomputed")
+tf.app.flags.DEFINE_float("prediction_cache_mb", 0, "If > 0, also limit each level of the prediction cache to roughly this many megabytes (this alone also enables the cache)")
+tf.app.flags.DEFINE_string("prediction_cache_path", "", "If set, the prediction cache is loaded from this file (if it exists, and was made with the same checkpoint and settings) and saved to it at the end")
+tf.app.flags.DEFINE_string("nbest_json_out_path", "nbest_predictions.json", "Output path for the n-best answers in official_eval mode. Only used if --n_best_size > 0. Defaults to nbest_predictions.json")
 
 
 FLAGS = tf.app.flags.FLAGS
 os.environ["CUDA_VISIBLE_DEVICES"] = str(FLAGS.gpu)
 
 
+def is_slim_checkpoint(ckpt_path):
+    """Returns True if the checkpoint only has the weights (see QAModel.export_slim_checkpoint): training checkpoints also have global_step"""
+    return not tf.train.NewCheckpointReader(ckpt_path).has_tensor("global_step")
+
+
+def has_compressed_weights(ckpt_path):
+    """Returns True if the checkpoint stores float16 or int8 weights (see QAModel.export_slim_checkpoint)"""
+    reader = tf.train.NewCheckpointReader(ckpt_path)
+    dtypes = set(reader.get_variable_to_dtype_map().values())
+    return tf.float16 in dtypes or tf.int8 in dtypes
+
+
+def restore_compressed_weights(session, ckpt_path):
+    """Restores the (float32) variables of the default graph from a checkpoint with float16 or int8 weights"""
+    reader = tf.train.NewCheckpointReader(ckpt_path)
+    dtypes = reader.get_variable_to_dtype_map()
+    for var in tf.global_variables():
+        if not reader.has_tensor(var.op.name):
+            raise Exception("Variable %s is missing from %s" % (var.op.name, ckpt_path))
+        value = reader.get_tensor(var.op.name)
+        if dtypes[var.op.name] == tf.int8:
+            value = dequantize_int8(value, reader.get_tensor(var.op.name + "_int8_scale"))
+        var.load(value.astype(var.dtype.base_dtype.as_numpy_dtype), session)
+
+
 def initialize_model(session, model, train_dir, expect_exists):
     """
     Initializes model from train_dir.
@@ -85,21 +153,211 @@ def initialize_model(session, model, train_dir, expect_exists):
       expect_exists: If True, throw an error if no checkpoint is found.
         If False, initialize fresh model if no checkpoint is found.
     """
+    if isinstance(model, FrozenQAModel):
+        # The weights are constants in the frozen graph
+        model.init_embeddings(session)
+        return
+
     print "Looking for model at %s..." % train_dir
     ckpt = tf.train.get_checkpoint_state(train_dir)
     v2_path = ckpt.model_checkpoint_path + ".index" if ckpt else ""
     if ckpt and (tf.gfile.Exists(ckpt.model_checkpoint_path) or tf.gfile.Exists(v2_path)):
         print "Reading model parameters from %s" % ckpt.model_checkpoint_path
-        model.saver.restore(session, ckpt.model_checkpoint_path)
+        if not model.is_training and is_slim_checkpoint(ckpt.model_checkpoint_path):
+            # Slim checkpoints never have the embedding variables, even with --save_embeddings,
+            # so they are restored without model.saver
+            if has_compressed_weights(ckpt.model_checkpoint_path):
+                restore_compressed_weights(session, ckpt.model_checkpoint_path)
+            else:
+                tf.train.Saver(tf.global_variables()).restore(session, ckpt.model_checkpoint_path)
+            model.init_embeddings(session)
+        else:
+            model.saver.restore(session, ckpt.model_checkpoint_path)
+            if not FLAGS.save_embeddings:
+                model.init_embeddings(session)
     else:
         if expect_exists:
             raise Exception("There is no saved checkpoint at %s" % train_dir)
         else:
             print "There is no saved checkpoint at %s. Creating model with fresh parameters." % train_dir
             session.run(tf.global_variables_initializer())
+            model.init_embeddings(session)
             print 'Num params: %d' % sum(v.get_shape().num_elements() for v in tf.trainable_variables())
 
 
+def get_model(id2word, word2id, emb_matrix):
+    """
+    Builds the QAModel in the default graph, or loads it from --frozen_graph_path
+    in official_eval / stream_eval / serve modes.
+    """
+    if FLAGS.frozen_graph_path and FLAGS.mode in ("official_eval", "stream_eval", "serve"):
+        return FrozenQAModel(FLAGS, id2word, word2id, FLAGS.frozen_graph_path, emb_matrix)
+    return QAModel(FLAGS, id2word, word2id, emb_matrix)
+
+
+# The model, session, vocabulary and input paragraphs of an official_eval worker process (see init_eval_worker)
+worker_model = None
+worker_session = None
+worker_word2id = None
+worker_paragraphs = None
+
+
+def init_eval_worker(id2word, word2id, emb_matrix, paragraphs):
+    """
+    Initializes an official_eval worker process: builds the model in a new graph
+    and loads it from FLAGS.ckpt_load_dir, once per process.
+
+    The worker processes are forked, so the arguments (and FLAGS) are inherited,
+    not pickled. In particular, each task only needs to send the range of
+    its paragraphs (see eval_worker).
+    """
+    global worker_model, worker_session, worker_word2id, worker_paragraphs
+
+    # Share the CPU cores between the workers
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    config.intra_op_parallelism_threads = max(1, multiprocessing.cpu_count() // FLAGS.num_workers)
+    config.inter_op_parallelism_threads = config.intra_op_parallelism_threads
+
+    graph = tf.Graph()
+    with graph.as_default():
+        worker_model = get_model(id2word, word2id, emb_matrix)
+        worker_session = tf.Session(graph=graph, config=config)
+        initialize_model(worker_session, worker_model, FLAGS.ckpt_load_dir, expect_exists=True)
+
+    worker_word2id = word2id
+    worker_paragraphs = paragraphs
+
+
+def eval_worker(pool):
+    """
+    Predicts the answers for a pool of paragraphs in an official_eval worker process:
+    tokenizes them, makes them into batches and runs the model, like generate_answers.
+
+    Inputs:
+      pool: (start, end) pair. The pool is worker_paragraphs[start:end] (see pool_paragraphs).
+
+    Returns:
+      list of (uuid, answer, nbest) triples (see predict_answers)
+    """
+    start, end = pool
+    examples = tokenize_paragraphs(worker_paragraphs[start:end])
+    return list(predict_answers(worker_session, worker_model, worker_word2id, examples))
+
+
+def generate_answers_in_workers(id2word, word2id, emb_matrix, json_in_path, num_workers):
+    """
+    Like generate_answers, but the Python-bound tokenization and detokenization,
+    and the model itself, run in num_workers processes.
+
+    The paragraphs are split into the pools that one process would read them in
+    (see pool_paragraphs), and each worker tokenizes, batches and predicts whole
+    pools (see eval_worker). So the workers make the same batches as one process,
+    and the answers are identical. All the questions (and windows) of a paragraph
+    go to the same worker, which reuses its context encoding with
+    --cache_context_encodings, as one process would. Only the pool ranges and the
+    answers are sent between the processes, so this process doesn't hold any batches,
+    and a worker holds one pool at a time.
+
+    Returns:
+      uuid2ans, uuid2nbest: see generate_answers
+    """
+    paragraphs = get_json_paragraphs(json_in_path)
+    qn_uuid_data = [qn['id'] for _, qas in paragraphs for qn in qas]
+
+    pools = pool_paragraphs(paragraphs, FLAGS.batch_size * FLAGS.batch_pool_size)
+    print "Generating answers for %i examples (%i pools) with %i workers..." % (len(qn_uuid_data), len(pools), num_workers)
+    if len(pools) < num_workers:
+        print "Warning: there are fewer pools than workers. Lower --batch_pool_size to split the input across more workers"
+
+    workers = multiprocessing.Pool(num_workers, initializer=init_eval_worker, initargs=(id2word, word2id, emb_matrix, paragraphs))
+    try:
+        answers = (answer for pool_answers in workers.imap_unordered(eval_worker, pools) for answer in pool_answers)
+        return collect_answers(answers, qn_uuid_data)
+    finally:
+        workers.close()
+        workers.join()
+
+
+def model_file_hash(path):
+    """Returns a hash (string) of the contents of the file at path, or None if it doesn't exist"""
+    if not path or not tf.gfile.Exists(path):
+        return None
+    sha = hashlib.sha1()
+    with tf.gfile.GFile(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_prediction_cache(word2id):
+    """
+    Returns a PredictionCache configured by the --prediction_cache_* flags,
+    or None if the cache is disabled.
+    """
+    if FLAGS.prediction_cache_size <= 0 and FLAGS.prediction_cache_mb <= 0:
+        return None
+
+    # Cached answers are only valid for the same checkpoint, vocabulary and settings.
+    # The paths are often reused (e.g. slim checkpoints are always qa_slim.ckpt), so the model is identified
+    # by the contents of the frozen graph, or of the checkpoint's index (which has a checksum of each variable).
+    ckpt = tf.train.get_checkpoint_state(FLAGS.ckpt_load_dir)
+    if FLAGS.frozen_graph_path:
+        model_path = FLAGS.frozen_graph_path
+    elif ckpt:
+        v2_path = ckpt.model_checkpoint_path + ".index"
+        model_path = v2_path if tf.gfile.Exists(v2_path) else ckpt.model_checkpoint_path
+    else:
+        model_path = None
+    signature = {
+        "checkpoint": FLAGS.frozen_graph_path or (ckpt.model_checkpoint_path if ckpt else None),
+        "model_hash": model_file_hash(model_path),
+        "glove_path": FLAGS.glove_path,
+        "vocab_size": len(word2id), # differs if the vocabulary has been pruned
+    }
+    for flag in ["context_len", "question_len", "word_len", "window_len", "window_stride", "max_answer_len", "n_best_size", "quantize_embeddings"]:
+        signature[flag] = getattr(FLAGS, flag)
+
+    return PredictionCache(word2id, tokenize_context, tokens_to_ids, FLAGS.prediction_cache_size, int(FLAGS.prediction_cache_mb * 2**20), FLAGS.prediction_cache_path, signature)
+
+
+def quantization_report(id2word, word2id, emb_matrix, json_in_path, ckpt_load_dir):
+    """
+    Compares the model with float32 and int8 (--quantize_embeddings) embeddings
+    on a SQuAD JSON file with answers: F1/EM (using evaluate.py), time to generate
+    the answers, and embedding matrix memory. Each variant is built in its own graph,
+    and warmed up on the first batch of examples before it is timed, so the order of
+    the variants doesn't bias the time ratio.
+    To also measure the int8 weights, point ckpt_load_dir to a --slim_int8 checkpoint.
+    """
+    dataset = data_from_json(json_in_path)
+    qn_uuid_data, context_token_data, qn_token_data = get_json_data(json_in_path)
+    num_warmup = FLAGS.batch_size
+
+    results = []
+    quantize_embeddings = FLAGS.quantize_embeddings
+    try:
+        for quantize in [False, True]:
+            FLAGS.quantize_embeddings = quantize
+            with tf.Graph().as_default():
+                model = QAModel(FLAGS, id2word, word2id, emb_matrix)
+                with tf.Session() as sess:
+                    initialize_model(sess, model, ckpt_load_dir, expect_exists=True)
+                    generate_answers(sess, model, word2id, qn_uuid_data[:num_warmup], context_token_data[:num_warmup], qn_token_data[:num_warmup])
+                    start_time = time.time()
+                    answers_dict, _ = generate_answers(sess, model, word2id, qn_uuid_data, context_token_data, qn_token_data)
+                    elapsed = time.time() - start_time
+            scores = evaluate(dataset['data'], answers_dict)
+            results.append(("int8" if quantize else "float32", scores['f1'], scores['exact_match'], elapsed, model.embedding_bytes))
+    finally:
+        FLAGS.quantize_embeddings = quantize_embeddings
+
+    print "%-8s %8s %8s %10s %14s" % ("", "F1", "EM", "time (s)", "embedding MB")
+    for name, f1, em, elapsed, embedding_bytes in results:
+        print "%-8s %8.3f %8.3f %10.2f %14.1f" % (name, f1, em, elapsed, embedding_bytes / 2.0**20)
+    print "%-8s %+8.3f %+8.3f %9.2fx %13.2fx" % ("delta", results[1][1] - results[0][1], results[1][2] - results[0][2], results[0][3] / results[1][3], results[0][4] / float(results[1][4]))
+
+
 def main(unused_argv):
     # Print an error message if you've entered flags incorrectly
     if len(unused_argv) != 1:
@@ -113,18 +371,61 @@ def main(unused_argv):
     print "This code was developed and tested on TensorFlow 1.4.1. Your TensorFlow version: %s" % tf.__version__
 
     # Define train_dir
-    if not FLAGS.experiment_name and not FLAGS.train_dir and FLAGS.mode != "official_eval":
+    if not FLAGS.experiment_name and not FLAGS.train_dir and FLAGS.mode not in ("official_eval", "stream_eval", "serve", "export_graph", "export_slim_checkpoint", "quantization_report", "compile_data"):
         raise Exception("You need to specify either --experiment_name or --train_dir")
+    has_train_dir = bool(FLAGS.experiment_name or FLAGS.train_dir)
     FLAGS.train_dir = FLAGS.train_dir or os.path.join(EXPERIMENTS_DIR, FLAGS.experiment_name)
 
+    if FLAGS.quantize_embeddings and FLAGS.mode == "train":
+        raise Exception("--quantize_embeddings is only for inference modes")
+    if FLAGS.quantize_embeddings and FLAGS.save_embeddings:
+        raise Exception("--save_embeddings can't be used with --quantize_embeddings")
+    if FLAGS.bucket_by and FLAGS.bucket_by not in BUCKET_BY:
+        raise Exception("--bucket_by=%s must be one of %s" % (FLAGS.bucket_by, " / ".join(BUCKET_BY)))
+    if FLAGS.batch_pool_size < 1 or FLAGS.bucket_spread < 1:
+        raise Exception("--batch_pool_size and --bucket_spread must be at least 1")
+
     # Initialize bestmodel directory
     bestmodel_dir = os.path.join(FLAGS.train_dir, "best_checkpoint")
 
     # Define path for glove vecs
     FLAGS.glove_path = FLAGS.glove_path or os.path.join(DEFAULT_DATA_DIR, "glove.6B.{}d.txt".format(FLAGS.embedding_size))
 
-    # Load embedding matrix and vocab mappings
-    emb_matrix, word2id, id2word = get_glove(FLAGS.glove_path, FLAGS.embedding_size)
+    # Load embedding matrix and vocab mappings.
+    # If prune_vocab mode has been run for this experiment, the modes that read the train/dev data use the
+    # pruned vocabulary (it has all their words). The inference modes only use it with --use_pruned_vocab,
+    # as new inputs can have words that it doesn't. It's in train_dir, which for inference modes is the parent
+    # of ckpt_load_dir (experiments/<name>/best_checkpoint) unless --experiment_name or --train_dir is given.
+    vocab = None
+    if FLAGS.mode in ("train", "show_examples", "compile_data") or FLAGS.use_pruned_vocab:
+        vocab_dir = FLAGS.train_dir if has_train_dir else os.path.dirname(os.path.normpath(FLAGS.ckpt_load_dir))
+        vocab = get_pruned_vocab(vocab_dir, FLAGS.embedding_size)
+        if vocab is None and FLAGS.use_pruned_vocab:
+            raise Exception("--use_pruned_vocab is set, but there is no pruned vocabulary in %s (see prune_vocab mode)" % vocab_dir)
+    if vocab is not None:
+        emb_matrix, word2id, id2word = vocab
+    elif FLAGS.input_vocab:
+        # The mappings for the full vocabulary aren't needed
+        emb_matrix, id2word = load_glove(FLAGS.glove_path, FLAGS.embedding_size)
+    else:
+        emb_matrix, word2id, id2word = get_glove(FLAGS.glove_path, FLAGS.embedding_size)
+
+    # For --input_vocab, read the input now, and keep only the rows of the embedding matrix it needs
+    input_data = None
+    if FLAGS.input_vocab:
+        if FLAGS.mode != "official_eval":
+            raise Exception("--input_vocab is only for official_eval mode")
+        if FLAGS.frozen_graph_path or FLAGS.prediction_cache_path:
+            raise Exception("--input_vocab can't be used with --frozen_graph_path or --prediction_cache_path, which need the word ids of the full vocabulary")
+        if FLAGS.json_in_path == "":
+            raise Exception("For official_eval mode, you need to specify --json_in_path")
+        input_data = get_json_data(FLAGS.json_in_path)
+        _, context_token_data, qn_token_data = input_data
+        input_words = set(word for tokens in context_token_data + qn_token_data for word in tokens)
+        full_vocab_size = len(id2word)
+        emb_matrix, words = prune_vocab(emb_matrix, id2word, input_words)
+        word2id, id2word = get_vocab_mappings(words)
+        print "Input vocabulary: %i of %i words (%.1f MB embedding matrix)" % (len(words), full_vocab_size, emb_matrix.nbytes / 2.0**20)
 
     # Get filepaths to train/dev datafiles for tokenized queries, contexts and answers
     train_context_path = os.path.join(FLAGS.data_dir, "train.context")
@@ -134,8 +435,9 @@ def main(unused_argv):
     dev_qn_path = os.path.join(FLAGS.data_dir, "dev.question")
     dev_ans_path = os.path.join(FLAGS.data_dir, "dev.span")
 
-    # Initialize model
-    qa_model = QAModel(FLAGS, id2word, word2id, emb_matrix)
+    # Initialize model (quantization_report builds its own models, and official_eval workers load their own copies)
+    builds_own_models = FLAGS.mode in ("quantization_report", "prune_vocab", "compile_data") or (FLAGS.mode == "official_eval" and FLAGS.num_workers > 1)
+    qa_model = get_model(id2word, word2id, emb_matrix) if not builds_own_models else None
 
     # Some GPU settings
     config=tf.ConfigProto()
@@ -177,23 +479,77 @@ def main(unused_argv):
             _, _ = qa_model.check_f1_em(sess, dev_context_path, dev_qn_path, dev_ans_path, "dev", num_samples=10, print_to_screen=True)
 
 
-    elif FLAGS.mode == "official_eval":
-        if FLAGS.json_in_path == "":
-            raise Exception("For official_eval mode, you need to specify --json_in_path")
-        if FLAGS.ckpt_load_dir == "":
-            raise Exception("For official_eval mode, you need to specify --ckpt_load_dir")
+    elif FLAGS.mode in ("official_eval", "stream_eval", "serve"):
+        if FLAGS.json_in_path == "" and FLAGS.mode != "serve":
+            raise Exception("For %s mode, you need to specify --json_in_path" % FLAGS.mode)
+        if FLAGS.ckpt_load_dir == "" and FLAGS.frozen_graph_path == "":
+            raise Exception("For %s mode, you need to specify --ckpt_load_dir (or --frozen_graph_path)" % FLAGS.mode)
+        if FLAGS.window_len > FLAGS.context_len:
+            raise Exception("--window_len=%i must be at most --context_len=%i" % (FLAGS.window_len, FLAGS.context_len))
+        if FLAGS.window_len > 0 and not 0 < FLAGS.window_stride <= FLAGS.window_len:
+            raise Exception("--window_stride=%i must be between 1 and --window_len=%i" % (FLAGS.window_stride, FLAGS.window_len))
+        if FLAGS.num_workers < 1:
+            raise Exception("--num_workers=%i must be at least 1" % FLAGS.num_workers)
 
-        # Read the JSON data from file
-        qn_uuid_data, context_token_data, qn_token_data = get_json_data(FLAGS.json_in_path)
+        # Get the prediction cache (None if it's disabled)
+        cache = get_prediction_cache(word2id)
+        if cache is not None and FLAGS.num_workers > 1:
+            raise Exception("The prediction cache can't be used with --num_workers > 1")
 
-        with tf.Session(config=config) as sess:
+        if FLAGS.mode == "serve":
+            with tf.Session(config=config) as sess:
 
-            # Load model from ckpt_load_dir
-            initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+                # Load model from ckpt_load_dir
+                initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+
+                # Answer requests until interrupted
+                serve(sess, qa_model, word2id, FLAGS.host, FLAGS.port, FLAGS.max_wait_ms / 1000.0, cache)
+
+        elif FLAGS.mode == "stream_eval":
+            with tf.Session(config=config) as sess:
+
+                # Load model from ckpt_load_dir
+                initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+
+                # Read, predict and write the examples a pool of batches at a time
+                print "Writing predictions to %s..." % FLAGS.json_out_path
+                num_written = stream_answers(sess, qa_model, word2id, FLAGS.json_in_path, FLAGS.json_out_path, cache)
+                print "Wrote %i predictions to %s" % (num_written, FLAGS.json_out_path)
+
+        else:
 
-            # Get a predicted answer for each example in the data
-            # Return a mapping answers_dict from uuid to answer
-            answers_dict = generate_answers(sess, qa_model, word2id, qn_uuid_data, context_token_data, qn_token_data)
+            if FLAGS.num_workers > 1:
+                # Each worker process loads its own copy of the model
+                # (no session is created in this process before forking)
+                answers_dict, nbest_dict = generate_answers_in_workers(id2word, word2id, emb_matrix, FLAGS.json_in_path, FLAGS.num_workers)
+
+            elif cache is not None:
+                # Read the (untokenized) JSON data from file
+                paragraphs = get_json_paragraphs(FLAGS.json_in_path)
+                qn_uuid_data = [qn['id'] for _, qas in paragraphs for qn in qas]
+
+                with tf.Session(config=config) as sess:
+
+                    # Load model from ckpt_load_dir
+                    initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+
+                    # Get a predicted answer for each example, looking up contexts and answers in the cache first
+                    print "Generating answers..."
+                    answers_dict, nbest_dict = collect_answers(predict_answers_with_cache(sess, qa_model, word2id, paragraphs, cache), qn_uuid_data)
+
+            else:
+                # Read the JSON data from file (unless --input_vocab already has)
+                qn_uuid_data, context_token_data, qn_token_data = input_data or get_json_data(FLAGS.json_in_path)
+
+                with tf.Session(config=config) as sess:
+
+                    # Load model from ckpt_load_dir
+                    initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+
+                    # Get a predicted answer for each example in the data
+                    # Return a mapping answers_dict from uuid to answer
+                    # (and nbest_dict from uuid to the n-best answers, if --n_best_size > 0)
+                    answers_dict, nbest_dict = generate_answers(sess, qa_model, word2id, qn_uuid_data, context_token_data, qn_token_data)
 
             # Write the uuid->answer mapping a to json file in root dir
             print "Writing predictions to %s..." % FLAGS.json_out_path
@@ -201,6 +557,83 @@ def main(unused_argv):
                 f.write(unicode(json.dumps(answers_dict, ensure_ascii=False)))
                 print "Wrote predictions to %s" % FLAGS.json_out_path
 
+            # Write the uuid->n-best answers mapping to json file
+            if FLAGS.n_best_size > 0:
+                print "Writing n-best predictions to %s..." % FLAGS.nbest_json_out_path
+                with io.open(FLAGS.nbest_json_out_path, 'w', encoding='utf-8') as f:
+                    f.write(unicode(json.dumps(nbest_dict, ensure_ascii=False)))
+                    print "Wrote n-best predictions to %s" % FLAGS.nbest_json_out_path
+
+        # Report and save the prediction cache
+        if cache is not None:
+            print "Prediction cache: %s" % json.dumps(cache.stats(), sort_keys=True)
+            if FLAGS.prediction_cache_path:
+                cache.save()
+
+
+    elif FLAGS.mode == "export_slim_checkpoint":
+        if FLAGS.ckpt_load_dir == "":
+            raise Exception("For export_slim_checkpoint mode, you need to specify --ckpt_load_dir")
+        if FLAGS.slim_ckpt_dir == "":
+            raise Exception("For export_slim_checkpoint mode, you need to specify --slim_ckpt_dir")
+
+        with tf.Session(config=config) as sess:
+
+            # Load model from ckpt_load_dir
+            initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+
+            # Write only the trainable weights
+            qa_model.export_slim_checkpoint(sess, FLAGS.slim_ckpt_dir, FLAGS.slim_float16, FLAGS.slim_int8)
+
+    elif FLAGS.mode == "export_graph":
+        if FLAGS.ckpt_load_dir == "":
+            raise Exception("For export_graph mode, you need to specify --ckpt_load_dir")
+        if FLAGS.frozen_graph_path == "":
+            raise Exception("For export_graph mode, you need to specify --frozen_graph_path")
+
+        with tf.Session(config=config) as sess:
+
+            # Load model from ckpt_load_dir
+            initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+
+            # Write the inference graph with the weights as constants
+            qa_model.export_frozen_graph(sess, FLAGS.frozen_graph_path, FLAGS.export_embeddings)
+
+    elif FLAGS.mode == "quantization_report":
+        if FLAGS.ckpt_load_dir == "":
+            raise Exception("For quantization_report mode, you need to specify --ckpt_load_dir")
+        if FLAGS.json_in_path == "":
+            raise Exception("For quantization_report mode, you need to specify --json_in_path")
+
+        quantization_report(id2word, word2id, emb_matrix, FLAGS.json_in_path, FLAGS.ckpt_load_dir)
+
+    elif FLAGS.mode == "prune_vocab":
+        if not os.path.exists(FLAGS.train_dir):
+            os.makedirs(FLAGS.train_dir)
+
+        # Keep the words that appear in the train/dev data (and the extra corpora)
+        corpus_paths = [train_context_path, train_qn_path, dev_context_path, dev_qn_path]
+        corpus_paths += [path for path in FLAGS.prune_vocab_corpora.split(",") if path]
+        keep_words = set()
+        for path in corpus_paths:
+            print "Reading words from %s..." % path
+            with open(path) as f:
+                for line in f:
+                    keep_words.update(split_by_whitespace(line))
+
+        pruned_emb_matrix, pruned_words = prune_vocab(emb_matrix, id2word, keep_words)
+        print "%i distinct words in the data, %i of them in GloVe (the rest map to UNK)" % (len(keep_words), len(keep_words.intersection(word2id)))
+        print "Embedding matrix: %i -> %i rows (%.1f MB -> %.1f MB)" % (emb_matrix.shape[0], pruned_emb_matrix.shape[0], emb_matrix.nbytes / 2.0**20, pruned_emb_matrix.nbytes / 2.0**20)
+        save_pruned_vocab(FLAGS.train_dir, pruned_emb_matrix, pruned_words)
+
+    elif FLAGS.mode == "compile_data":
+        if FLAGS.shards_dir == "":
+            raise Exception("For compile_data mode, you need to specify --shards_dir")
+
+        # The word ids depend on the vocabulary (e.g. if it has been pruned), so the shards record its signature
+        vocab_sig = vocab_signature(id2word)
+        compile_shards(train_context_path, train_qn_path, train_ans_path, os.path.join(FLAGS.shards_dir, "train"), word2id, vocab_sig, FLAGS.word_len)
+        compile_shards(dev_context_path, dev_qn_path, dev_ans_path, os.path.join(FLAGS.shards_dir, "dev"), word2id, vocab_sig, FLAGS.word_len)
 
     else:
         raise Exception("Unexpected value of FLAGS.mode: %s" % FLAGS.mode)
@@ -12,162 +12,287 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""This code is required for "official_eval" mode in main.py
-It provides functions to read a SQuAD json file, use the model to get predicted answers,
-and write those answers to another JSON file."""
+"""This code is required for "official_eval" and "stream_eval" modes in main.py
+It provides functions to read a SQuAD json (or JSONL) file, use the model to get predicted answers,
+and write those answers to another JSON (or JSONL) file."""
 
 from __future__ import absolute_import
 from __future__ import division
 
 import os
+import io
+import json
+from collections import OrderedDict
+from itertools import izip, groupby
 from tqdm import tqdm
 import numpy as np
 from six.moves import xrange
 from nltk.tokenize.moses import MosesDetokenizer
 
 from preprocessing.squad_preprocess import data_from_json, tokenize
-from vocab import PAD_ID, UNK_ID, CHAR_PAD_ID, CHAR_UNK_ID, ALPHABET
-from data_batcher import padded, Batch
+from data_batcher import words_to_ids, batch_inputs, batch_boundaries, Batch, BatchBuffers
+from prefetch import BatchPrefetcher
 
 
 
-def readnext(x):
-    """x is a list"""
-    if len(x) == 0:
-        return False
-    else:
-        return x.pop(0)
-
 def tokens_to_ids(tokens, word2id):
     """Turns an already-tokenized sentence string into word indices
     e.g. "i do n't know" -> [9, 32, 16, 96]
     Note any token that isn't in the word2id mapping gets mapped to the id for UNK
+    Returns a numpy int32 array (the char ids are made per batch, see data_batcher.batch_inputs).
     """
-    char_ids = []
-    for word in tokens :
-        char_ids.append([ALPHABET.find(char) if char in ALPHABET else CHAR_UNK_ID for char in word])
-    ids = [word2id.get(w, UNK_ID) for w in tokens]
-    return ids, char_ids
+    return words_to_ids(tokens, word2id)
 
-def flatten_char_ids(char_ids, word_len, sequence_len):
-    for char_id in char_ids :
-        if len(char_id) > word_len:
-            char_id = char_id[:word_len]
-        if len(char_id) < word_len :
-            char_id.extend([CHAR_PAD_ID] * (word_len - len(char_id)))
-    char_ids_flat = [item for sublist in char_ids for item in sublist]
-    char_len = sequence_len * word_len
-    if len(char_ids_flat) > char_len:
-        char_ids_flat = char_ids_flat[:char_len]
-    return char_ids_flat
+def get_window_starts(num_tokens, window_len, window_stride):
+    """
+    Returns the start positions of the windows of length window_len that a context of
+    num_tokens tokens is split into. Consecutive windows start window_stride apart
+    (so they overlap if window_stride < window_len), and the last window reaches the end.
+    """
+    starts = [0]
+    while starts[-1] + window_len < num_tokens:
+        starts.append(starts[-1] + window_stride)
+    return starts
 
 
-def refill_batches(batches, word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len, word_len):
+def refill_batches(batches, word2id, context_groups, batch_size, context_len, question_len, max_batch_tokens=0, window_len=0, window_stride=0, pool_size=160):
     """
     This is similar to refill_batches in data_batcher.py, but:
-      (1) instead of reading from (preprocessed) datafiles, it reads from the provided lists
+      (1) instead of reading from (preprocessed) datafiles, it reads from the provided iterator
       (2) it only puts the context and question information in the batches (not the answer information)
       (3) it also gets UUID information and puts it in the batches
+      (4) it sorts the examples by context length, so that each batch needs as little padding as possible.
+        Questions about the same context stay next to each other.
+      (5) if window_len > 0, instead of truncating long contexts, it splits them into
+        overlapping windows, each of which is a separate example with the same UUID.
 
     Inputs:
       batches: list to be refilled
-      qn_uuid_data: list of strings that are unique ids
-      context_token_data, qn_token_data: list of lists of strings (no UNKs, no padding)
+      context_groups: iterator over the examples, grouped by context (see group_by_context).
+        The examples are (uuid, context_tokens, qn_tokens) triples.
+        context_tokens and qn_tokens are lists of strings (no UNKs, no padding).
+        An example can also be (uuid, context_tokens, qn_tokens, context_ids)
+        if the context has already been mapped to ids (see tokens_to_ids), e.g. by a PredictionCache.
       batch_size: int. size of batches to make
       context_len, question_len: ints. max sizes of context and question. Anything longer is truncated.
-      word_len: ints. max size of a word. Anything longer is truncated.
-
-    Makes batches that contain:
-      uuids_batch, context_tokens_batch, context_ids_batch, qn_ids_batch: all lists length batch_size
+      max_batch_tokens: int. If > 0, pack batches up to this many padded context tokens
+        instead of batch_size examples (see data_batcher.batch_boundaries).
+      window_len, window_stride: ints. If window_len > 0, contexts longer than window_len
+        are split into windows of window_len tokens, starting every window_stride tokens.
+      pool_size: int. The whole contexts (and their questions) are read until there are
+        batch_size * pool_size questions, then sorted and made into batches.
+
+    Makes batches that are lists (length batch_size) of
+      (uuid, context_tokens, context_ids, qn_tokens, qn_ids, context_offset, num_windows) tuples,
+    with the context and question ids truncated.
     """
-    examples = []
-
-    # Get next example
-    qn_uuid, context_tokens, qn_tokens = readnext(qn_uuid_data), readnext(context_token_data), readnext(qn_token_data)
-
-    while qn_uuid and context_tokens and qn_tokens:
-
-        # Convert context_tokens and qn_tokens to context_ids and qn_ids
-        context_ids, context_char_ids = tokens_to_ids(context_tokens, word2id)
-        qn_ids, qn_char_ids = tokens_to_ids(qn_tokens, word2id)
-
-        # context_tokens is a list of words in a sentence.
-        context_char_ids_flat = flatten_char_ids(context_char_ids, word_len, context_len)
-        question_char_ids_flat = flatten_char_ids(qn_char_ids, word_len, question_len)
-        
-        # Truncate context_ids and qn_ids
-        # Note: truncating context_ids may truncate the correct answer, meaning that it's impossible for your model to get the correct answer on this example!
-        if len(qn_ids) > question_len:
-            qn_ids = qn_ids[:question_len]
-        if len(context_ids) > context_len:
-            context_ids = context_ids[:context_len]
-
-        # Add to list of examples
-        examples.append((qn_uuid, context_tokens, context_ids, qn_ids, context_char_ids_flat, question_char_ids_flat))
-
-        # Stop if you've got a batch
-        if len(examples) == batch_size:
+    pool = []
+    prev_context_tokens, context_windows = None, None
+
+    # Get the next context's examples
+    num_questions = 0
+    for _, context_examples in context_groups:
+        for example in context_examples:
+            qn_uuid, context_tokens, qn_tokens = example[:3]
+
+            # Convert context_tokens to context_ids, and split them into windows (or truncate them).
+            # The questions about a context are consecutive and share its context_tokens, so they share the windows.
+            # Note: truncating context_ids may truncate the correct answer, meaning that it's impossible for your model to get the correct answer on this example!
+            if context_tokens is not prev_context_tokens:
+                context_ids = np.asarray(example[3], dtype=np.int32) if len(example) > 3 else words_to_ids(context_tokens, word2id)
+                if window_len > 0:
+                    window_starts = get_window_starts(len(context_ids), window_len, window_stride)
+                    context_windows = [(context_tokens[window_start:window_start + window_len], context_ids[window_start:window_start + window_len], window_start, len(window_starts))
+                                       for window_start in window_starts]
+                else:
+                    context_windows = [(context_tokens, context_ids[:context_len], 0, 1)]
+                prev_context_tokens = context_tokens
+
+            # Convert qn_tokens to (truncated) qn_ids
+            qn_ids = words_to_ids(qn_tokens, word2id)[:question_len]
+
+            # Add to list of examples, one per window
+            for window_tokens, window_ids, window_start, num_windows in context_windows:
+                pool.append((qn_uuid, window_tokens, window_ids, qn_tokens, qn_ids, window_start, num_windows))
+
+            num_questions += 1
+
+        # Stop at the end of a context once you've got pool_size batches' worth of questions.
+        # So the pools only depend on the number of questions of each paragraph, and
+        # the official_eval workers can split the input in the same places (see pool_paragraphs).
+        if num_questions >= batch_size * pool_size:
             break
 
-        # Get next example
-        qn_uuid, context_tokens, qn_tokens = readnext(qn_uuid_data), readnext(context_token_data), readnext(qn_token_data)
+    # Sort by context length (the sort is stable, so questions about the same context stay together)
+    pool = sorted(pool, key=lambda e: len(e[2]))
 
     # Make into batches
-    for batch_start in xrange(0, len(examples), batch_size):
-        uuids_batch, context_tokens_batch, context_ids_batch, qn_ids_batch, context_char_ids_batch, qn_char_ids_batch = zip(*examples[batch_start:batch_start + batch_size])
-        batches.append((uuids_batch, context_tokens_batch, context_ids_batch, qn_ids_batch, context_char_ids_batch, qn_char_ids_batch))
+    for batch_start, batch_end in batch_boundaries([len(e[2]) for e in pool], batch_size, max_batch_tokens):
+        batches.append(pool[batch_start:batch_end])
     return
 
 
 
-def get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len, word_len):
+def group_by_context(examples):
+    """
+    Groups consecutive examples (see refill_batches) that share the same context_tokens
+    list (e.g. the questions of a paragraph, see iter_paragraph_examples).
+    Returns an iterator of (key, examples of the context) pairs, like itertools.groupby.
+    """
+    # The previous example is still referenced when the next one is made,
+    # so two different contexts can't have the same id
+    return groupby(examples, key=lambda example: id(example[1]))
+
+
+def get_batch_generator(word2id, examples, batch_size, context_len, question_len, word_len, max_batch_tokens=0, window_len=0, window_stride=0, num_buffers=2, pool_size=160):
     """
     This is similar to get_batch_generator in data_batcher.py, but with some
     differences (see explanation in refill_batches).
 
+    Only about batch_size * pool_size questions are read from examples at a time,
+    so examples can be a (lazy) generator over an arbitrarily large input.
+
     Inputs:
       word2id: dictionary mapping word (string) to word id (int)
-      qn_uuid_data: list of strings that are unique ids
-      context_token_data, qn_token_data: list of lists of strings (no UNKs, no padding)
+      examples: iterable of (uuid, context_tokens, qn_tokens) triples (see refill_batches).
+        context_tokens and qn_tokens are lists of strings (no UNKs, no padding).
       batch_size: int. size of batches to make
       context_len, question_len: ints. max sizes of context and question. Anything longer is truncated.
+      max_batch_tokens: int. If > 0, pack batches up to this many padded context tokens instead of batch_size examples.
+      window_len, window_stride: ints. If window_len > 0, split long contexts into windows instead of truncating them.
+      num_buffers: int. The batches' arrays are reused after this many batches (see data_batcher.BatchBuffers).
+      pool_size: int. The number of batches' worth of questions that are sorted by length together (see refill_batches).
 
     Yields:
-      Batch objects, but they only contain context and question information (no answer information)
+      Batch objects, but they only contain context and question information (no answer information).
+        If a context was split into windows, there is one example per window, with the same UUID;
+        batch.context_offsets gives the position of each window in the full context,
+        and batch.num_windows the number of windows of that context.
     """
+    context_groups = group_by_context(examples)
     batches = []
+    buffers = BatchBuffers(num_buffers)
 
     while True:
         if len(batches) == 0:
-            refill_batches(batches, word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len, word_len)
+            refill_batches(batches, word2id, context_groups, batch_size, context_len, question_len, max_batch_tokens, window_len, window_stride, pool_size)
         if len(batches) == 0:
             break
 
         # Get next batch. These are all lists length batch_size
-        (uuids, context_tokens, context_ids, qn_ids, context_char_ids, qn_char_ids) = batches.pop(0)
-
-        # Pad context_ids and qn_ids
-        qn_ids, qn_char_ids = padded(qn_ids, qn_char_ids, word_len, question_len) # pad questions to length question_len
-        context_ids, context_char_ids = padded(context_ids, context_char_ids, word_len, context_len) # pad contexts to length context_len
-
-        # Make qn_ids into a np array and create qn_mask
-        qn_ids = np.array(qn_ids)
-        qn_char_ids = np.array(qn_char_ids)
-        qn_mask = (qn_ids != PAD_ID).astype(np.int32)
+        uuids, context_tokens, context_ids, qn_tokens, qn_ids, context_offsets, num_windows = zip(*batches.pop(0))
+        buffers.next_batch()
 
-        # Make context_ids into a np array and create context_mask
-        context_ids = np.array(context_ids)
-        context_char_ids = np.array(context_char_ids)
-        context_mask = (context_ids != PAD_ID).astype(np.int32)
+        # Pad context_ids and qn_ids to the length of the longest context and question in this batch,
+        # and get the char ids and the unique words of the batch, for the (deduplicated) char-CNN
+        qn_ids, qn_char_ids, qn_lens, qn_words, qn_word_idx = batch_inputs(buffers, "qn", qn_ids, qn_tokens, map(len, qn_ids), word_len)
+        context_ids, context_char_ids, context_lens, context_words, context_word_idx = batch_inputs(buffers, "context", context_ids, context_tokens, map(len, context_ids), word_len)
 
         # Make into a Batch object
-        batch = Batch(context_ids, context_char_ids, context_mask, context_tokens, qn_ids, qn_char_ids, qn_mask, qn_tokens=None, ans_span=None, ans_tokens=None, uuids=uuids)
+        batch = Batch(context_ids, context_char_ids, context_lens, list(context_tokens), qn_ids, qn_char_ids, qn_lens, list(qn_tokens), ans_span=None, uuids=list(uuids),
+                      context_words=context_words, context_word_idx=context_word_idx, qn_words=qn_words, qn_word_idx=qn_word_idx, context_offsets=list(context_offsets), num_windows=list(num_windows))
 
         yield batch
 
     return
 
 
+def tokenize_context(context):
+    """Tokenizes a context (paragraph) string. Returns a list of strings (lowercase)"""
+    context = unicode(context) # string
+
+    # The following replacements are suggested in the paper
+    # BidAF (Seo et al., 2016)
+    context = context.replace("''", '" ')
+    context = context.replace("``", '" ')
+
+    return tokenize(context)
+
+
+def iter_paragraph_examples(context, qas):
+    """
+    Tokenizes a paragraph and its questions.
+
+    Inputs:
+      context: string
+      qas: list of dictionaries with keys "id" and "question"
+
+    Yields:
+      (uuid, context_tokens, qn_tokens) triples. All the questions share the same context_tokens list.
+    """
+    context_tokens = tokenize_context(context) # list of strings (lowercase)
+
+    # for each question
+    for qn in qas:
+
+        # read the question text and tokenize
+        question = unicode(qn['question']) # string
+        question_tokens = tokenize(question) # list of strings
+
+        # also get the question_uuid
+        question_uuid = qn['id']
+
+        yield question_uuid, context_tokens, question_tokens
+
+
+def iter_dataset_paragraphs(dataset):
+    """
+    Input:
+      dataset: data read from SQuAD JSON file
+
+    Yields:
+      (context, qas) pairs. context is a string and qas is a list of dictionaries with keys "id" and "question".
+    """
+    for article in dataset['data']:
+        for paragraph in article['paragraphs']:
+            yield paragraph['context'], paragraph['qas']
+
+
+def iter_jsonl_paragraphs(jsonl_filename):
+    """
+    Lazily reads the contexts and questions of a JSONL file, one line at a time.
+
+    Each line is a JSON object, either a single question:
+      {"id": ..., "context": ..., "question": ...}
+    or a SQuAD-style paragraph with several questions:
+      {"context": ..., "qas": [{"id": ..., "question": ...}, ...]}
+
+    Yields:
+      (context, qas) pairs (see iter_dataset_paragraphs)
+    """
+    with io.open(jsonl_filename, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield record['context'], record['qas'] if 'qas' in record else [record]
+
+
+def iter_examples(paragraphs):
+    """
+    Lazily tokenizes the contexts and questions of an iterable of (context, qas) pairs, one paragraph at a time.
+
+    Yields:
+      (uuid, context_tokens, qn_tokens) triples
+    """
+    for context, qas in paragraphs:
+        for example in iter_paragraph_examples(context, qas):
+            yield example
+
+
+def iter_dataset_examples(dataset):
+    """
+    Lazily tokenizes the contexts and questions of a SQuAD dataset, article by article.
+
+    Input:
+      dataset: data read from SQuAD JSON file
+
+    Yields:
+      (uuid, context_tokens, qn_tokens) triples
+    """
+    return iter_examples(iter_dataset_paragraphs(dataset))
+
+
 def preprocess_dataset(dataset):
     """
     Note: this is similar to squad_preprocess.preprocess_and_write, but:
@@ -187,36 +312,12 @@ def preprocess_dataset(dataset):
     context_token_data = []
     qn_token_data = []
 
-    for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing data"):
-        article_paragraphs = dataset['data'][articles_id]['paragraphs']
-        for pid in range(len(article_paragraphs)):
-
-            context = unicode(article_paragraphs[pid]['context']) # string
-
-            # The following replacements are suggested in the paper
-            # BidAF (Seo et al., 2016)
-            context = context.replace("''", '" ')
-            context = context.replace("``", '" ')
-
-            context_tokens = tokenize(context) # list of strings (lowercase)
-            context = context.lower()
-
-            qas = article_paragraphs[pid]['qas'] # list of questions
+    for question_uuid, context_tokens, question_tokens in tqdm(iter_dataset_examples(dataset), desc="Preprocessing data"):
 
-            # for each question
-            for qn in qas:
-
-                # read the question text and tokenize
-                question = unicode(qn['question']) # string
-                question_tokens = tokenize(question) # list of strings
-
-                # also get the question_uuid
-                question_uuid = qn['id']
-
-                # Append to data lists
-                qn_uuid_data.append(question_uuid)
-                context_token_data.append(context_tokens)
-                qn_token_data.append(question_tokens)
+        # Append to data lists
+        qn_uuid_data.append(question_uuid)
+        context_token_data.append(context_tokens)
+        qn_token_data.append(question_tokens)
 
     return qn_uuid_data, context_token_data, qn_token_data
 
@@ -249,12 +350,277 @@ def get_json_data(data_filename):
     return qn_uuid_data, context_token_data, qn_token_data
 
 
+def get_json_paragraphs(data_filename):
+    """
+    Read the (untokenized) paragraphs from a .json file (like dev-v1.1.json)
+
+    Returns:
+      paragraphs: list of (context, qas) pairs, in file order.
+        context is a string and qas is a list of dictionaries with keys "id" and "question".
+    """
+    # Check the data file exists
+    if not os.path.exists(data_filename):
+        raise Exception("JSON input file does not exist: %s" % data_filename)
+
+    # Read the json file
+    print "Reading data from %s..." % data_filename
+    data = data_from_json(data_filename)
+
+    return list(iter_dataset_paragraphs(data))
+
+
+def pool_paragraphs(paragraphs, pool_questions):
+    """
+    Splits paragraphs into the pools that get_batch_generator reads them in:
+    whole paragraphs, until there are at least pool_questions questions (see refill_batches).
+    The batches of a pool only depend on its paragraphs, so the pools can be
+    predicted separately (e.g. by the official_eval workers), with the same answers.
+
+    Inputs:
+      paragraphs: list of (context, qas) pairs
+      pool_questions: int. batch_size * pool_size.
+
+    Returns:
+      pools: list of (start, end) pairs. The pools are paragraphs[start:end],
+        in order, so concatenating them gives back the original list.
+    """
+    pools = []
+    start, num_questions = 0, 0
+    for paragraph_idx, (_, qas) in enumerate(paragraphs):
+        num_questions += len(qas)
+        if num_questions >= pool_questions:
+            pools.append((start, paragraph_idx + 1))
+            start, num_questions = paragraph_idx + 1, 0
+    if start < len(paragraphs):
+        pools.append((start, len(paragraphs)))
+    return pools
+
+
+def tokenize_paragraphs(paragraphs):
+    """
+    Tokenizes the contexts and questions of a list of paragraphs.
+
+    Inputs:
+      paragraphs: list of (context, qas) pairs (see get_json_paragraphs)
+
+    Returns:
+      examples: list of (uuid, context_tokens, qn_tokens) triples
+    """
+    return [example for context, qas in paragraphs for example in iter_paragraph_examples(context, qas)]
+
+
+def predict_batch(session, model, batch, detokenizer, context_cache=None):
+    """
+    Predicts the answer span for each example (or context window) in a batch.
+
+    Inputs:
+      session: TensorFlow session
+      model: QAModel
+      batch: a Batch object made by get_batch_generator
+      detokenizer: MosesDetokenizer
+      context_cache: dict or None. See QAModel.get_prob_dists.
+
+    Returns:
+      window_predictions: list (length batch_size) of (uuid, num_windows, score, answer, nbest) tuples.
+        answer is the most likely answer in this window (string; detokenized) and score its probability.
+        If model.FLAGS.n_best_size > 0, nbest is a list of dictionaries
+        {"text", "start", "end", "probability"}. Otherwise nbest is None.
+    """
+    n_best_size = model.FLAGS.n_best_size
+
+    # Get the predicted spans
+    # The most likely span is the first of the n-best spans
+    if n_best_size > 0:
+        nbest_start_batch, nbest_end_batch, nbest_score_batch = model.get_nbest_spans(session, batch, n_best_size, context_cache)
+        pred_start_batch, pred_end_batch, pred_score_batch = nbest_start_batch[:, 0], nbest_end_batch[:, 0], nbest_score_batch[:, 0]
+    else:
+        pred_start_batch, pred_end_batch, pred_score_batch = model.get_start_end_scores(session, batch, context_cache)
+
+    # Convert pred_start_batch, pred_end_batch and pred_score_batch to lists length batch_size
+    pred_start_batch = pred_start_batch.tolist()
+    pred_end_batch = pred_end_batch.tolist()
+    pred_score_batch = pred_score_batch.tolist()
+
+    window_predictions = []
+
+    # For each example in the batch:
+    for ex_idx, (pred_start, pred_end, pred_score) in enumerate(zip(pred_start_batch, pred_end_batch, pred_score_batch)):
+
+        # Original context tokens (no UNKs or padding) for this example
+        # (if the context was split into windows, this is just the window)
+        context_tokens = batch.context_tokens[ex_idx] # list of strings
+        context_offset = batch.context_offsets[ex_idx]
+
+        # Check the predicted span is in range
+        assert pred_start in range(len(context_tokens))
+        assert pred_end in range(len(context_tokens))
+
+        # Predicted answer tokens
+        pred_ans_tokens = context_tokens[pred_start : pred_end +1] # list of strings
+
+        # Detokenize
+        pred_ans = detokenizer.detokenize(pred_ans_tokens, return_str=True)
+
+        # Detokenize the n-best answers, skipping the invalid spans (score -1) that fill up the list for short contexts
+        nbest = None
+        if n_best_size > 0:
+            nbest = [{"text": detokenizer.detokenize(context_tokens[start : end + 1], return_str=True),
+                      "start": start + context_offset,
+                      "end": end + context_offset,
+                      "probability": score}
+                     for start, end, score in zip(nbest_start_batch[ex_idx].tolist(), nbest_end_batch[ex_idx].tolist(), nbest_score_batch[ex_idx].tolist())
+                     if score >= 0]
+
+        window_predictions.append((batch.uuids[ex_idx], batch.num_windows[ex_idx], pred_score, pred_ans, nbest))
+
+    return window_predictions
+
+
+def combine_window_predictions(batch_predictions, n_best_size):
+    """
+    Combines the predictions for the windows of each context.
+
+    Inputs:
+      batch_predictions: iterable of lists of (uuid, num_windows, score, answer, nbest) tuples,
+        as returned by predict_batch, in batch order.
+      n_best_size: int
+
+    Yields:
+      (uuid, answer, nbest) triples, as soon as all the windows of the context have been seen.
+        answer is the most likely answer over all windows (the first one, in case of ties).
+        If n_best_size > 0, nbest is the merged list of n-best answers (see merge_nbest).
+        Otherwise nbest is None.
+    """
+    # Maps uuid to [number of windows seen so far, best probability, best answer, n-best answers]
+    # for examples whose context windows have not all been seen yet
+    pending = {}
+
+    for window_predictions in batch_predictions:
+        for uuid, num_windows, score, answer, nbest in window_predictions:
+            prediction = pending.setdefault(uuid, [0, None, None, []])
+            prediction[0] += 1
+
+            # Keep the most likely answer over all windows of the context
+            if prediction[1] is None or score > prediction[1]:
+                prediction[1] = score
+                prediction[2] = answer
+
+            if nbest is not None:
+                prediction[3].extend(nbest)
+
+            # Once all the windows of the context have been seen, the prediction is final
+            if prediction[0] == num_windows:
+                del pending[uuid]
+                yield uuid, prediction[2], merge_nbest(prediction[3], n_best_size) if n_best_size > 0 else None
+
+
+def predict_answers(session, model, word2id, examples):
+    """
+    Given a model, and an iterable of (context, question) pairs, each with a unique ID,
+    use the model to predict an answer for each pair.
+
+    This is a generator: examples are read, batched and predicted a pool of
+    batches at a time, so memory use does not depend on the number of examples.
+    Answers are yielded as soon as they are final, which is not necessarily in input order.
+
+    If model.FLAGS.window_len > 0, long contexts are split into overlapping windows,
+    and the answer is the most likely span over all the windows.
+
+    Inputs:
+      session: TensorFlow session
+      model: QAModel
+      word2id: dictionary mapping word (string) to word id (int)
+      examples: iterable of (uuid, context_tokens, qn_tokens) triples
+
+    Yields:
+      (uuid, answer, nbest) triples.
+        answer is the predicted answer (string; detokenized).
+        If model.FLAGS.n_best_size > 0, nbest is a list of dictionaries
+        {"text", "start", "end", "probability"}, sorted by decreasing probability.
+        start and end are token positions in the full context. Otherwise nbest is None.
+    """
+    detokenizer = MosesDetokenizer()
+
+    # Questions about the same paragraph are consecutive, so we can run the
+    # context encoder once per paragraph and reuse its output for all of them
+    context_cache = {} if model.FLAGS.cache_context_encodings else None
+
+    # With --prefetch_batches, the examples are read and batched in the background
+    batch_fn = lambda: get_batch_generator(word2id, examples, model.FLAGS.batch_size, model.FLAGS.context_len, model.FLAGS.question_len, model.FLAGS.word_len, model.FLAGS.max_batch_tokens, model.FLAGS.window_len, model.FLAGS.window_stride,
+                                           num_buffers=model.FLAGS.prefetch_batches + 2, pool_size=model.FLAGS.batch_pool_size)
+    batches = BatchPrefetcher(batch_fn, model.FLAGS.prefetch_batches, model.FLAGS.prefetch_process)
+    batch_predictions = (predict_batch(session, model, batch, detokenizer, context_cache) for batch in batches)
+
+    for prediction in combine_window_predictions(batch_predictions, model.FLAGS.n_best_size):
+        yield prediction
+    print "Waited %.2f seconds for data over %i batches" % (batches.total_wait_time, batches.num_batches)
+
+
+def predict_answers_with_cache(session, model, word2id, paragraphs, cache):
+    """
+    Like predict_answers, but reads untokenized paragraphs and looks them up in a PredictionCache.
+    Each context is tokenized and mapped to ids only if it isn't cached, and
+    questions whose answer is cached skip the model.
+
+    The paragraphs are processed in chunks of model.FLAGS.batch_size * 160 questions,
+    so memory use does not depend on the number of examples.
+
+    Inputs:
+      session: TensorFlow session
+      model: QAModel
+      word2id: dictionary mapping word (string) to word id (int)
+      paragraphs: iterable of (context, qas) pairs (see iter_dataset_paragraphs)
+      cache: PredictionCache
+
+    Yields:
+      (uuid, answer, nbest) triples (see predict_answers)
+    """
+    chunk_size = model.FLAGS.batch_size * 160
+    chunk = [] # list of (uuid, context hash, question, context_tokens, context_ids)
+
+    for context, qas in paragraphs:
+        key, context_tokens, context_ids = cache.get_context(context)
+        for qn in qas:
+            chunk.append((qn['id'], key, unicode(qn['question']), context_tokens, context_ids))
+
+        if len(chunk) >= chunk_size:
+            for prediction in predict_chunk_with_cache(session, model, word2id, chunk, cache):
+                yield prediction
+            chunk = []
+
+    for prediction in predict_chunk_with_cache(session, model, word2id, chunk, cache):
+        yield prediction
+
+
+def predict_chunk_with_cache(session, model, word2id, chunk, cache):
+    """Yields the cached answers in chunk, then predicts (and caches) the others. See predict_answers_with_cache."""
+    uuid2question = {} # maps uuid to (context hash, question) for the questions that aren't cached
+    examples = []
+
+    for uuid, key, question, context_tokens, context_ids in chunk:
+        cached = cache.get_answer(key, question)
+        if cached is not None:
+            answer, nbest = cached
+            yield uuid, answer, nbest
+        else:
+            uuid2question[uuid] = (key, question)
+            examples.append((uuid, context_tokens, tokenize(question), context_ids))
+
+    for uuid, answer, nbest in predict_answers(session, model, word2id, examples):
+        key, question = uuid2question[uuid]
+        cache.put_answer(key, question, answer, nbest)
+        yield uuid, answer, nbest
+
+
 def generate_answers(session, model, word2id, qn_uuid_data, context_token_data, qn_token_data):
     """
     Given a model, and a set of (context, question) pairs, each with a unique ID,
     use the model to generate an answer for each pair, and return a dictionary mapping
     each unique ID to the generated answer.
 
+    If model.FLAGS.n_best_size > 0, also returns the n_best most likely answers
+    for each unique ID, with their joint probabilities.
+
     Inputs:
       session: TensorFlow session
       model: QAModel
@@ -262,47 +628,112 @@ def generate_answers(session, model, word2id, qn_uuid_data, context_token_data,
       qn_uuid_data, context_token_data, qn_token_data: lists
 
     Outputs:
-      uuid2ans: dictionary mapping uuid (string) to predicted answer (string; detokenized)
+      uuid2ans: dictionary mapping uuid (string) to predicted answer (string; detokenized).
+        Ordered like qn_uuid_data (the examples are sorted by length for batching).
+      uuid2nbest: dictionary mapping uuid (string) to a list of dictionaries
+        {"text", "start", "end", "probability"}, sorted by decreasing probability.
+        start and end are token positions in the full context.
+        Empty if model.FLAGS.n_best_size is 0.
+    """
+    print "Generating answers..."
+
+    examples = izip(qn_uuid_data, context_token_data, qn_token_data)
+    return collect_answers(predict_answers(session, model, word2id, examples), qn_uuid_data)
+
+
+def collect_answers(answers, qn_uuid_data):
+    """
+    Collects the answers yielded by predict_answers (or combine_window_predictions)
+    into dictionaries, in the order of qn_uuid_data.
+
+    Returns:
+      uuid2ans, uuid2nbest: see generate_answers
     """
     uuid2ans = {} # maps uuid to string containing predicted answer
+    uuid2nbest = {} # maps uuid to list of n-best answers
     data_size = len(qn_uuid_data)
-    num_batches = ((data_size-1) / model.FLAGS.batch_size) + 1
-    batch_num = 0
-    detokenizer = MosesDetokenizer()
 
-    print "Generating answers..."
+    for uuid, answer, nbest in answers:
+        uuid2ans[uuid] = answer
+        if nbest is not None:
+            uuid2nbest[uuid] = nbest
 
-    for batch in get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, model.FLAGS.batch_size, model.FLAGS.context_len, model.FLAGS.question_len, model.FLAGS.word_len):
+        if len(uuid2ans) % 1000 == 0:
+            print "Generated answers for %i/%i examples = %.2f%%" % (len(uuid2ans), data_size, len(uuid2ans)*100.0/data_size)
 
-        # Get the predicted spans
-        pred_start_batch, pred_end_batch = model.get_start_end_pos(session, batch)
+    print "Finished generating answers for dataset."
 
-        # Convert pred_start_batch and pred_end_batch to lists length batch_size
-        pred_start_batch = pred_start_batch.tolist()
-        pred_end_batch = pred_end_batch.tolist()
+    # Restore the original order of the examples
+    uuid2ans = OrderedDict((uuid, uuid2ans[uuid]) for uuid in qn_uuid_data)
+    if uuid2nbest:
+        uuid2nbest = OrderedDict((uuid, uuid2nbest[uuid]) for uuid in qn_uuid_data)
 
-        # For each example in the batch:
-        for ex_idx, (pred_start, pred_end) in enumerate(zip(pred_start_batch, pred_end_batch)):
+    return uuid2ans, uuid2nbest
 
-            # Original context tokens (no UNKs or padding) for this example
-            context_tokens = batch.context_tokens[ex_idx] # list of strings
 
-            # Check the predicted span is in range
-            assert pred_start in range(len(context_tokens))
-            assert pred_end in range(len(context_tokens))
+def stream_answers(session, model, word2id, in_filename, out_filename, cache=None):
+    """
+    Reads (context, question) pairs from in_filename, predicts their answers, and writes
+    them to out_filename as they are produced, one JSON object per line:
+      {"id": ..., "answer": ...} (plus "nbest": [...] if model.FLAGS.n_best_size > 0)
 
-            # Predicted answer tokens
-            pred_ans_tokens = context_tokens[pred_start : pred_end +1] # list of strings
+    Input files ending in .jsonl are read one line at a time (see iter_jsonl_paragraphs),
+    so memory use doesn't depend on the input size. Other files are read as SQuAD JSON;
+    the raw JSON is loaded, but it is tokenized and predicted one article at a time.
 
-            # Detokenize and add to dict
-            uuid = batch.uuids[ex_idx]
-            uuid2ans[uuid] = detokenizer.detokenize(pred_ans_tokens, return_str=True)
+    If cache (a PredictionCache) is given, contexts and answers are looked up in it first.
 
-        batch_num += 1
+    Returns:
+      The number of answers written.
+    """
+    # Check the data file exists
+    if not os.path.exists(in_filename):
+        raise Exception("Input file does not exist: %s" % in_filename)
 
-        if batch_num % 10 == 0:
-            print "Generated answers for %i/%i batches = %.2f%%" % (batch_num, num_batches, batch_num*100.0/num_batches)
+    if in_filename.endswith(".jsonl"):
+        paragraphs = iter_jsonl_paragraphs(in_filename)
+    else:
+        paragraphs = iter_dataset_paragraphs(data_from_json(in_filename))
+
+    if cache is not None:
+        answers = predict_answers_with_cache(session, model, word2id, paragraphs, cache)
+    else:
+        answers = predict_answers(session, model, word2id, iter_examples(paragraphs))
+
+    num_written = 0
+    with io.open(out_filename, 'w', encoding='utf-8') as f:
+        for uuid, answer, nbest in answers:
+            prediction = {"id": uuid, "answer": answer}
+            if nbest is not None:
+                prediction["nbest"] = nbest
+            f.write(unicode(json.dumps(prediction, ensure_ascii=False)) + u"\n")
+            num_written += 1
+
+            if num_written % 1000 == 0:
+                print "Wrote answers for %i examples" % num_written
+
+    return num_written
 
-    print "Finished generating answers for dataset."
 
-    return uuid2ans
+def merge_nbest(nbest, n_best_size):
+    """
+    Merges the n-best answers from the windows of a context.
+
+    Inputs:
+      nbest: list of dictionaries {"text", "start", "end", "probability"}
+      n_best_size: int
+
+    Returns:
+      The n_best_size most likely answers in nbest, with duplicate spans
+      (from overlapping windows) removed, sorted by decreasing probability.
+    """
+    merged = []
+    seen = set()
+    for answer in sorted(nbest, key=lambda a: -a["probability"]):
+        span = (answer["start"], answer["end"])
+        if span not in seen:
+            seen.add(span)
+            merged.append(answer)
+            if len(merged) == n_best_size:
+                break
+    return merged
@@ -0,0 +1,192 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains a bounded LRU cache for repeated inference queries.
+It is used by the official_eval, stream_eval and serve modes in main.py (see --prediction_cache_size)."""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import hashlib
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+
+import numpy as np
+
+# Bumped when the cached entries or what the signatures cover change, so that older cache files are ignored
+CACHE_FORMAT = 4
+
+
+def approx_size(obj):
+    """Roughly estimates the memory (bytes) used by obj, which is made of containers, strings, numbers and numpy arrays"""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (str, unicode)):
+        return 40 + len(obj) * (4 if isinstance(obj, unicode) else 1)
+    if isinstance(obj, (list, tuple)):
+        return 64 + 8 * len(obj) + sum(approx_size(item) for item in obj)
+    if isinstance(obj, dict):
+        return 280 + sum(approx_size(k) + approx_size(v) for k, v in obj.items())
+    return 24
+
+
+class LRUCache(object):
+    """
+    A thread-safe least-recently-used cache, bounded by number of entries and/or (approximate) bytes.
+    """
+
+    def __init__(self, max_entries=0, max_bytes=0):
+        """
+        Inputs:
+          max_entries: int. If > 0, the maximum number of entries.
+          max_bytes: int. If > 0, the maximum total size of the entries (see approx_size).
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # maps key to (value, size), least recently used first
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns the value for key (and marks it as most recently used), or None if it isn't cached"""
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Adds (or replaces) an entry, then evicts least recently used entries until the cache is within its bounds"""
+        size = approx_size(key) + approx_size(value)
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.num_bytes -= old_entry[1]
+            self.entries[key] = (value, size)
+            self.num_bytes += size
+            while self.entries and ((self.max_entries > 0 and len(self.entries) > self.max_entries) or (self.max_bytes > 0 and self.num_bytes > self.max_bytes)):
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.num_bytes -= evicted_size
+                self.evictions += 1
+
+    def items(self):
+        """Returns a list of (key, value) pairs, least recently used first"""
+        with self.lock:
+            return [(key, value) for key, (value, _) in self.entries.items()]
+
+    def stats(self):
+        """Returns the counters as a dictionary"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self.entries), "bytes": self.num_bytes, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "hit_rate": self.hits / lookups if lookups else None}
+
+
+def context_key(context):
+    """Returns a hash (string) of a context string"""
+    return hashlib.sha1(context.encode('utf-8') if isinstance(context, unicode) else context).hexdigest()
+
+
+class PredictionCache(object):
+    """
+    A two-level cache for inference queries:
+      contexts: maps a context hash to (context_tokens, context_ids),
+        so each distinct paragraph is tokenized and mapped to ids once.
+      answers: maps (context hash, question string) to (answer, nbest),
+        so repeated (context, question) pairs skip the model entirely.
+
+    The cache can be saved to and loaded from a pickle file. The file records a signature
+    (e.g. the checkpoint and the flags that change the predictions), and is ignored
+    if the signature doesn't match.
+    """
+
+    def __init__(self, word2id, tokenize_fn, ids_fn, max_entries=0, max_bytes=0, path="", signature=None):
+        """
+        Inputs:
+          word2id: dictionary mapping word (string) to word id (int)
+          tokenize_fn: function mapping a context string to a list of tokens
+          ids_fn: function mapping (tokens, word2id) to ids
+          max_entries, max_bytes: ints. Bounds for each level (see LRUCache).
+          path: string. If not empty, the file to load the cache from (if it exists) and save it to.
+          signature: anything picklable that identifies the model and settings the answers come from.
+        """
+        self.word2id = word2id
+        self.tokenize_fn = tokenize_fn
+        self.ids_fn = ids_fn
+        self.path = path
+        self.signature = signature
+        self.contexts = LRUCache(max_entries, max_bytes)
+        self.answers = LRUCache(max_entries, max_bytes)
+
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def get_context(self, context):
+        """
+        Returns (key, context_tokens, context_ids) for a context string,
+        tokenizing it only if it isn't cached.
+        """
+        key = context_key(context)
+        entry = self.contexts.get(key)
+        if entry is None:
+            context_tokens = self.tokenize_fn(context)
+            entry = (context_tokens, self.ids_fn(context_tokens, self.word2id))
+            self.contexts.put(key, entry)
+        return (key,) + entry
+
+    def get_answer(self, key, question):
+        """Returns the cached (answer, nbest) for a context hash and a question string, or None"""
+        return self.answers.get((key, question))
+
+    def put_answer(self, key, question, answer, nbest):
+        self.answers.put((key, question), (answer, nbest))
+
+    def stats(self):
+        return {"contexts": self.contexts.stats(), "answers": self.answers.stats()}
+
+    def save(self, path=None):
+        """Saves both levels (most recently used entries last) to path (defaults to self.path)"""
+        path = path or self.path
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({"format": CACHE_FORMAT, "signature": self.signature, "contexts": self.contexts.items(), "answers": self.answers.items()}, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        print "Saved prediction cache (%i contexts, %i answers) to %s" % (len(self.contexts), len(self.answers), path)
+
+    def load(self, path):
+        """Adds the entries saved in path, unless they were made with a different signature"""
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if data.get("format") != CACHE_FORMAT:
+            print "Ignoring prediction cache %s: it was made with an older version of this code" % path
+            return
+        if data["signature"] != self.signature:
+            print "Ignoring prediction cache %s: it was made with a different model or settings" % path
+            return
+        for key, value in data["contexts"]:
+            self.contexts.put(key, value)
+        for key, value in data["answers"]:
+            self.answers.put(key, value)
+        print "Loaded prediction cache (%i contexts, %i answers) from %s" % (len(self.contexts), len(self.answers), path)
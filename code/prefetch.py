@@ -0,0 +1,153 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains a wrapper that makes batches in the background (see --prefetch_batches),
+so that reading and padding the next batches overlaps with session.run on the current one"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import sys
+import time
+import threading
+import traceback
+import multiprocessing
+import Queue
+
+
+class BatchPrefetcher(object):
+    """
+    Iterates over the batches made by batch_fn(), which returns a batch generator.
+
+    If depth > 0, the generator is run by a worker thread (or process), which keeps
+    up to depth batches ready in a bounded queue. If depth is 0, the batches are made
+    on demand in the calling thread, as before.
+
+    Either way, the time spent waiting for each batch is recorded:
+      wait_time: float. Seconds spent waiting for the most recent batch.
+      total_wait_time: float. Seconds spent waiting, over all the batches so far.
+      num_batches: int. Number of batches so far.
+    """
+
+    def __init__(self, batch_fn, depth=0, use_process=False):
+        """
+        Inputs:
+          batch_fn: function with no arguments that returns a generator of batches
+          depth: int. Maximum number of batches made ahead. 0 means no prefetching.
+          use_process: bool. If True, make the batches in a worker process instead of a thread,
+            so that making them doesn't compete with the training loop for the GIL.
+            The batches are then pickled to be sent back.
+            Daemonic processes (e.g. multiprocessing.Pool workers) can't have children, so they use a thread.
+        """
+        self.batch_fn = batch_fn
+        self.depth = depth
+        self.use_process = use_process and not multiprocessing.current_process().daemon
+        self.wait_time = 0.
+        self.total_wait_time = 0.
+        self.num_batches = 0
+        self.worker = None
+
+    def __iter__(self):
+        if self.depth <= 0:
+            return self.iter_sync()
+        return self.iter_prefetch()
+
+    def record_wait(self, tic):
+        self.wait_time = time.time() - tic
+        self.total_wait_time += self.wait_time
+        self.num_batches += 1
+
+    def iter_sync(self):
+        batches = self.batch_fn()
+        while True:
+            tic = time.time()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            self.record_wait(tic)
+            yield batch
+
+    def iter_prefetch(self):
+        if self.use_process:
+            self.queue = multiprocessing.Queue(self.depth)
+            self.stop_event = multiprocessing.Event()
+            self.worker = multiprocessing.Process(target=self.produce)
+        else:
+            self.queue = Queue.Queue(self.depth)
+            self.stop_event = threading.Event()
+            self.worker = threading.Thread(target=self.produce)
+        self.worker.daemon = True
+        self.worker.start()
+
+        try:
+            while True:
+                tic = time.time()
+                kind, item = self.get()
+                if kind == "end":
+                    return
+                if kind == "error":
+                    raise Exception("Making batches failed:\n%s" % item)
+                self.record_wait(tic)
+                yield item
+        finally:
+            # Also runs if the caller stops early (e.g. check_f1_em with num_samples)
+            self.close()
+
+    def get(self):
+        """Returns the next (kind, item) pair from the queue, checking that the worker is still alive"""
+        while True:
+            try:
+                return self.queue.get(timeout=1.0)
+            except Queue.Empty:
+                if not self.worker.is_alive():
+                    # The worker may have put its last item just before exiting
+                    try:
+                        return self.queue.get(timeout=1.0)
+                    except Queue.Empty:
+                        return "error", "The batch worker exited unexpectedly"
+
+    def put(self, kind, item):
+        """Puts (kind, item) on the queue, waiting while it's full. Returns False if the prefetcher was closed."""
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put((kind, item), timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce(self):
+        """Runs in the worker: puts ("batch", batch) for each batch, then ("end", None), or ("error", traceback)"""
+        try:
+            for batch in self.batch_fn():
+                if not self.put("batch", batch):
+                    return
+            self.put("end", None)
+        except Exception:
+            self.put("error", traceback.format_exc())
+        finally:
+            if self.use_process:
+                sys.stdout.flush()
+
+    def close(self):
+        """Stops the worker, if there is one"""
+        if self.worker is None:
+            return
+        self.stop_event.set()
+        if self.use_process:
+            self.worker.terminate()
+            self.queue.close()
+        self.worker.join()
+        self.worker = None
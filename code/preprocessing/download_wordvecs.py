@@ -12,16 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Downloads the GloVe vectors and unzips them"""
+"""Downloads the GloVe vectors and unzips them.
+With --embedding_size, only that dimension is converted, straight from the zip file
+to the binary cache read by vocab.get_glove (no .txt file is extracted)."""
 
 import zipfile
 import argparse
 import os
+import sys
 from squad_preprocess import maybe_download
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # for vocab.py
+from vocab import get_glove_cache_paths, write_glove_cache
+
 def setup_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--download_dir", required=True) # where to put the downloaded glove files
+    parser.add_argument("--embedding_size", type=int, default=0) # if set, only convert glove.6B.{embedding_size}d.txt to the binary cache
     return parser.parse_args()
 
 
@@ -38,7 +45,17 @@ def main():
     maybe_download(glove_base_url, glove_filename, args.download_dir, 862182613L)
     glove_zip_ref = zipfile.ZipFile(os.path.join(args.download_dir, glove_filename), 'r')
 
-    glove_zip_ref.extractall(args.download_dir)
+    if args.embedding_size:
+        # Stream the one member we need from the zip file into the cache
+        member = "glove.6B.{}d.txt".format(args.embedding_size)
+        if member not in glove_zip_ref.namelist():
+            raise Exception("There is no %s in %s" % (member, glove_filename))
+        emb_path, vocab_path = get_glove_cache_paths(os.path.join(args.download_dir, member))
+        print "Converting {} to {} and {}".format(member, emb_path, vocab_path)
+        with glove_zip_ref.open(member) as lines:
+            write_glove_cache(lines, args.embedding_size, member, emb_path, vocab_path)
+    else:
+        glove_zip_ref.extractall(args.download_dir)
     glove_zip_ref.close()
 
 
@@ -43,7 +43,7 @@ def magentaback(s):
 
 
 
-def print_example(word2id, context_tokens, qn_tokens, true_ans_start, true_ans_end, pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em):
+def print_example(word2id, context_tokens, qn_tokens, true_ans_start, true_ans_end, pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em, nbest=None):
     """
     Pretty-print the results for one example.
 
@@ -55,6 +55,7 @@ def print_example(word2id, context_tokens, qn_tokens, true_ans_start, true_ans_e
       true_answer, pred_answer: strings
       f1: float
       em: bool
+      nbest: optional list of (answer, probability) pairs, sorted by decreasing probability
     """
     # Get the length (no padding) of this context
     curr_context_len = len(context_tokens)
@@ -94,6 +95,9 @@ def print_example(word2id, context_tokens, qn_tokens, true_ans_start, true_ans_e
     else:
         print yellowtext("{:>20}: {}".format("TRUE ANSWER", true_answer))
     print yellowtext("{:>20}: {}".format("PREDICTED ANSWER", pred_answer))
+    if nbest:
+        for rank, (answer, prob) in enumerate(nbest):
+            print yellowtext("{:>20}: {:.4f} {}".format("N-BEST #%i" % (rank + 1), prob, answer))
     print yellowtext("{:>20}: {:4.3f}".format("F1 SCORE ANSWER", f1))
     print yellowtext("{:>20}: {}".format("EM SCORE", em))
     print ""
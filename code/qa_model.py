@@ -21,20 +21,33 @@ import time
 import logging
 import os
 import sys
+import json
 
 import numpy as np
 import tensorflow as tf
 from tensorflow.python.ops import variable_scope as vs
 from tensorflow.python.ops import embedding_ops
+from tensorflow.python.framework import tensor_util
+from tensorflow.tools.graph_transforms import TransformGraph
 
 from evaluate import exact_match_score, f1_score
-from data_batcher import get_batch_generator
+from data_batcher import get_batch_generator, PaddingStats
+from prefetch import BatchPrefetcher
+import data_shards
 from pretty_print import print_example
+from span_decoder import get_nbest_spans
 from modules import RNNEncoder, SimpleSoftmaxLayer, BasicAttn, CoAttn, BidafAttn
 from vocab import CHAR_PAD_ID
+from quantization import quantize_int8
 
 logging.basicConfig(level=logging.INFO)
 
+# Flags that an exported inference graph depends on (see QAModel.export_frozen_graph)
+EXPORT_FLAGS = ["embedding_size", "hidden_size", "word_len", "dedup_char_words", "max_answer_len"]
+
+# Collection of the (non-trainable) embedding variables, which aren't in tf.GraphKeys.GLOBAL_VARIABLES
+EMBEDDING_VARIABLES = "embedding_variables"
+
 
 class QAModel(object):
     """Top-level Question Answering module"""
@@ -45,7 +58,7 @@ class QAModel(object):
 
         Inputs:
           FLAGS: the flags passed in from main.py
-          id2word: dictionary mapping word idx (int) to word (string)
+          id2word: numpy array mapping word idx (int) to word (string)
           word2id: dictionary mapping word (string) to word idx (int)
           emb_matrix: numpy array shape (400002, embedding_size) containing pre-traing GloVe embeddings
         """
@@ -54,29 +67,54 @@ class QAModel(object):
         self.id2word = id2word
         self.word2id = word2id
 
+        # The loss, gradients and optimizer are only needed for training
+        self.is_training = FLAGS.mode == "train"
+
         # Add all parts of the graph
         with tf.variable_scope("QAModel", initializer=tf.contrib.layers.variance_scaling_initializer(factor=1.0, uniform=True)):
             self.add_placeholders()
             self.add_embedding_layer(emb_matrix)
             self.build_graph()
-            self.add_loss()
+            self.add_span_decoding()
+            if self.is_training:
+                self.add_loss()
+
+        if self.is_training:
+            self.add_train_ops()
+        else:
+            # Only the weights are needed at inference time
+            # (the optimizer's slot variables and global_step in the checkpoint are not restored)
+            self.saver = tf.train.Saver(self.get_checkpoint_variables(), max_to_keep=1)
+
+
+    def get_checkpoint_variables(self):
+        """
+        Returns the variables to save in (and restore from) checkpoints.
+        The embedding variables aren't in tf.global_variables(), and are only included with --save_embeddings.
+        """
+        return tf.global_variables() + (self.embedding_vars if self.FLAGS.save_embeddings else [])
 
+
+    def add_train_ops(self):
+        """
+        Adds the gradient update, savers and summaries to the graph. Only used in train mode.
+        """
         # Define trainable parameters, gradient, gradient norm, and clip by gradient norm
         params = tf.trainable_variables()
         gradients = tf.gradients(self.loss, params)
         self.gradient_norm = tf.global_norm(gradients)
-        clipped_gradients, _ = tf.clip_by_global_norm(gradients, FLAGS.max_gradient_norm)
+        clipped_gradients, _ = tf.clip_by_global_norm(gradients, self.FLAGS.max_gradient_norm)
         self.param_norm = tf.global_norm(params)
 
         # Define optimizer and updates
         # (updates is what you need to fetch in session.run to do a gradient update)
         self.global_step = tf.Variable(0, name="global_step", trainable=False)
-        opt = tf.train.AdamOptimizer(learning_rate=FLAGS.learning_rate) # you can try other optimizers
+        opt = tf.train.AdamOptimizer(learning_rate=self.FLAGS.learning_rate) # you can try other optimizers
         self.updates = opt.apply_gradients(zip(clipped_gradients, params), global_step=self.global_step)
 
         # Define savers (for checkpointing) and summaries (for tensorboard)
-        self.saver = tf.train.Saver(tf.global_variables(), max_to_keep=FLAGS.keep)
-        self.bestmodel_saver = tf.train.Saver(tf.global_variables(), max_to_keep=1)
+        self.saver = tf.train.Saver(self.get_checkpoint_variables(), max_to_keep=self.FLAGS.keep)
+        self.bestmodel_saver = tf.train.Saver(self.get_checkpoint_variables(), max_to_keep=1)
         self.summaries = tf.summary.merge_all()
 
 
@@ -85,59 +123,132 @@ class QAModel(object):
         Add placeholders to the graph. Placeholders are used to feed in inputs.
         """
         # Add placeholders for inputs.
-        # These are all batch-first: the None corresponds to batch_size and
-        # allows you to run the same model with variable batch_size
-        self.context_ids = tf.placeholder(tf.int32, shape=[None, self.FLAGS.context_len])
-        self.context_mask = tf.placeholder(tf.int32, shape=[None, self.FLAGS.context_len])
-        self.qn_ids = tf.placeholder(tf.int32, shape=[None, self.FLAGS.question_len])
-        self.qn_mask = tf.placeholder(tf.int32, shape=[None, self.FLAGS.question_len])
-        self.ans_span = tf.placeholder(tf.int32, shape=[None, 2])
-        self.context_char_ids = tf.placeholder(tf.int32, shape=[None, self.FLAGS.context_len * self.FLAGS.word_len])
-        self.qn_char_ids = tf.placeholder(tf.int32, shape=[None, self.FLAGS.question_len * self.FLAGS.word_len])
+        # These are all batch-first: the first None corresponds to batch_size and
+        # allows you to run the same model with variable batch_size.
+        # The second None is the sequence length: each batch is only padded to its longest
+        # context / question (at most context_len / question_len).
+        # The placeholders are named so that they can be found in an exported graph (see FrozenQAModel).
+        self.context_ids = tf.placeholder(tf.int32, shape=[None, None], name="context_ids")
+        self.context_lens = tf.placeholder(tf.int32, shape=[None], name="context_lens")
+        self.qn_ids = tf.placeholder(tf.int32, shape=[None, None], name="qn_ids")
+        self.qn_lens = tf.placeholder(tf.int32, shape=[None], name="qn_lens")
+        self.ans_span = tf.placeholder(tf.int32, shape=[None, 2], name="ans_span")
+        self.context_char_ids = tf.placeholder(tf.uint8, shape=[None, None], name="context_char_ids") # shape (batch_size, seq_len * word_len)
+        self.qn_char_ids = tf.placeholder(tf.uint8, shape=[None, None], name="qn_char_ids")
+
+        # The masks (1s where there is real data, 0s where there is padding) are made from the lengths.
+        # Note: context_ids is fed even when context_hiddens is (see get_inference_feed), for its shape.
+        self.context_mask = tf.sequence_mask(self.context_lens, tf.shape(self.context_ids)[1], dtype=tf.int32, name="context_mask") # shape (batch_size, seq_len)
+        self.qn_mask = tf.sequence_mask(self.qn_lens, tf.shape(self.qn_ids)[1], dtype=tf.int32, name="qn_mask")
+
+        # With --dedup_char_words, the char ids are given once per unique word in the batch
+        # (shape (num_unique_words, word_len)), with the index of each token's word.
+        # These are used instead of context_char_ids and qn_char_ids.
+        self.context_words = tf.placeholder(tf.uint8, shape=[None, self.FLAGS.word_len], name="context_words")
+        self.context_word_idx = tf.placeholder(tf.int32, shape=[None, None], name="context_word_idx")
+        self.qn_words = tf.placeholder(tf.uint8, shape=[None, self.FLAGS.word_len], name="qn_words")
+        self.qn_word_idx = tf.placeholder(tf.int32, shape=[None, None], name="qn_word_idx")
 
 
         # Add a placeholder to feed in the keep probability (for dropout).
         # This is necessary so that we can instruct the model to use dropout when training, but not when testing
-        self.keep_prob = tf.placeholder_with_default(1.0, shape=())
+        self.keep_prob = tf.placeholder_with_default(1.0, shape=(), name="keep_prob")
 
 
     def add_embedding_layer(self, emb_matrix):
         """
         Adds word embedding layer to the graph.
 
+        The embedding matrix is held in non-trainable variables, which are set by feeding
+        their values once (see init_embeddings), so it isn't stored in the GraphDef.
+        They aren't in tf.global_variables(): they are left out of checkpoints unless --save_embeddings is set.
+
         Inputs:
           emb_matrix: shape (400002, embedding_size).
             The GloVe vectors, plus vectors for PAD and UNK.
         """
         with vs.variable_scope("embeddings"):
 
-            # Note: the embedding matrix is a tf.constant which means it's not a trainable parameter
-            embedding_matrix = tf.constant(emb_matrix, dtype=tf.float32, name="emb_matrix") # shape (400002, embedding_size)
+            # The values are only computed when they're fed in (see init_embeddings), so the model doesn't keep a copy
+            get_values = lambda: get_embedding_values(emb_matrix, self.FLAGS.quantize_embeddings)
+            if self.FLAGS.quantize_embeddings:
+                # Store the embedding matrix as int8, with one scale per row,
+                # and only dequantize the rows that are looked up
+                embedding_matrix, embedding_scales = self.add_embedding_variables(["emb_matrix_int8", "emb_scales"], [tf.int8, tf.float32], [emb_matrix.shape, (emb_matrix.shape[0], 1)], get_values) # shapes (400002, embedding_size) and (400002, 1)
+                lookup = lambda ids: tf.cast(tf.gather(embedding_matrix, ids), tf.float32) * tf.gather(embedding_scales, ids)
+            else:
+                embedding_matrix, = self.add_embedding_variables(["emb_matrix"], [tf.float32], [emb_matrix.shape], get_values) # shape (400002, embedding_size)
+                lookup = lambda ids: embedding_ops.embedding_lookup(embedding_matrix, ids)
+            self.embedding_bytes = sum(var.get_shape().num_elements() * var.dtype.base_dtype.size for var in self.embedding_vars)
 
             # Get the word embeddings for the context and question,
             # using the placeholders self.context_ids and self.qn_ids
-            self.context_embs = embedding_ops.embedding_lookup(embedding_matrix, self.context_ids) # shape (batch_size, context_len, embedding_size)
-            self.qn_embs = embedding_ops.embedding_lookup(embedding_matrix, self.qn_ids) # shape (batch_size, question_len, embedding_size)
+            self.context_embs = lookup(self.context_ids) # shape (batch_size, context_len, embedding_size)
+            self.qn_embs = lookup(self.qn_ids) # shape (batch_size, question_len, embedding_size)
 
             char_emb_matrix = tf.get_variable(name="char_emb_matrix",
                                               shape=[CHAR_PAD_ID +  2, self.FLAGS.char_embedding_size],
                                               initializer=tf.contrib.layers.xavier_initializer())
 
-            # shape : batch_size , self.FLAGS.context_len * self.FLAGS.word_len, char_embedding_size
-            self.context_char_embs = embedding_ops.embedding_lookup(char_emb_matrix, self.context_char_ids)
+            # The char ids are fed as uint8
+            char_lookup = lambda char_ids: embedding_ops.embedding_lookup(char_emb_matrix, tf.cast(char_ids, tf.int32))
+
+            if self.FLAGS.dedup_char_words:
+                # shape : num_unique_words, word_len, char_embedding_size
+                self.context_char_embs = char_lookup(self.context_words)
+                self.qn_char_embs = char_lookup(self.qn_words)
+            else:
+                # shape : batch_size , self.FLAGS.context_len * self.FLAGS.word_len, char_embedding_size
+                self.context_char_embs = char_lookup(self.context_char_ids)
+
+                # shape = batch_size * context_len, word_len, char_embedding_size
+                self.context_char_embs = tf.reshape(self.context_char_embs,
+                                                    (-1, self.FLAGS.word_len, self.FLAGS.char_embedding_size))
+                self.qn_char_embs = char_lookup(self.qn_char_ids)
+                self.qn_char_embs = tf.reshape(self.qn_char_embs,
+                                                    (-1, self.FLAGS.word_len, self.FLAGS.char_embedding_size))
+
 
-            # shape = batch_size, context_len, word_len*char_embedding_size
-            self.context_char_embs = tf.reshape(self.context_char_embs,
-                                                (-1, self.FLAGS.word_len, self.FLAGS.char_embedding_size))
-            self.qn_char_embs = embedding_ops.embedding_lookup(char_emb_matrix, self.qn_char_ids)
-            self.qn_char_embs = tf.reshape(self.qn_char_embs,
-                                                (-1, self.FLAGS.word_len, self.FLAGS.char_embedding_size))
+    def add_embedding_variables(self, names, dtypes, shapes, get_values):
+        """
+        Adds non-trainable variables (outside of tf.global_variables()),
+        with placeholders and initializers to set them (see init_embeddings).
+        Defines self.embedding_vars, self.embedding_inits (initializers), self.embedding_feeds (placeholders)
+        and self.get_embedding_values.
+
+        Inputs:
+          names, dtypes, shapes: lists with the name, dtype and shape of each variable
+          get_values: function with no arguments that returns the list of numpy values of the variables
+
+        Returns:
+          The list of variables
+        """
+        self.embedding_vars, self.embedding_inits, self.embedding_feeds = [], [], []
+        for name, dtype, shape in zip(names, dtypes, shapes):
+            feed = tf.placeholder(dtype, shape=shape, name=name + "_feed")
+            var = tf.Variable(feed, trainable=False, collections=[EMBEDDING_VARIABLES], name=name)
+            self.embedding_vars.append(var)
+            self.embedding_inits.append(var.initializer)
+            self.embedding_feeds.append(feed)
+        self.get_embedding_values = get_values
+        return self.embedding_vars
+
+
+    def init_embeddings(self, session):
+        """
+        Sets the embedding variables, by feeding in their values.
+        The values (e.g. the int8 embedding matrix) are made again each time, and released afterwards.
+        """
+        session.run(self.embedding_inits, feed_dict=dict(zip(self.embedding_feeds, self.get_embedding_values())))
 
 
     def build_graph(self):
         """Builds the main part of the graph for the model, starting from the input embeddings to the final distributions for the answer span.
 
         Defines:
+          self.context_hiddens: Tensor shape (batch_size, context_len, hidden_size*2).
+            The question-independent context encoding. At inference time this can be
+            computed once per unique context and fed back in (see get_prob_dists).
           self.logits_start, self.logits_end: Both tensors shape (batch_size, context_len).
             These are the logits (i.e. values that are fed into the softmax function) for the start and end distribution.
             Important: these are -large in the pad locations. Necessary for when we feed into the cross entropy function.
@@ -151,21 +262,28 @@ class QAModel(object):
         encoder = RNNEncoder(self.FLAGS.hidden_size, self.keep_prob)
         context_cnn = tf.layers.conv1d(self.context_char_embs, 100, 5, activation=tf.nn.tanh, use_bias=True)
         context_cnn_maxpool = tf.reduce_max(context_cnn, axis=1, keep_dims=True)
-        context_cnn_maxpool = tf.reshape(context_cnn_maxpool, (-1, self.FLAGS.context_len, 100))
-        
+
         qn_cnn = tf.layers.conv1d(self.qn_char_embs, 100, 5, activation=tf.nn.tanh, use_bias=True)
         qn_cnn_maxpool = tf.reduce_max(qn_cnn, axis=1, keep_dims=True)
-        qn_cnn_maxpool = tf.reshape(qn_cnn_maxpool, (-1, self.FLAGS.question_len, 100))
 
-        context_hiddens = encoder.build_graph(tf.concat([self.context_embs, context_cnn_maxpool], axis=2), self.context_mask) # (batch_size, context_len, hidden_size*2)
+        if self.FLAGS.dedup_char_words:
+            # The char-CNN was run once per unique word; gather the results back for each token
+            context_cnn_maxpool = tf.gather(tf.squeeze(context_cnn_maxpool, axis=1), self.context_word_idx) # (batch_size, context_len, 100)
+            qn_cnn_maxpool = tf.gather(tf.squeeze(qn_cnn_maxpool, axis=1), self.qn_word_idx) # (batch_size, question_len, 100)
+        else:
+            context_cnn_maxpool = tf.reshape(context_cnn_maxpool, tf.stack([-1, tf.shape(self.context_ids)[1], 100])) # (batch_size, context_len, 100)
+            qn_cnn_maxpool = tf.reshape(qn_cnn_maxpool, tf.stack([-1, tf.shape(self.qn_ids)[1], 100])) # (batch_size, question_len, 100)
+
+        context_hiddens = encoder.build_graph(tf.concat([self.context_embs, context_cnn_maxpool], axis=2), self.context_mask)
+        self.context_hiddens = tf.identity(context_hiddens, name="context_hiddens") # (batch_size, context_len, hidden_size*2)
         question_hiddens = encoder.build_graph(tf.concat([self.qn_embs, qn_cnn_maxpool], axis=2), self.qn_mask) # (batch_size, question_len, hidden_size*2)
 
         # Use context hidden states to attend to question hidden states
         attn_layer = CoAttn(self.keep_prob, self.FLAGS.hidden_size*2, self.FLAGS.hidden_size*2)
-        _, attn_output = attn_layer.build_graph(question_hiddens, self.qn_mask, context_hiddens, self.context_mask) # attn_output is shape (batch_size, context_len, hidden_size*2)
+        _, attn_output = attn_layer.build_graph(question_hiddens, self.qn_mask, self.context_hiddens, self.context_mask) # attn_output is shape (batch_size, context_len, hidden_size*2)
 
         # Concat attn_output to context_hiddens to get blended_reps
-        blended_reps = tf.concat([context_hiddens, attn_output], axis=2) # (batch_size, context_len, hidden_size*8)
+        blended_reps = tf.concat([self.context_hiddens, attn_output], axis=2) # (batch_size, context_len, hidden_size*8)
 
         # Apply fully connected layer to each blended representation
         # Note, blended_reps_final corresponds to b' in the handout
@@ -184,6 +302,60 @@ class QAModel(object):
             softmax_layer_end = SimpleSoftmaxLayer()
             self.logits_end, self.probdist_end = softmax_layer_end.build_graph(blended_reps_final, self.context_mask)
 
+        self.probdist_start = tf.identity(self.probdist_start, name="probdist_start")
+        self.probdist_end = tf.identity(self.probdist_end, name="probdist_end")
+
+
+    def add_span_decoding(self):
+        """
+        Adds the most likely answer span to the graph, so that only three numbers per
+        example need to be fetched: for each end position, the best start (the earliest one,
+        in case of ties), then the best end (the earliest one, in case of ties).
+        The cost is linear in context_len (times max_answer_len, if it's set).
+
+        Defines:
+          self.pred_start, self.pred_end: int32 tensors shape (batch_size).
+          self.pred_score: tensor shape (batch_size). The joint probability of each span.
+        """
+        with vs.variable_scope("SpanDecoding"):
+            max_answer_len = self.FLAGS.max_answer_len
+            start_dist, end_dist = self.probdist_start, self.probdist_end # shape (batch_size, context_len)
+            context_len = tf.shape(start_dist)[1]
+
+            if max_answer_len > 0:
+                # cand_probs[b, j, k] is the probability of the k-th candidate start for end position j,
+                # i.e. position j - (max_answer_len - 1) + k. Positions before the context start are -1.
+                padded_start_dist = tf.pad(start_dist, [[0, 0], [max_answer_len - 1, 0]], constant_values=-1.0)
+                cand_probs = tf.stack([padded_start_dist[:, k : k + context_len] for k in xrange(max_answer_len)], axis=2) # shape (batch_size, context_len, max_answer_len)
+                best_cand = tf.argmax(cand_probs, axis=2, output_type=tf.int32) # shape (batch_size, context_len)
+                best_start = tf.range(context_len) - (max_answer_len - 1) + best_cand
+
+                # Joint probability of the best span ending at each position
+                span_scores = tf.reduce_max(cand_probs, axis=2) * end_dist # shape (batch_size, context_len)
+            else:
+                # Without a length limit, the best start for end position j is a running argmax of
+                # start_dist over positions 0..j. A position only replaces the running max if it's
+                # strictly greater, so the earliest start wins ties.
+                def running_argmax(prev, inputs):
+                    prev_max, prev_argmax = prev
+                    probs, pos = inputs # shapes (batch_size) and ()
+                    is_new_max = probs > prev_max
+                    return tf.where(is_new_max, probs, prev_max), tf.where(is_new_max, tf.fill(tf.shape(prev_argmax), pos), prev_argmax)
+
+                batch_size = tf.shape(start_dist)[0]
+                initializer = (tf.fill([batch_size], -1.0), tf.zeros([batch_size], dtype=tf.int32))
+                running_max, running_argmax = tf.scan(running_argmax, (tf.transpose(start_dist), tf.range(context_len)), initializer=initializer) # shapes (context_len, batch_size)
+                best_start = tf.transpose(running_argmax) # shape (batch_size, context_len)
+
+                # Joint probability of the best span ending at each position
+                span_scores = tf.transpose(running_max) * end_dist # shape (batch_size, context_len)
+
+            end_pos = tf.argmax(span_scores, axis=1, output_type=tf.int32) # shape (batch_size)
+            rows = tf.stack([tf.range(tf.shape(end_pos)[0]), end_pos], axis=1)
+            self.pred_start = tf.gather_nd(best_start, rows, name="pred_start")
+            self.pred_end = tf.identity(end_pos, name="pred_end")
+            self.pred_score = tf.reduce_max(span_scores, axis=1, name="pred_score")
+
 
     def add_loss(self):
         """
@@ -221,6 +393,31 @@ class QAModel(object):
             tf.summary.scalar('loss', self.loss)
 
 
+    def add_context_char_feed(self, input_feed, batch, rows=None):
+        """
+        Adds the character-level context inputs to input_feed.
+
+        Inputs:
+          input_feed: dictionary mapping placeholders to values
+          batch: Batch object
+          rows: optional list of example indices. If given, only feed those examples.
+        """
+        if self.FLAGS.dedup_char_words:
+            input_feed[self.context_words] = batch.context_words
+            input_feed[self.context_word_idx] = batch.context_word_idx if rows is None else batch.context_word_idx[rows]
+        else:
+            input_feed[self.context_char_ids] = batch.context_char_ids if rows is None else batch.context_char_ids[rows]
+
+
+    def add_qn_char_feed(self, input_feed, batch):
+        """Adds the character-level question inputs to input_feed"""
+        if self.FLAGS.dedup_char_words:
+            input_feed[self.qn_words] = batch.qn_words
+            input_feed[self.qn_word_idx] = batch.qn_word_idx
+        else:
+            input_feed[self.qn_char_ids] = batch.qn_char_ids
+
+
     def run_train_iter(self, session, batch, summary_writer):
         """
         This performs a single training iteration (forward pass, loss computation, backprop, parameter update)
@@ -239,12 +436,12 @@ class QAModel(object):
         # Match up our input data with the placeholders
         input_feed = {}
         input_feed[self.context_ids] = batch.context_ids
-        input_feed[self.context_mask] = batch.context_mask
+        input_feed[self.context_lens] = batch.context_lens
         input_feed[self.qn_ids] = batch.qn_ids
-        input_feed[self.qn_mask] = batch.qn_mask
+        input_feed[self.qn_lens] = batch.qn_lens
         input_feed[self.ans_span] = batch.ans_span
-        input_feed[self.context_char_ids] = batch.context_char_ids
-        input_feed[self.qn_char_ids] = batch.qn_char_ids
+        self.add_context_char_feed(input_feed, batch)
+        self.add_qn_char_feed(input_feed, batch)
         input_feed[self.keep_prob] = 1.0 - self.FLAGS.dropout # apply dropout
 
         # output_feed contains the things we want to fetch.
@@ -273,12 +470,12 @@ class QAModel(object):
 
         input_feed = {}
         input_feed[self.context_ids] = batch.context_ids
-        input_feed[self.context_mask] = batch.context_mask
+        input_feed[self.context_lens] = batch.context_lens
         input_feed[self.qn_ids] = batch.qn_ids
-        input_feed[self.qn_mask] = batch.qn_mask
+        input_feed[self.qn_lens] = batch.qn_lens
         input_feed[self.ans_span] = batch.ans_span
-        input_feed[self.context_char_ids] = batch.context_char_ids
-        input_feed[self.qn_char_ids] = batch.qn_char_ids
+        self.add_context_char_feed(input_feed, batch)
+        self.add_qn_char_feed(input_feed, batch)
         # note you don't supply keep_prob here, so it will default to 1 i.e. no dropout
 
         output_feed = [self.loss]
@@ -289,70 +486,272 @@ class QAModel(object):
 
 
 
-    def get_prob_dists(self, session, batch):
+    def get_prob_dists(self, session, batch, context_cache=None):
         """
         Run forward-pass only; get probability distributions for start and end positions.
 
         Inputs:
           session: TensorFlow session
           batch: Batch object
+          context_cache: optional dictionary mapping a context (tuple of tokens) to its
+            context hidden states. If given, the question-independent part of the graph
+            (char-CNN and context RNNEncoder) is only run once per unique context, and the
+            result is fed in for every question about that context. The cache is updated
+            in place to hold the contexts of this batch, so that questions about the same
+            context in the next batch can reuse them.
 
         Returns:
           probdist_start and probdist_end: both shape (batch_size, context_len)
         """
+        input_feed = self.get_inference_feed(session, batch, context_cache)
+        output_feed = [self.probdist_start, self.probdist_end]
+        [probdist_start, probdist_end] = session.run(output_feed, input_feed)
+        return probdist_start, probdist_end
+
+
+    def get_inference_feed(self, session, batch, context_cache=None):
+        """
+        Returns the input_feed for a forward pass on batch (see get_prob_dists).
+        """
         input_feed = {}
         input_feed[self.context_ids] = batch.context_ids
-        input_feed[self.context_mask] = batch.context_mask
+        input_feed[self.context_lens] = batch.context_lens
         input_feed[self.qn_ids] = batch.qn_ids
-        input_feed[self.qn_mask] = batch.qn_mask
-        input_feed[self.context_char_ids] = batch.context_char_ids
-        input_feed[self.qn_char_ids] = batch.qn_char_ids
+        input_feed[self.qn_lens] = batch.qn_lens
+        self.add_qn_char_feed(input_feed, batch)
+        if context_cache is None:
+            self.add_context_char_feed(input_feed, batch)
+        else:
+            input_feed[self.context_hiddens] = self.get_cached_context_hiddens(session, batch, context_cache)
         # note you don't supply keep_prob here, so it will default to 1 i.e. no dropout
+        return input_feed
 
-        output_feed = [self.probdist_start, self.probdist_end]
-        [probdist_start, probdist_end] = session.run(output_feed, input_feed)
-        return probdist_start, probdist_end
+
+    def get_cached_context_hiddens(self, session, batch, context_cache):
+        """
+        Get the context hidden states for a batch, running the context encoder
+        only for the contexts that are not already in context_cache.
+
+        Inputs:
+          session: TensorFlow session
+          batch: Batch object
+          context_cache: dictionary mapping a context (tuple of tokens) to a numpy
+            array shape (context_len, hidden_size*2), unpadded. Updated in place.
+
+        Returns:
+          context_hiddens: numpy array shape (batch_size, context_len, hidden_size*2)
+        """
+        # Key each example by its (possibly truncated) context tokens
+        context_lens = batch.context_lens.tolist()
+        keys = [tuple(tokens[:length]) for tokens, length in zip(batch.context_tokens, context_lens)]
+
+        # Find one example for each context that isn't cached yet
+        new_rows = []
+        seen = set(context_cache)
+        for row, key in enumerate(keys):
+            if key not in seen:
+                seen.add(key)
+                new_rows.append(row)
+
+        # Run the context stage on those examples only
+        if new_rows:
+            input_feed = {}
+            input_feed[self.context_ids] = batch.context_ids[new_rows]
+            input_feed[self.context_lens] = batch.context_lens[new_rows]
+            self.add_context_char_feed(input_feed, batch, new_rows)
+            new_hiddens = session.run(self.context_hiddens, input_feed)
+            for row, hiddens in zip(new_rows, new_hiddens):
+                context_cache[keys[row]] = hiddens[:context_lens[row]]
+
+        # Gather the cached encodings back into batch order.
+        # Note: the RNN outputs are zero in the padding locations, so we pad with zeros.
+        context_hiddens = np.zeros(batch.context_ids.shape + (self.FLAGS.hidden_size * 2,), dtype=np.float32)
+        for row, key in enumerate(keys):
+            context_hiddens[row, :context_lens[row]] = context_cache[key]
+
+        # Only keep the contexts of this batch in the cache
+        for key in set(context_cache) - set(keys):
+            del context_cache[key]
+
+        return context_hiddens
+
+
+    def export_frozen_graph(self, session, frozen_graph_path, include_embeddings=True):
+        """
+        Writes the inference part of the graph to frozen_graph_path, with the weights
+        (from session) turned into constants and constant subgraphs folded.
+        The loss and training ops are not included. Load it with FrozenQAModel.
+
+        If include_embeddings is False, the embedding variables are left as variables,
+        and FrozenQAModel sets them from the embedding matrix it is given. This makes
+        the graph much smaller, but it must be loaded with the same vocabulary.
+
+        The graph also records the values of EXPORT_FLAGS, the vocabulary size and the names of the
+        tensors that FrozenQAModel needs.
+        """
+        if self.FLAGS.dedup_char_words:
+            inputs = ["context_ids", "context_lens", "qn_ids", "qn_lens", "context_words", "context_word_idx", "qn_words", "qn_word_idx"]
+        else:
+            inputs = ["context_ids", "context_lens", "qn_ids", "qn_lens", "context_char_ids", "qn_char_ids"]
+        outputs = ["context_hiddens", "probdist_start", "probdist_end", "pred_start", "pred_end", "pred_score"]
+
+        settings = {
+            "flags": dict((name, getattr(self.FLAGS, name)) for name in EXPORT_FLAGS),
+            "vocab_size": len(self.word2id),
+            "tensors": dict((attr, getattr(self, attr).name) for attr in inputs + outputs),
+            "embedding_variables": [] if include_embeddings else [var.op.name for var in self.embedding_vars],
+            "quantize_embeddings": self.FLAGS.quantize_embeddings,
+        }
+        with tf.name_scope("QAModel/"):
+            settings_node = tf.constant(json.dumps(settings), name="export_settings")
+
+        input_names = [getattr(self, attr).op.name for attr in inputs]
+        output_names = [getattr(self, attr).op.name for attr in outputs] + [settings_node.op.name]
+
+        # Turn the variables into constants, keeping only what the outputs need
+        graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), output_names,
+                                                                 variable_names_blacklist=settings["embedding_variables"])
+        graph_def = TransformGraph(graph_def, input_names, output_names, ["fold_constants(ignore_errors=true)", "sort_by_execution_order"])
+
+        # Folding can remove the (former) variables that other ops are colocated with
+        for node in graph_def.node:
+            if "_class" in node.attr:
+                del node.attr["_class"]
+
+        with tf.gfile.GFile(frozen_graph_path, "wb") as f:
+            f.write(graph_def.SerializeToString())
+        print "Wrote frozen inference graph (%i nodes, %.1f MB) to %s" % (len(graph_def.node), graph_def.ByteSize() / 2.0**20, frozen_graph_path)
+
+
+    def export_slim_checkpoint(self, session, slim_ckpt_dir, float16=False, int8=False):
+        """
+        Writes a weights-only checkpoint to slim_ckpt_dir: only the trainable variables
+        (no optimizer slots or global_step), and no meta graph.
+        initialize_model in main.py restores it in all modes except train.
+
+        Inputs:
+          session: TensorFlow session holding the weights
+          slim_ckpt_dir: directory to write the checkpoint to
+          float16: if True, store the weights as float16 (they are cast back to float32 when restored)
+          int8: if True, store the kernels (weights with 2 or more dimensions) as int8,
+            with one float32 scale per output unit in "<name>_int8_scale" (see quantization.quantize_int8).
+            They are dequantized to float32 when restored: TF has no int8 LSTM or dense kernels,
+            so this only makes the checkpoint smaller.
+
+        Returns:
+          The path of the checkpoint
+        """
+        variables = tf.trainable_variables()
+        values = session.run(variables)
+        dtype = np.float16 if float16 else np.float32
+
+        # Maps checkpoint names to the (numpy) values to save
+        slim_values = {}
+        for var, value in zip(variables, values):
+            if int8 and value.ndim >= 2:
+                slim_values[var.op.name], slim_values[var.op.name + "_int8_scale"] = quantize_int8(value, axis=tuple(range(value.ndim - 1)))
+            else:
+                slim_values[var.op.name] = value.astype(dtype)
+
+        if not os.path.exists(slim_ckpt_dir):
+            os.makedirs(slim_ckpt_dir)
+
+        # Save copies of the variables (with the same names) from a separate graph
+        with tf.Graph().as_default():
+            slim_vars = dict((name, tf.Variable(value)) for name, value in slim_values.items())
+            saver = tf.train.Saver(slim_vars)
+            with tf.Session() as slim_session:
+                slim_session.run(tf.global_variables_initializer())
+                slim_ckpt_path = saver.save(slim_session, os.path.join(slim_ckpt_dir, "qa_slim.ckpt"), write_meta_graph=False)
+
+        # Record the checkpoint relative to slim_ckpt_dir, so the directory can be copied to other machines
+        tf.train.update_checkpoint_state(slim_ckpt_dir, os.path.basename(slim_ckpt_path))
+
+        print "Wrote %i weights (%.2f MB) to %s" % (len(variables), sum(value.nbytes for value in slim_values.values()) / 2.0**20, slim_ckpt_path)
+        return slim_ckpt_path
 
 
-    def get_start_end_pos(self, session, batch):
+    def get_start_end_pos(self, session, batch, context_cache=None):
         """
         Run forward-pass only; get the most likely answer span.
 
         Inputs:
           session: TensorFlow session
           batch: Batch object
+          context_cache: optional context encoding cache (see get_prob_dists)
 
         Returns:
           start_pos, end_pos: both numpy arrays shape (batch_size).
             The most likely start and end positions for each example in the batch.
         """
-        # Get start_dist and end_dist, both shape (batch_size, context_len)
-        start_dist, end_dist = self.get_prob_dists(session, batch)
-
-        start_pos = np.zeros(start_dist.shape[0], dtype=int)
-        end_pos = np.zeros(start_dist.shape[0], dtype=int)
-        
-        for x in range(0, start_dist.shape[0]):
-            max_prod = 0
-            start = 0
-            end = 0
-            for y in range(0, start_dist.shape[1]):
-                for z in range(y, start_dist.shape[1]):
-                    if (start_dist[x,y] * end_dist[x,z]) > max_prod:
-                        max_prod = start_dist[x,y] * end_dist[x,z]
-                        start = y
-                        end = z
-            start_pos[x] = start
-            end_pos[x] = end
-
-
-        # Take argmax to get start_pos and end_post, both shape (batch_size)
-        # start_pos = np.argmax(start_dist, axis=1)
-        # end_pos = np.argmax(end_dist, axis=1)
-
+        start_pos, end_pos, _ = self.get_start_end_scores(session, batch, context_cache)
         return start_pos, end_pos
 
 
+    def get_start_end_scores(self, session, batch, context_cache=None):
+        """
+        Run forward-pass only; get the most likely answer span and its probability.
+
+        Inputs:
+          session: TensorFlow session
+          batch: Batch object
+          context_cache: optional context encoding cache (see get_prob_dists)
+
+        Returns:
+          start_pos, end_pos: both numpy arrays shape (batch_size).
+            The most likely start and end positions for each example in the batch.
+          scores: numpy array shape (batch_size). The joint probability of each span.
+        """
+        # Take the span (start, end) with start <= end that maximizes start_dist[start] * end_dist[end].
+        # This is done in the graph (see add_span_decoding), so only three numbers per example are fetched.
+        input_feed = self.get_inference_feed(session, batch, context_cache)
+        output_feed = [self.pred_start, self.pred_end, self.pred_score]
+        [start_pos, end_pos, scores] = session.run(output_feed, input_feed)
+        return start_pos, end_pos, scores
+
+
+    def get_nbest_spans(self, session, batch, n_best, context_cache=None):
+        """
+        Run forward-pass only; get the n_best most likely answer spans.
+
+        Inputs:
+          session: TensorFlow session
+          batch: Batch object
+          n_best: int. How many spans to return per example.
+          context_cache: optional context encoding cache (see get_prob_dists)
+
+        Returns:
+          start_pos, end_pos, scores: numpy arrays shape (batch_size, n_best).
+            The most likely spans for each example in the batch, sorted by decreasing
+            joint probability (scores). The first span is the most likely one.
+        """
+        start_dist, end_dist = self.get_prob_dists(session, batch, context_cache)
+        return get_nbest_spans(start_dist, end_dist, n_best, self.FLAGS.max_answer_len, batch.context_lens)
+
+
+    def get_batches(self, context_path, qn_path, ans_path, dataset, discard_long, seed, shuffle=False, num_samples=0):
+        """
+        Returns a BatchPrefetcher over the batches for the train or dev set: read from the data compiled
+        in --shards_dir/{dataset} if --shards_dir is set (see data_shards.py), otherwise from the text files.
+        If --prefetch_batches > 0 they are made in the background.
+
+        Inputs:
+          context_path, qn_path, ans_path: paths to the {train/dev}.{context/question/answer} data files
+          dataset: "train" or "dev"
+          discard_long, seed, shuffle, num_samples: see data_batcher.get_batch_generator
+        """
+        # The batches' arrays are reused, so there must be enough of them for the prefetched batches (see BatchBuffers)
+        num_buffers = self.FLAGS.prefetch_batches + 2
+        batch_options = {"pool_size": self.FLAGS.batch_pool_size, "bucket_by": self.FLAGS.bucket_by or None, "spread": self.FLAGS.bucket_spread, "shuffle": shuffle, "num_samples": num_samples}
+        if self.FLAGS.shards_dir:
+            if not hasattr(self, "vocab_sig"):
+                self.vocab_sig = data_shards.vocab_signature(self.id2word)
+            batch_fn = lambda: data_shards.get_batch_generator(os.path.join(self.FLAGS.shards_dir, dataset), self.vocab_sig, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, word_len=self.FLAGS.word_len, discard_long=discard_long, max_batch_tokens=self.FLAGS.max_batch_tokens, seed=seed, num_buffers=num_buffers, dedup_char_words=self.FLAGS.dedup_char_words, **batch_options)
+        else:
+            batch_fn = lambda: get_batch_generator(self.word2id, context_path, qn_path, ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, word_len=self.FLAGS.word_len, discard_long=discard_long, max_batch_tokens=self.FLAGS.max_batch_tokens, seed=seed, num_buffers=num_buffers, **batch_options)
+        return BatchPrefetcher(batch_fn, self.FLAGS.prefetch_batches, self.FLAGS.prefetch_process)
+
+
     def get_dev_loss(self, session, dev_context_path, dev_qn_path, dev_ans_path):
         """
         Get loss for entire dev set.
@@ -373,7 +772,8 @@ class QAModel(object):
         # which are longer than our context_len or question_len.
         # We need to do this because if, for example, the true answer is cut
         # off the context, then the loss function is undefined.
-        for batch in get_batch_generator(self.word2id, dev_context_path, dev_qn_path, dev_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, word_len=self.FLAGS.word_len, discard_long=True):
+        batches = self.get_batches(dev_context_path, dev_qn_path, dev_ans_path, "dev", discard_long=True, seed=self.FLAGS.seed)
+        for batch in batches:
 
             # Get loss for this batch
             loss = self.get_loss(session, batch)
@@ -384,7 +784,7 @@ class QAModel(object):
         # Calculate average loss
         total_num_examples = sum(batch_lengths)
         toc = time.time()
-        print "Computed dev loss over %i examples in %.2f seconds" % (total_num_examples, toc-tic)
+        print "Computed dev loss over %i examples in %.2f seconds (%.2f seconds waiting for data)" % (total_num_examples, toc-tic, batches.total_wait_time)
 
         # Overall loss is total loss divided by total number of examples
         dev_loss = sum(loss_per_batch) / float(total_num_examples)
@@ -412,7 +812,7 @@ class QAModel(object):
           session: TensorFlow session
           qn_path, context_path, ans_path: paths to {dev/train}.{question/context/answer} data files.
           dataset: string. Either "train" or "dev". Just for logging purposes.
-          num_samples: int. How many samples to use. If num_samples=0 then do whole dataset.
+          num_samples: int. How many samples to use (a random sample, chosen with FLAGS.seed). If num_samples=0 then do whole dataset.
           print_to_screen: if True, pretty-prints each example to screen
 
         Returns:
@@ -426,11 +826,21 @@ class QAModel(object):
 
         tic = time.time()
 
+        # Optionally reuse context encodings for examples that share a context
+        context_cache = {} if self.FLAGS.cache_context_encodings else None
+
         # Note here we select discard_long=False because we want to sample from the entire dataset
         # That means we're truncating, rather than discarding, examples with too-long context or questions
-        for batch in get_batch_generator(self.word2id, context_path, qn_path, ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, word_len=self.FLAGS.word_len, discard_long=False):
+        # If num_samples > 0, only a random sample of that many examples is read (by seeking to their lines)
+        batches = self.get_batches(context_path, qn_path, ans_path, dataset, discard_long=False, seed=self.FLAGS.seed, num_samples=num_samples)
+        for batch in batches:
 
-            pred_start_pos, pred_end_pos = self.get_start_end_pos(session, batch)
+            # When pretty-printing, also get the n-best spans if they were asked for
+            if print_to_screen and self.FLAGS.n_best_size > 0:
+                nbest_start, nbest_end, nbest_scores = self.get_nbest_spans(session, batch, self.FLAGS.n_best_size, context_cache)
+                pred_start_pos, pred_end_pos = nbest_start[:, 0], nbest_end[:, 0]
+            else:
+                pred_start_pos, pred_end_pos = self.get_start_end_pos(session, batch, context_cache)
 
             # Convert the start and end positions to lists length batch_size
             pred_start_pos = pred_start_pos.tolist() # list length batch_size
@@ -456,7 +866,13 @@ class QAModel(object):
 
                 # Optionally pretty-print
                 if print_to_screen:
-                    print_example(self.word2id, batch.context_tokens[ex_idx], batch.qn_tokens[ex_idx], batch.ans_span[ex_idx, 0], batch.ans_span[ex_idx, 1], pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em)
+                    nbest = None
+                    if self.FLAGS.n_best_size > 0:
+                        # Spans with score -1 are only there to fill up the n-best list of short contexts
+                        nbest = [(" ".join(batch.context_tokens[ex_idx][start : end + 1]), score)
+                                 for start, end, score in zip(nbest_start[ex_idx], nbest_end[ex_idx], nbest_scores[ex_idx])
+                                 if score >= 0]
+                    print_example(self.word2id, batch.context_tokens[ex_idx], batch.qn_tokens[ex_idx], batch.ans_span[ex_idx, 0], batch.ans_span[ex_idx, 1], pred_ans_start, pred_ans_end, true_answer, pred_answer, f1, em, nbest)
 
                 if num_samples != 0 and example_num >= num_samples:
                     break
@@ -468,7 +884,7 @@ class QAModel(object):
         em_total /= example_num
 
         toc = time.time()
-        logging.info("Calculating F1/EM for %i examples in %s set took %.2f seconds" % (example_num, dataset, toc-tic))
+        logging.info("Calculating F1/EM for %i examples in %s set took %.2f seconds (%.2f seconds waiting for data)" % (example_num, dataset, toc-tic, batches.total_wait_time))
 
         return f1_total, em_total
 
@@ -510,8 +926,14 @@ class QAModel(object):
             epoch += 1
             epoch_tic = time.time()
 
+            # Use a different (but reproducible) batch order for each epoch
+            epoch_seed = None if self.FLAGS.seed is None else self.FLAGS.seed + epoch
+
             # Loop over batches
-            for batch in get_batch_generator(self.word2id, train_context_path, train_qn_path, train_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, word_len=self.FLAGS.word_len, discard_long=True):
+            batches = self.get_batches(train_context_path, train_qn_path, train_ans_path, "train", discard_long=True, seed=epoch_seed, shuffle=self.FLAGS.shuffle_examples)
+            padding_stats = PaddingStats()
+            for batch in batches:
+                padding_stats.add(batch)
 
                 # Run training iteration
                 iter_tic = time.time()
@@ -528,8 +950,8 @@ class QAModel(object):
                 # Sometimes print info to screen
                 if global_step % self.FLAGS.print_every == 0:
                     logging.info(
-                        'epoch %d, iter %d, loss %.5f, smoothed loss %.5f, grad norm %.5f, param norm %.5f, batch time %.3f' %
-                        (epoch, global_step, loss, exp_loss, grad_norm, param_norm, iter_time))
+                        'epoch %d, iter %d, loss %.5f, smoothed loss %.5f, grad norm %.5f, param norm %.5f, batch time %.3f, data wait %.3f' %
+                        (epoch, global_step, loss, exp_loss, grad_norm, param_norm, iter_time, batches.wait_time))
 
                 # Sometimes save model
                 if global_step % self.FLAGS.save_every == 0:
@@ -567,7 +989,11 @@ class QAModel(object):
 
 
             epoch_toc = time.time()
-            logging.info("End of epoch %i. Time for epoch: %f" % (epoch, epoch_toc-epoch_tic))
+            logging.info("End of epoch %i. Time for epoch: %f. Time waiting for data: %f" % (epoch, epoch_toc-epoch_tic, batches.total_wait_time))
+            if padding_stats.num_batches > 0:
+                logging.info("Epoch %i batches: %s" % (epoch, padding_stats))
+                write_summary(padding_stats.context_efficiency(), "train/context_padding_efficiency", summary_writer, global_step)
+                write_summary(padding_stats.repeated_context_rate(), "train/repeated_context_rate", summary_writer, global_step)
 
         sys.stdout.flush()
 
@@ -578,3 +1004,73 @@ def write_summary(value, tag, summary_writer, global_step):
     summary = tf.Summary()
     summary.value.add(tag=tag, simple_value=value)
     summary_writer.add_summary(summary, global_step)
+
+
+def get_embedding_values(emb_matrix, quantize):
+    """Returns the values of the embedding variables: [emb_matrix], or the int8 matrix and its per-row scales if quantize (see quantize_int8)"""
+    return list(quantize_int8(emb_matrix, axis=1)) if quantize else [emb_matrix]
+
+
+class FrozenQAModel(QAModel):
+    """
+    A QAModel loaded from a frozen inference graph (see QAModel.export_frozen_graph).
+
+    The weights are constants in the graph, so there is no checkpoint to restore,
+    and the model code isn't used to rebuild the graph. Only the inference methods
+    (get_prob_dists, get_start_end_pos, get_nbest_spans, check_f1_em...) can be used.
+    If the graph was exported without the embedding matrix, it is set by init_embeddings.
+    """
+
+    def __init__(self, FLAGS, id2word, word2id, frozen_graph_path, emb_matrix=None):
+        """
+        Loads the frozen graph into the default graph.
+
+        Inputs:
+          FLAGS: the flags passed in from main.py. The flags in EXPORT_FLAGS must match the exported graph.
+          id2word: numpy array mapping word idx (int) to word (string)
+          word2id: dictionary mapping word (string) to word idx (int)
+          frozen_graph_path: path to the graph written by export_frozen_graph
+          emb_matrix: shape (400002, embedding_size). Only used if the graph was exported
+            without the embedding matrix (see export_frozen_graph).
+        """
+        print "Loading the frozen QAModel from %s..." % frozen_graph_path
+        self.FLAGS = FLAGS
+        self.id2word = id2word
+        self.word2id = word2id
+        self.is_training = False
+        self.frozen_graph_path = frozen_graph_path
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(frozen_graph_path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+
+        # Read the settings the graph was exported with
+        settings_nodes = [node for node in graph_def.node if node.name == "QAModel/export_settings"]
+        if not settings_nodes:
+            raise Exception("%s is not a graph exported with --mode=export_graph" % frozen_graph_path)
+        settings = json.loads(tensor_util.MakeNdarray(settings_nodes[0].attr["value"].tensor).item())
+        for name, value in settings["flags"].items():
+            if getattr(FLAGS, name) != value:
+                raise Exception("The frozen graph %s was exported with --%s=%s, but --%s=%s" % (frozen_graph_path, name, value, name, getattr(FLAGS, name)))
+        if settings.get("vocab_size", len(word2id)) != len(word2id):
+            raise Exception("The frozen graph %s was exported with a vocabulary of %i words, but this one has %i. Use the same (pruned or full) vocabulary, see prune_vocab mode and --use_pruned_vocab" % (frozen_graph_path, settings["vocab_size"], len(word2id)))
+
+        if "context_lens" not in settings["tensors"]:
+            raise Exception("The frozen graph %s takes masks instead of sequence lengths. Export it again with --mode=export_graph" % frozen_graph_path)
+
+        tf.import_graph_def(graph_def, name="")
+        graph = tf.get_default_graph()
+        for attr, tensor_name in settings["tensors"].items():
+            setattr(self, attr, graph.get_tensor_by_name(tensor_name))
+
+        # Add initializers for the embedding variables, if they were left out of the graph
+        self.embedding_vars, self.embedding_inits, self.embedding_feeds = [], [], []
+        self.get_embedding_values = lambda: []
+        if settings.get("embedding_variables"):
+            for name in settings["embedding_variables"]:
+                var = graph.get_tensor_by_name(name + ":0")
+                feed = tf.placeholder(var.dtype.base_dtype, shape=var.get_shape(), name=name + "_feed")
+                self.embedding_vars.append(var)
+                self.embedding_inits.append(tf.assign(var, feed))
+                self.embedding_feeds.append(feed)
+            self.get_embedding_values = lambda: get_embedding_values(emb_matrix, settings["quantize_embeddings"])
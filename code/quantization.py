@@ -0,0 +1,49 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains functions for post-training int8 quantization
+of the embedding matrix and the model weights"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+
+
+def quantize_int8(array, axis):
+    """
+    Symmetric linear quantization to int8, with one scale per slice of array.
+    Each slice is scaled so that its largest absolute value maps to 127.
+
+    Inputs:
+      array: numpy float array
+      axis: int or tuple of ints. The axes each scale is shared over.
+        e.g. for an embedding matrix shape (vocab_size, embedding_size), axis=1 gives one scale per row;
+        for a kernel shape (input_size, output_size), axis=0 gives one scale per output unit.
+
+    Returns:
+      quantized: numpy int8 array, same shape as array
+      scales: numpy float32 array, with the dimensions in axis kept with size 1,
+        so that quantized * scales approximates array.
+    """
+    max_abs = np.max(np.abs(array), axis=axis, keepdims=True)
+    scales = (max_abs / 127.0).astype(np.float32)
+    scales[scales == 0] = 1.0 # all-zero slices stay zero
+    quantized = np.clip(np.round(array / scales), -127, 127).astype(np.int8)
+    return quantized, scales
+
+
+def dequantize_int8(quantized, scales):
+    """Inverse of quantize_int8. Returns a numpy float32 array"""
+    return quantized.astype(np.float32) * scales
@@ -0,0 +1,312 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains the HTTP inference server for "serve" mode in main.py.
+
+The model is loaded once. Each request is a JSON object
+  {"context": ..., "question": ...}
+POSTed to /predict, and the response is
+  {"answer": ...} (plus "nbest": [...] if --n_best_size > 0).
+Concurrent requests are grouped into micro-batches by a single thread that owns the TensorFlow session.
+GET /stats returns request latency percentiles and micro-batch size counters
+(and prediction cache counters, if --prediction_cache_size or --prediction_cache_mb is set)."""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import json
+import time
+import signal
+import threading
+import Queue
+from collections import deque, Counter
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import numpy as np
+from nltk.tokenize.moses import MosesDetokenizer
+
+from preprocessing.squad_preprocess import tokenize
+from official_eval_helper import iter_paragraph_examples, get_batch_generator, predict_batch, combine_window_predictions
+
+
+class PredictionRequest(object):
+    """A (context, question) pair waiting for its answer"""
+
+    def __init__(self, uuid, context_tokens, qn_tokens, context_ids=None):
+        self.uuid = uuid
+        self.context_tokens = context_tokens
+        self.qn_tokens = qn_tokens
+        self.context_ids = context_ids # if known
+        self.enqueue_time = None # time.time() when the request was queued (see MicroBatcher.predict)
+        self.answer = None
+        self.nbest = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ServerStats(object):
+    """Thread-safe counters for request latency and micro-batch sizes"""
+
+    def __init__(self, num_latencies=10000):
+        """
+        Inputs:
+          num_latencies: int. Latency percentiles are computed over this many most recent requests.
+        """
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=num_latencies) # seconds
+        self.batch_sizes = Counter() # maps number of requests in a micro-batch to number of micro-batches
+        self.num_requests = 0
+        self.num_errors = 0
+
+    def add_request(self, latency, error=False):
+        with self.lock:
+            self.latencies.append(latency)
+            self.num_requests += 1
+            self.num_errors += int(error)
+
+    def add_batch(self, batch_size):
+        with self.lock:
+            self.batch_sizes[batch_size] += 1
+
+    def to_dict(self):
+        """Returns the counters as a JSON-serializable dictionary"""
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.0
+            batch_sizes = dict(self.batch_sizes)
+            num_requests, num_errors = self.num_requests, self.num_errors
+
+        num_batches = sum(batch_sizes.values())
+        return {
+            "num_requests": num_requests,
+            "num_errors": num_errors,
+            "latency_ms": {
+                "p50": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p99": float(np.percentile(latencies, 99)) if len(latencies) else None,
+                "mean": float(np.mean(latencies)) if len(latencies) else None,
+            },
+            "num_batches": num_batches,
+            "batch_size": {
+                "mean": sum(size * count for size, count in batch_sizes.items()) / num_batches if num_batches else None,
+                "counts": dict((str(size), count) for size, count in sorted(batch_sizes.items())),
+            },
+        }
+
+
+class MicroBatcher(object):
+    """
+    Groups concurrent requests into micro-batches and runs the model on them.
+
+    A single thread owns the TensorFlow session. It waits for a request, then
+    collects more requests until it has max_batch_size of them or max_wait seconds
+    have passed since the first one was queued, and predicts them all at once.
+    """
+
+    def __init__(self, session, model, word2id, max_batch_size, max_wait, stats):
+        """
+        Inputs:
+          session: TensorFlow session
+          model: QAModel
+          word2id: dictionary mapping word (string) to word id (int)
+          max_batch_size: int. Maximum number of requests in a micro-batch.
+          max_wait: float. Maximum time (seconds) a request waits for other requests to join its micro-batch.
+          stats: ServerStats
+        """
+        self.session = session
+        self.model = model
+        self.word2id = word2id
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = stats
+        self.detokenizer = MosesDetokenizer()
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def predict(self, request):
+        """Queues a PredictionRequest, and blocks until it has been predicted"""
+        request.enqueue_time = time.time()
+        self.queue.put(request)
+        request.done.wait()
+
+    def get_requests(self):
+        """Blocks until there is a request, then collects a micro-batch of requests (list)"""
+        requests = [self.queue.get()]
+        # The first request is the oldest one. It may have waited in the queue while the previous micro-batch ran.
+        deadline = requests[0].enqueue_time + self.max_wait
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self.queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return requests
+
+    def run(self):
+        FLAGS = self.model.FLAGS
+        while True:
+            requests = self.get_requests()
+            self.stats.add_batch(len(requests))
+            uuid2request = dict((request.uuid, request) for request in requests)
+            try:
+                # Contexts longer than context_len may be split into windows (--window_len),
+                # so one micro-batch of requests can make more than one model batch
+                examples = [(request.uuid, request.context_tokens, request.qn_tokens) + ((request.context_ids,) if request.context_ids is not None else ())
+                            for request in requests]
+                batches = get_batch_generator(self.word2id, examples, self.max_batch_size, FLAGS.context_len, FLAGS.question_len, FLAGS.word_len, FLAGS.max_batch_tokens, FLAGS.window_len, FLAGS.window_stride)
+                batch_predictions = (predict_batch(self.session, self.model, batch, self.detokenizer) for batch in batches)
+                for uuid, answer, nbest in combine_window_predictions(batch_predictions, FLAGS.n_best_size):
+                    uuid2request[uuid].answer = answer
+                    uuid2request[uuid].nbest = nbest
+            except Exception as e:
+                for request in requests:
+                    request.error = "Prediction failed: %s" % e
+            for request in requests:
+                if request.error is None and request.answer is None:
+                    request.error = "No prediction was made for this request"
+                request.done.set()
+
+
+class QARequestHandler(BaseHTTPRequestHandler):
+    """Handles POST /predict and GET /stats. self.server is a QAServer."""
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            stats = self.server.stats.to_dict()
+            if self.server.cache is not None:
+                stats["prediction_cache"] = self.server.cache.stats()
+            self.send_json(200, stats)
+        else:
+            self.send_json(404, {"error": "Unknown path: %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self.send_json(404, {"error": "Unknown path: %s" % self.path})
+            return
+
+        start_time = time.time()
+
+        # Read and tokenize the request
+        try:
+            data = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+            context, question = data['context'], data['question']
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {"error": 'Expected a JSON object with keys "context" and "question"'})
+            return
+        uuid = self.server.next_uuid()
+        cache = self.server.cache
+        if cache is not None:
+            question = unicode(question)
+            key, context_tokens, context_ids = cache.get_context(context)
+            cached = cache.get_answer(key, question)
+            if cached is not None:
+                answer, nbest = cached
+                self.send_answer(start_time, answer, nbest)
+                return
+            request = PredictionRequest(uuid, context_tokens, tokenize(question), context_ids)
+        else:
+            (_, context_tokens, qn_tokens), = iter_paragraph_examples(context, [{"id": uuid, "question": question}])
+            request = PredictionRequest(uuid, context_tokens, qn_tokens)
+
+        if not request.context_tokens or not request.qn_tokens:
+            self.send_json(400, {"error": "The context and question must not be empty"})
+            return
+
+        # Wait for the answer
+        self.server.batcher.predict(request)
+
+        if request.error is not None:
+            self.server.stats.add_request(time.time() - start_time, error=True)
+            self.send_json(500, {"error": request.error})
+            return
+
+        if cache is not None:
+            cache.put_answer(key, question, request.answer, request.nbest)
+        self.send_answer(start_time, request.answer, request.nbest)
+
+    def send_answer(self, start_time, answer, nbest):
+        response = {"answer": answer}
+        if nbest is not None:
+            response["nbest"] = nbest
+        self.server.stats.add_request(time.time() - start_time)
+        self.send_json(200, response)
+
+    def log_message(self, format, *args):
+        # Don't print a line per request
+        pass
+
+
+class QAServer(ThreadingMixIn, HTTPServer):
+    """A multi-threaded HTTP server. Each request is handled in its own thread."""
+    daemon_threads = True
+
+    def __init__(self, address, batcher, stats, cache=None):
+        HTTPServer.__init__(self, address, QARequestHandler)
+        self.batcher = batcher
+        self.stats = stats
+        self.cache = cache
+        self.uuid_lock = threading.Lock()
+        self.num_uuids = 0
+
+    def next_uuid(self):
+        """Returns a unique id (string) for a request"""
+        with self.uuid_lock:
+            self.num_uuids += 1
+            return str(self.num_uuids)
+
+
+def serve(session, model, word2id, host, port, max_wait, cache=None):
+    """
+    Serves the model over HTTP until interrupted (with Ctrl-C or SIGTERM).
+
+    Inputs:
+      session: TensorFlow session, with the model loaded
+      model: QAModel
+      word2id: dictionary mapping word (string) to word id (int)
+      host, port: address to listen on
+      max_wait: float. Maximum time (seconds) a request waits for other requests to join its micro-batch.
+        Micro-batches have at most model.FLAGS.batch_size requests.
+      cache: PredictionCache or None. If given, contexts and answers are looked up in it first.
+    """
+    stats = ServerStats()
+    batcher = MicroBatcher(session, model, word2id, model.FLAGS.batch_size, max_wait, stats)
+    batcher.start()
+
+    server = QAServer((host, port), batcher, stats, cache)
+
+    # Stop on SIGTERM the same way as on Ctrl-C, so the caller can clean up (e.g. save the cache)
+    def handle_sigterm(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    print "Serving on http://%s:%i (POST /predict, GET /stats)" % (host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print "Shutting down server"
+    finally:
+        server.server_close()
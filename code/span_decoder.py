@@ -0,0 +1,149 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains functions to decode answer spans from the
+start and end probability distributions output by the model"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+from six.moves import xrange
+
+
+def get_running_top_starts(start_dist, n_best):
+    """
+    For each end position j, finds the n_best most likely starts i <= j.
+
+    The starts are ranked once, then the k-th best start for every j is found in one
+    vectorized pass per k: it is the best start i <= j that ranks below the (k-1)-th best
+    start for j. Those (k-1)-th best ranks only improve as j grows, so each start becomes
+    eligible from some end position on, and the k-th best for j is the best start eligible
+    by j. So there are n_best passes of linear array ops (counts, cumulative sums and
+    minimums) over (batch_size, context_len) arrays, and no loop over positions
+    (unlike scoring all the context_len^2 spans).
+
+    Inputs:
+      start_dist: numpy array shape (batch_size, context_len).
+      n_best: int.
+
+    Returns:
+      top_starts: numpy int array shape (batch_size, context_len, n_best).
+        top_starts[b, j] are the best starts for end position j, best first (earliest first, in case of ties).
+        When there are fewer than n_best starts (j < n_best - 1), the missing ones are -1.
+      top_probs: numpy array shape (batch_size, context_len, n_best). Their probabilities (-1 for the missing ones).
+    """
+    batch_size, context_len = start_dist.shape
+    rows = np.arange(batch_size)[:, np.newaxis]
+    positions = np.arange(context_len)[np.newaxis, :]
+    top_starts = np.full((batch_size, context_len, n_best), -1, dtype=np.int64)
+    top_probs = np.full((batch_size, context_len, n_best), -1, dtype=start_dist.dtype)
+
+    # The key of a start is its rank: context_len - 1 for the best start and 0 for the worst (earliest first, in case of ties).
+    # key_starts[b, key] is the start with that key, and key_probs[b, key] its probability.
+    key_starts = np.ascontiguousarray(np.argsort(-start_dist, axis=1, kind='mergesort')[:, ::-1])
+    key_probs = start_dist[rows, key_starts]
+
+    # Values in [0, context_len] are counted in buckets offset by row * (context_len + 1), so the whole batch is
+    # counted at once: count_upto(values)[row * (context_len + 1) + v] is the number of values <= v in rows <= row
+    row_offsets = rows * (context_len + 1)
+    num_buckets = batch_size * (context_len + 1)
+    count_upto = lambda values: np.cumsum(np.bincount((values + row_offsets).ravel(), minlength=num_buckets))
+
+    prev_keys = None # shape (batch_size, context_len): the (k-1)-th best key for each end position, or -1
+    for k in xrange(n_best):
+        # eligible_from[b, key]: the first end position for which the start with that key ranks below the
+        # (k-1)-th best start. prev_keys only grows along the row, so that's the number of end positions
+        # where it is <= key. A start i is never eligible before end position i.
+        if prev_keys is None:
+            eligible_from = key_starts
+        else:
+            eligible_from = np.maximum(key_starts, count_upto(prev_keys + 1)[positions + 1 + row_offsets] - rows * context_len)
+
+        # keys[b, j] is the largest key eligible by end position j. With the minimum of eligible_from over
+        # the keys >= key, the keys eligible by j become a prefix of all the keys, so they can be counted.
+        suffix_min = np.minimum.accumulate(eligible_from[:, ::-1], axis=1)[:, ::-1]
+        keys = count_upto(suffix_min)[positions + row_offsets] - rows * context_len - 1 # -1 if there is none
+
+        missing = keys < 0
+        flat_keys = np.maximum(keys, 0) + rows * context_len
+        top_starts[:, :, k] = key_starts.ravel()[flat_keys]
+        top_probs[:, :, k] = key_probs.ravel()[flat_keys]
+        top_starts[missing, k] = -1
+        top_probs[missing, k] = -1
+        prev_keys = keys
+
+    return top_starts, top_probs
+
+
+def get_nbest_spans(start_dist, end_dist, n_best, max_answer_len=0, context_lens=None):
+    """
+    For each example, finds the n_best spans (start, end) with
+    start <= end < start + max_answer_len that have the highest
+    joint probability start_dist[start] * end_dist[end].
+
+    With a length limit, all the candidate spans are scored at once as a
+    (context_len, max_answer_len) band per example. Without one, only the n_best
+    best starts for each end position can be in the n-best spans, so they are taken
+    from a running top n_best (see get_running_top_starts), and the memory is
+    linear in context_len. The top spans are then selected with np.argpartition.
+
+    Inputs:
+      start_dist, end_dist: numpy arrays shape (batch_size, context_len).
+      n_best: int. How many spans to return per example.
+      max_answer_len: int. If > 0, only consider spans with end - start + 1 <= max_answer_len.
+      context_lens: optional numpy int array shape (batch_size). If given, spans that end
+        past the real context (in the padding) are never selected.
+
+    Returns:
+      start_pos, end_pos: numpy int arrays shape (batch_size, n_best), or fewer columns
+        if there are fewer than n_best candidate spans (e.g. a short padded context_len).
+      scores: numpy array shape (batch_size, n_best). The joint probability of each span.
+        Each row is sorted by decreasing score.
+        Note: if an example has fewer than n_best valid spans, the rest have score -1.
+    """
+    batch_size, context_len = start_dist.shape
+    rows = np.arange(batch_size)[:, np.newaxis]
+    if context_lens is None:
+        context_lens = np.full(batch_size, context_len)
+
+    if max_answer_len > 0 and max_answer_len < context_len:
+        # span_probs[b, i, k] is the probability of the span starting at i with length k+1
+        span_starts = np.broadcast_to(np.arange(context_len)[:, np.newaxis], (context_len, max_answer_len))
+        span_ends = span_starts + np.arange(max_answer_len) # shape (context_len, max_answer_len)
+        span_probs = start_dist[:, :, np.newaxis] * end_dist[:, np.minimum(span_ends, context_len - 1)] # shape (batch_size, context_len, max_answer_len)
+        valid = span_ends < context_lens[:, np.newaxis, np.newaxis]
+        span_starts, span_ends = span_starts[np.newaxis], span_ends[np.newaxis]
+    else:
+        # span_probs[b, j, k] is the probability of the span ending at j with the k-th best start for j
+        top_starts, top_probs = get_running_top_starts(start_dist, min(n_best, context_len)) # shape (batch_size, context_len, min(n_best, context_len))
+        span_probs = top_probs * end_dist[:, :, np.newaxis]
+        span_ends = np.arange(context_len)[np.newaxis, :, np.newaxis]
+        valid = (top_starts >= 0) & (span_ends < context_lens[:, np.newaxis, np.newaxis])
+        span_starts = top_starts
+
+    span_probs = np.where(valid, span_probs, -1).reshape(batch_size, -1)
+    span_starts = np.broadcast_to(span_starts, valid.shape).reshape(batch_size, -1)
+    span_ends = np.broadcast_to(span_ends, valid.shape).reshape(batch_size, -1)
+    n_best = min(n_best, span_probs.shape[1]) # the number of candidate spans
+
+    # Select the top n_best spans (unordered), then sort them by score
+    top = np.argpartition(-span_probs, n_best - 1, axis=1)[:, :n_best] # shape (batch_size, n_best)
+    top = top[rows, np.argsort(-span_probs[rows, top], axis=1, kind='mergesort')]
+
+    start_pos = span_starts[rows, top]
+    end_pos = span_ends[rows, top]
+    scores = span_probs[rows, top]
+
+    return start_pos, end_pos, scores
@@ -0,0 +1,112 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests that predicting the pools of pool_paragraphs separately (as the official_eval
+workers do, see --num_workers) gives the same answers and n-best lists as predicting
+all the paragraphs at once. The model is replaced by one whose outputs depend on
+the batches, so no checkpoint is needed. Run from the code directory with
+  python -m unittest test_official_eval_helper
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import unittest
+
+import numpy as np
+from six.moves import xrange
+
+from span_decoder import get_nbest_spans
+from official_eval_helper import pool_paragraphs, tokenize_paragraphs, predict_answers
+
+
+class BatchDependentFlags(object):
+    batch_size = 4
+    batch_pool_size = 2
+    context_len = 30
+    question_len = 10
+    word_len = 16
+    max_batch_tokens = 0
+    window_len = 0
+    window_stride = 0
+    n_best_size = 3
+    max_answer_len = 0
+    cache_context_encodings = False
+    prefetch_batches = 0
+    prefetch_process = False
+
+
+class BatchDependentModel(object):
+    """Stands in for QAModel. Its probabilities depend on the batch's size and padded width, as padding can in a real model."""
+
+    def __init__(self, **flags):
+        self.FLAGS = BatchDependentFlags()
+        for name, value in flags.items():
+            setattr(self.FLAGS, name, value)
+
+    def get_prob_dists(self, batch):
+        batch_size, padded_len = batch.context_ids.shape
+        positions = np.arange(padded_len)[np.newaxis, :]
+        start_dist = ((positions + 1) * (batch_size + 3) + padded_len + batch.qn_lens[:, np.newaxis]) % 7 + 1.0
+        end_dist = ((positions + 2) * (padded_len + 1) + batch_size) % 5 + 1.0
+        mask = positions < batch.context_lens[:, np.newaxis]
+        start_dist, end_dist = start_dist * mask, end_dist * mask
+        return start_dist / start_dist.sum(axis=1, keepdims=True), end_dist / end_dist.sum(axis=1, keepdims=True)
+
+    def get_nbest_spans(self, session, batch, n_best, context_cache=None):
+        start_dist, end_dist = self.get_prob_dists(batch)
+        return get_nbest_spans(start_dist, end_dist, n_best, self.FLAGS.max_answer_len, batch.context_lens)
+
+
+def make_paragraphs(num_paragraphs, rng):
+    """Returns a list of (context, qas) pairs with contexts and questions of random lengths"""
+    words = ["the", "river", "flows", "north", "past", "old", "city", "walls", "in", "spring"]
+    paragraphs = []
+    for p in xrange(num_paragraphs):
+        context = " ".join(rng.choice(words, rng.randint(3, 40)))
+        qas = [{"id": "%i-%i" % (p, q), "question": " ".join(rng.choice(words, rng.randint(2, 8))) + " ?"}
+               for q in xrange(rng.randint(0, 5))]
+        paragraphs.append((context, qas))
+    return paragraphs
+
+
+class PoolParagraphsTest(unittest.TestCase):
+
+    def predict(self, model, paragraphs):
+        return sorted(predict_answers(None, model, {}, tokenize_paragraphs(paragraphs)))
+
+    def check_pools_match(self, model, paragraphs):
+        pools = pool_paragraphs(paragraphs, model.FLAGS.batch_size * model.FLAGS.batch_pool_size)
+        self.assertGreater(len(pools), 2)
+        self.assertEqual([start for start, _ in pools[1:]], [end for _, end in pools[:-1]])
+
+        answers = self.predict(model, paragraphs)
+        pool_answers = sorted(answer for start, end in pools for answer in self.predict(model, paragraphs[start:end]))
+        self.assertEqual(answers, pool_answers)
+
+        # The model's answers do depend on the batches: splitting the paragraphs elsewhere changes them
+        split_answers = sorted(answer for p in xrange(0, len(paragraphs), 3) for answer in self.predict(model, paragraphs[p:p + 3]))
+        self.assertNotEqual(answers, split_answers)
+
+    def test_pools_give_the_same_answers(self):
+        rng = np.random.RandomState(0)
+        self.check_pools_match(BatchDependentModel(), make_paragraphs(30, rng))
+
+    def test_pools_with_windows_and_token_budget(self):
+        rng = np.random.RandomState(1)
+        self.check_pools_match(BatchDependentModel(window_len=12, window_stride=6, max_batch_tokens=60), make_paragraphs(30, rng))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the HTTP inference server (server.py), on localhost.
+The model is replaced by one that always predicts the first context token,
+so no checkpoint is needed. Run from the code directory with
+  python -m unittest test_server
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import json
+import time
+import threading
+import unittest
+import urllib2
+
+import numpy as np
+
+import server
+from server import ServerStats, MicroBatcher, QAServer, PredictionRequest
+from prediction_cache import PredictionCache
+from official_eval_helper import tokenize_context, tokens_to_ids
+
+
+class FirstTokenFlags(object):
+    context_len = 50
+    question_len = 10
+    word_len = 16
+    max_batch_tokens = 0
+    window_len = 0
+    window_stride = 0
+    n_best_size = 0
+
+
+class FirstTokenModel(object):
+    """Stands in for QAModel: predicts the span (0, 0) for every example"""
+
+    FLAGS = FirstTokenFlags()
+
+    def get_start_end_scores(self, session, batch, context_cache=None):
+        batch_size = batch.context_ids.shape[0]
+        return np.zeros(batch_size, dtype=np.int32), np.zeros(batch_size, dtype=np.int32), np.ones(batch_size)
+
+
+class ServerTest(unittest.TestCase):
+
+    def start_server(self, max_batch_size, max_wait, cache=None):
+        self.stats = ServerStats()
+        batcher = MicroBatcher(None, FirstTokenModel(), {}, max_batch_size, max_wait, self.stats)
+        batcher.start()
+        self.server = QAServer(("127.0.0.1", 0), batcher, self.stats, cache)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def tearDown(self):
+        if hasattr(self, "server"):
+            self.server.shutdown()
+            self.server.server_close()
+
+    def post(self, obj):
+        """POSTs obj as JSON to /predict. Returns (HTTP status code, decoded JSON response)."""
+        url = "http://127.0.0.1:%i/predict" % self.server.server_address[1]
+        try:
+            response = urllib2.urlopen(urllib2.Request(url, json.dumps(obj), {"Content-Type": "application/json"}), timeout=10)
+        except urllib2.HTTPError as e:
+            response = e
+        return response.getcode(), json.loads(response.read())
+
+    def test_concurrent_requests_share_a_micro_batch(self):
+        num_requests = 8
+        self.start_server(max_batch_size=num_requests, max_wait=2.0)
+
+        results = [None] * num_requests
+        def post_request(i):
+            results[i] = self.post({"context": "word%i is the first word ." % i, "question": "which word ?"})
+        threads = [threading.Thread(target=post_request, args=(i,)) for i in xrange(num_requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Each request gets the answer for its own context
+        self.assertEqual(results, [(200, {"answer": "word%i" % i}) for i in xrange(num_requests)])
+        stats = self.stats.to_dict()
+        self.assertEqual(stats["num_requests"], num_requests)
+        self.assertEqual(stats["batch_size"]["counts"], {str(num_requests): 1})
+
+    def test_bad_request(self):
+        self.start_server(max_batch_size=4, max_wait=0.01)
+        self.assertEqual(self.post({"context": "no question"})[0], 400)
+        self.assertEqual(self.post({"context": "", "question": "empty context ?"})[0], 400)
+
+    def test_prediction_cache(self):
+        cache = PredictionCache({}, tokenize_context, tokens_to_ids, max_entries=10)
+        self.start_server(max_batch_size=4, max_wait=0.01, cache=cache)
+        request = {"context": "cached is the first word .", "question": "which word ?"}
+        self.assertEqual(self.post(request), (200, {"answer": "cached"}))
+        self.assertEqual(self.post(request), (200, {"answer": "cached"}))
+        self.assertEqual(self.post({"context": request["context"], "question": "another question ?"}), (200, {"answer": "cached"}))
+        stats = cache.stats()
+        self.assertEqual((stats["contexts"]["hits"], stats["contexts"]["misses"]), (2, 1))
+        self.assertEqual((stats["answers"]["hits"], stats["answers"]["misses"]), (1, 2))
+        self.assertEqual(self.stats.to_dict()["batch_size"]["counts"], {"1": 2})
+
+    def test_missing_prediction_is_an_error(self):
+        self.start_server(max_batch_size=4, max_wait=0.01)
+        combine_window_predictions = server.combine_window_predictions
+        server.combine_window_predictions = lambda batch_predictions, n_best_size: iter([])
+        try:
+            code, response = self.post({"context": "some context .", "question": "some question ?"})
+        finally:
+            server.combine_window_predictions = combine_window_predictions
+        self.assertEqual(code, 500)
+        self.assertIn("error", response)
+        self.assertEqual(self.stats.to_dict()["num_errors"], 1)
+
+    def test_max_wait_counts_from_enqueue_time(self):
+        # Not started: the requests are taken from the queue by hand
+        batcher = MicroBatcher(None, FirstTokenModel(), {}, 4, 0.5, ServerStats())
+        request = PredictionRequest("1", ["context"], ["question"])
+        request.enqueue_time = time.time() - 1.0 # e.g. queued while the previous micro-batch ran
+        batcher.queue.put(request)
+
+        start_time = time.time()
+        self.assertEqual(batcher.get_requests(), [request])
+        self.assertLess(time.time() - start_time, 0.25)
+
+
+if __name__ == "__main__":
+    unittest.main()
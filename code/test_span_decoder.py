@@ -0,0 +1,85 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the span decoding (span_decoder.py), against brute-force enumeration
+of all the spans. Run from the code directory with
+  python -m unittest test_span_decoder
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import unittest
+
+import numpy as np
+from six.moves import xrange
+
+from span_decoder import get_running_top_starts, get_nbest_spans
+
+
+def brute_force_nbest(start_dist, end_dist, n_best, max_answer_len, context_len):
+    """Returns the n_best highest joint probabilities of the valid spans of one example, highest first"""
+    scores = [start_dist[i] * end_dist[j] for i in xrange(context_len) for j in xrange(i, context_len)
+              if max_answer_len <= 0 or j - i + 1 <= max_answer_len]
+    return sorted(scores, reverse=True)[:n_best]
+
+
+class SpanDecoderTest(unittest.TestCase):
+
+    def check_nbest(self, start_dist, end_dist, n_best, max_answer_len, context_lens):
+        start_pos, end_pos, scores = get_nbest_spans(start_dist, end_dist, n_best, max_answer_len, context_lens)
+        for b in xrange(start_dist.shape[0]):
+            expected = brute_force_nbest(start_dist[b], end_dist[b], n_best, max_answer_len, context_lens[b])
+            found = [(start, end, score) for start, end, score in zip(start_pos[b], end_pos[b], scores[b]) if score >= 0]
+            self.assertEqual(len(found), len(expected))
+            np.testing.assert_allclose([score for _, _, score in found], expected)
+            for start, end, score in found:
+                self.assertTrue(0 <= start <= end < context_lens[b])
+                self.assertTrue(max_answer_len <= 0 or end - start + 1 <= max_answer_len)
+                self.assertAlmostEqual(start_dist[b, start] * end_dist[b, end], score)
+
+    def test_running_top_starts(self):
+        rng = np.random.RandomState(0)
+        for trial in xrange(50):
+            # Rounding makes ties, which go to the earliest start
+            start_dist = np.round(rng.rand(3, rng.randint(1, 20)), 1 if trial % 2 else 8)
+            n_best = rng.randint(1, 8)
+            top_starts, top_probs = get_running_top_starts(start_dist, n_best)
+            for b in xrange(start_dist.shape[0]):
+                for j in xrange(start_dist.shape[1]):
+                    expected = sorted(xrange(j + 1), key=lambda i: (-start_dist[b, i], i))[:n_best]
+                    expected += [-1] * (n_best - len(expected))
+                    self.assertEqual(top_starts[b, j].tolist(), expected)
+
+    def test_nbest_spans(self):
+        rng = np.random.RandomState(1)
+        for trial in xrange(100):
+            batch_size, context_len = rng.randint(1, 5), rng.randint(1, 25)
+            start_dist, end_dist = rng.rand(batch_size, context_len), rng.rand(batch_size, context_len)
+            context_lens = rng.randint(1, context_len + 1, size=batch_size)
+            self.check_nbest(start_dist, end_dist, rng.randint(1, 12), rng.choice([0, 1, 3, 40]), context_lens)
+
+    def test_contexts_shorter_than_nbest(self):
+        # A batch whose longest context has 3 tokens still has 6 spans
+        rng = np.random.RandomState(2)
+        start_dist, end_dist = rng.rand(2, 3), rng.rand(2, 3)
+        for n_best in [4, 6, 10]:
+            for max_answer_len in [0, 2, 5]:
+                self.check_nbest(start_dist, end_dist, n_best, max_answer_len, np.array([3, 2]))
+        _, _, scores = get_nbest_spans(start_dist, end_dist, 6)
+        self.assertTrue((scores >= 0).all())
+
+
+if __name__ == "__main__":
+    unittest.main()
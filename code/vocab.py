@@ -12,14 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""This file contains a function to read the GloVe vectors from file,
-and return them as an embedding matrix"""
+"""This file contains a function to read the GloVe vectors from file
+(or from a binary cache of it), and return them as an embedding matrix"""
 
 from __future__ import absolute_import
 from __future__ import division
 
+import os
+from itertools import izip
 from tqdm import tqdm
 import numpy as np
+from six.moves import xrange
 
 _PAD = b"<pad>"
 _UNK = b"<unk>"
@@ -29,59 +32,221 @@ UNK_ID = 1
 CHAR_PAD_ID = 70
 CHAR_UNK_ID = 71
 ALPHABET = "abcdefghijklmnopqrstuvwxyz0123456789-,;.!?:'\"/\\|_@#$%^&*~`+-=<>()[]{}\n"
+GLOVE_VOCAB_SIZE = int(4e5) # this is the vocab size of the corpus we've downloaded
+PRUNED_VOCAB_NAME = "pruned_vocab" # prune_vocab mode writes pruned_vocab.npy and pruned_vocab.vocab to the experiment dir
+
+
+def get_glove_cache_paths(glove_path):
+    """
+    Returns the paths (emb_path, vocab_path) of the binary cache for a GloVe .txt file:
+    e.g. glove.6B.100d.npy (float32 embedding matrix) and glove.6B.100d.vocab (one word per line).
+    """
+    base = glove_path[:-len(".txt")] if glove_path.endswith(".txt") else glove_path
+    return base + ".npy", base + ".vocab"
+
+
+def parse_glove_line(line, glove_dim, glove_path):
+    """Parses a line of a GloVe .txt file into (word, vector), where vector is a float32 numpy array"""
+    word, vector = line.lstrip().rstrip().split(" ", 1)
+    vector = np.fromstring(vector, dtype=np.float32, sep=" ")
+    if glove_dim != len(vector):
+        raise Exception("You set --glove_path=%s but --embedding_size=%i. If you set --glove_path yourself then make sure that --embedding_size matches!" % (glove_path, glove_dim))
+    return word, vector
+
+
+def read_glove_txt(glove_path, glove_dim):
+    """
+    Parses the original GloVe .txt file into memory.
+
+    Returns:
+      emb_matrix: float32 numpy array shape (400002, glove_dim). The first two rows
+        (PAD and UNK) are randomly initialized.
+      words: list of the 400002 words (strings), in id order
+    """
+    print "Loading GLoVE vectors from file: %s" % glove_path
+
+    emb_matrix = np.zeros((GLOVE_VOCAB_SIZE + len(_START_VOCAB), glove_dim), dtype=np.float32)
+    words = list(_START_VOCAB)
+
+    # randomly initialize the special tokens
+    emb_matrix[:len(_START_VOCAB), :] = np.random.randn(len(_START_VOCAB), glove_dim)
+
+    # go through glove vecs
+    idx = len(_START_VOCAB)
+    with open(glove_path, 'r') as fh:
+        for line in tqdm(fh, total=GLOVE_VOCAB_SIZE):
+            word, vector = parse_glove_line(line, glove_dim, glove_path)
+            emb_matrix[idx, :] = vector
+            words.append(word)
+            idx += 1
+
+    assert idx == GLOVE_VOCAB_SIZE + len(_START_VOCAB)
+    return emb_matrix, words
+
+
+def write_glove_cache(lines, glove_dim, glove_path, emb_path, vocab_path):
+    """
+    Converts the lines of a GloVe .txt file to the binary cache (see get_glove_cache_paths),
+    one line at a time, so memory use doesn't depend on the size of the file.
+    The first two rows (PAD and UNK) are randomly initialized.
+    Each file is written to a temporary path then renamed.
+
+    Inputs:
+      lines: iterable of the lines (strings) of glove.6B.{glove_dim}d.txt
+        e.g. an open file, or a member of glove.6B.zip
+      glove_dim: integer; needs to match the dimension of the vectors
+      glove_path: string. Where the lines come from (for error messages).
+      emb_path, vocab_path: where to write the cache
+    """
+    num_rows = GLOVE_VOCAB_SIZE + len(_START_VOCAB)
+    emb_matrix = np.lib.format.open_memmap(emb_path + ".tmp", mode='w+', dtype=np.float32, shape=(num_rows, glove_dim))
+
+    # randomly initialize the special tokens
+    emb_matrix[:len(_START_VOCAB), :] = np.random.randn(len(_START_VOCAB), glove_dim)
+
+    idx = len(_START_VOCAB)
+    with open(vocab_path + ".tmp", 'wb') as vocab_file:
+        vocab_file.write(b"\n".join(_START_VOCAB))
+        for line in tqdm(lines, total=GLOVE_VOCAB_SIZE):
+            if idx == num_rows:
+                raise Exception("%s has more than %i words" % (glove_path, GLOVE_VOCAB_SIZE))
+            word, vector = parse_glove_line(line, glove_dim, glove_path)
+            emb_matrix[idx, :] = vector
+            vocab_file.write(b"\n" + word)
+            idx += 1
+    if idx != num_rows:
+        raise Exception("%s has %i words, expected %i" % (glove_path, idx - len(_START_VOCAB), GLOVE_VOCAB_SIZE))
+
+    emb_matrix.flush()
+    del emb_matrix
+    os.rename(emb_path + ".tmp", emb_path)
+    os.rename(vocab_path + ".tmp", vocab_path)
+    print "Wrote GLoVE cache to %s and %s" % (emb_path, vocab_path)
 
 
 def get_glove(glove_path, glove_dim):
-    """Reads from original GloVe .txt file and returns embedding matrix and
-    mappings from words to word ids.
+    """Returns embedding matrix and mappings from words to word ids.
+
+    The first time, the GloVe .txt file is converted to a binary cache
+    (see get_glove_cache_paths) next to it. The cache can also be built directly
+    from glove.6B.zip with preprocessing/download_wordvecs.py --embedding_size.
+    After that, the embedding matrix is memory-mapped from the cache, which is
+    much faster to load. The cache is rebuilt if the .txt file is newer.
+    Note: this only speeds up loading. The model copies the whole matrix into its
+    embedding variables (see QAModel.init_embeddings), so every process that
+    builds a model (e.g. each official_eval worker) still holds its own copy.
+    Only the cache is needed, so the .txt file can be deleted afterwards.
+
+    Note: the PAD and UNK embeddings are randomly initialized when the cache is written,
+    so they are the same for every run that uses the cache.
 
     Input:
       glove_path: path to glove.6B.{glove_dim}d.txt
       glove_dim: integer; needs to match the dimension in glove_path
 
     Returns:
-      emb_matrix: Numpy array shape (400002, glove_dim) containing glove embeddings
-        (plus PAD and UNK embeddings in first two rows).
+      emb_matrix: float32 Numpy array shape (400002, glove_dim) containing glove embeddings
+        (plus PAD and UNK embeddings in first two rows). Read-only (memory-mapped) if it comes from the cache.
         The rows of emb_matrix correspond to the word ids given in word2id and id2word
       word2id: dictionary mapping word (string) to word id (int)
-      id2word: dictionary mapping word id (int) to word (string)
+      id2word: numpy object array mapping word id (int) to word (string)
     """
+    emb_matrix, words = load_glove(glove_path, glove_dim)
+    word2id, id2word = get_vocab_mappings(words)
+    return emb_matrix, word2id, id2word
 
-    print "Loading GLoVE vectors from file: %s" % glove_path
-    vocab_size = int(4e5) # this is the vocab size of the corpus we've downloaded
 
-    emb_matrix = np.zeros((vocab_size + len(_START_VOCAB), glove_dim))
-    word2id = {}
-    id2word = {}
+def load_glove(glove_path, glove_dim):
+    """
+    Like get_glove, but returns (emb_matrix, words) without building the mappings,
+    where words is the list of words (strings) in id order.
+    """
+    emb_path, vocab_path = get_glove_cache_paths(glove_path)
+    cache_exists = os.path.exists(emb_path) and os.path.exists(vocab_path)
 
-    random_init = True
-    # randomly initialize the special tokens
-    if random_init:
-        emb_matrix[:len(_START_VOCAB), :] = np.random.randn(len(_START_VOCAB), glove_dim)
+    if not cache_exists or (os.path.exists(glove_path) and os.path.getmtime(emb_path) < os.path.getmtime(glove_path)):
+        print "Converting GLoVE vectors from file: %s" % glove_path
+        try:
+            with open(glove_path, 'r') as fh:
+                write_glove_cache(fh, glove_dim, glove_path, emb_path, vocab_path)
+            cache_exists = True
+        except (IOError, OSError) as e:
+            if not os.path.exists(glove_path):
+                raise
+            print "Could not write GLoVE cache: %s" % e
+            cache_exists = False
 
-    # put start tokens in the dictionaries
-    idx = 0
-    for word in _START_VOCAB:
-        word2id[word] = idx
-        id2word[idx] = word
-        idx += 1
+    if cache_exists:
+        return load_glove_cache(emb_path, vocab_path, glove_dim, glove_path)
+    return read_glove_txt(glove_path, glove_dim)
 
-    # go through glove vecs
-    with open(glove_path, 'r') as fh:
-        for line in tqdm(fh, total=vocab_size):
-            line = line.lstrip().rstrip().split(" ")
-            word = line[0]
-            vector = list(map(float, line[1:]))
-            if glove_dim != len(vector):
-                raise Exception("You set --glove_path=%s but --embedding_size=%i. If you set --glove_path yourself then make sure that --embedding_size matches!" % (glove_path, glove_dim))
-            emb_matrix[idx, :] = vector
-            word2id[word] = idx
-            id2word[idx] = word
-            idx += 1
 
-    final_vocab_size = vocab_size + len(_START_VOCAB)
-    assert len(word2id) == final_vocab_size
-    assert len(id2word) == final_vocab_size
-    assert idx == final_vocab_size
+def load_glove_cache(emb_path, vocab_path, glove_dim, glove_path):
+    """Returns (emb_matrix, words) from a binary cache. emb_matrix is memory-mapped (read-only)."""
+    print "Loading GLoVE vectors from cache: %s" % emb_path
+    emb_matrix = np.load(emb_path, mmap_mode='r')
+    if emb_matrix.shape[1] != glove_dim:
+        raise Exception("You set --glove_path=%s but --embedding_size=%i. If you set --glove_path yourself then make sure that --embedding_size matches!" % (glove_path, glove_dim))
+    with open(vocab_path, 'rb') as f:
+        words = f.read().split(b"\n")
+    if len(words) != emb_matrix.shape[0]:
+        raise Exception("GLoVE cache %s has %i words but %s has %i rows. Delete both files to rebuild the cache." % (vocab_path, len(words), emb_path, emb_matrix.shape[0]))
+    return emb_matrix, words
+
 
+def get_vocab_mappings(words):
+    """Returns word2id (dictionary) and id2word (numpy object array) for a list of words in id order"""
+    id2word = np.array(words, dtype=object)
+    word2id = dict(izip(words, xrange(len(words))))
+    assert len(word2id) == len(words)
+    return word2id, id2word
+
+
+def prune_vocab(emb_matrix, id2word, keep_words):
+    """
+    Reduces the vocabulary to the words in keep_words (plus PAD and UNK).
+    The kept words stay in the same order, and keep their embeddings, so a word that
+    is kept gets the same embedding as before; every other word maps to UNK.
+    If emb_matrix is memory-mapped, only the kept rows are read.
+
+    Inputs:
+      emb_matrix: numpy array shape (vocab_size, embedding_size)
+      id2word: numpy object array or list mapping word id (int) to word (string)
+      keep_words: set of words (strings). Words that aren't in id2word are ignored.
+
+    Returns:
+      emb_matrix: numpy float32 array shape (new_vocab_size, embedding_size)
+      words: list of the new_vocab_size words (strings), in new id order
+    """
+    keep_ids = [idx for idx, word in enumerate(id2word) if idx < len(_START_VOCAB) or word in keep_words]
+    return np.asarray(emb_matrix[keep_ids], dtype=np.float32), [id2word[idx] for idx in keep_ids]
+
+
+def get_pruned_vocab_paths(vocab_dir):
+    """Returns the paths (emb_path, vocab_path) of the pruned vocabulary in vocab_dir (same format as the GloVe cache)"""
+    return get_glove_cache_paths(os.path.join(vocab_dir, PRUNED_VOCAB_NAME))
+
+
+def save_pruned_vocab(vocab_dir, emb_matrix, words):
+    """Writes a pruned vocabulary (see prune_vocab) to vocab_dir"""
+    emb_path, vocab_path = get_pruned_vocab_paths(vocab_dir)
+    with open(emb_path + ".tmp", 'wb') as f:
+        np.save(f, emb_matrix)
+    with open(vocab_path + ".tmp", 'wb') as f:
+        f.write(b"\n".join(words))
+    os.rename(emb_path + ".tmp", emb_path)
+    os.rename(vocab_path + ".tmp", vocab_path)
+    print "Wrote pruned vocabulary (%i words) to %s and %s" % (len(words), emb_path, vocab_path)
+
+
+def get_pruned_vocab(vocab_dir, glove_dim):
+    """
+    Like get_glove, but for the pruned vocabulary written by save_pruned_vocab.
+    Returns None if vocab_dir doesn't have one.
+    """
+    emb_path, vocab_path = get_pruned_vocab_paths(vocab_dir)
+    if not (os.path.exists(emb_path) and os.path.exists(vocab_path)):
+        return None
+    emb_matrix, words = load_glove_cache(emb_path, vocab_path, glove_dim, emb_path)
+    word2id, id2word = get_vocab_mappings(words)
     return emb_matrix, word2id, id2word